@@ -0,0 +1,242 @@
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+
+class AssetCache:
+    """
+    デコード・リサイズ済みの背景画像とキャラクター画像を(パス, サイズ)ごとに保持するLRUキャッシュ。
+    画像のモードは元ファイルのまま（背景はRGB、キャラクターはRGBAなど）保持し、
+    Image.open(path).resize(size)と同じ結果を返す。
+
+    mmap_dirを指定すると、リサイズ済みの画素をuint8の.npyファイルとして保存し、
+    メモリマップ上の画素をコピーせずに参照する画像を返す。複数のワーカープロセスで同じファイルのページを共有できる。
+    Pillowが画素をコピーせずに参照できるのは1画素1バイトか4バイトのモードだけなので、
+    RGBの画像はRGBX（4バイト目は255）として保存し、モードがRGBXの画像を返す（画素の値は同じ）。
+    LAなどそれ以外のモードはデコードのみ省略し、読み込み時にコピーする。
+
+    返す画像はキャッシュと共有しているため、呼び出し側で書き換えないこと。
+    書き換える場合はworking_copyでコピーする（RGBXはRGBに戻す）。
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, mmap_dir: str = None):
+        self.max_bytes = max_bytes
+        self.mmap_dir = mmap_dir
+        self._images = OrderedDict()
+        self._source_sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.decodes = 0
+        self.evictions = 0
+
+    def source_size(self, path: str) -> tuple[int, int]:
+        """元画像のサイズを返す（ヘッダのみ読み込み、結果は保持する）"""
+        size = self._source_sizes.get(path)
+        if size is None:
+            with Image.open(path) as img:
+                size = self._source_sizes[path] = img.size
+        return size
+
+    def get(self, path: str, size: tuple[int, int]) -> Image.Image:
+        key = (path, tuple(size))
+        img = self._images.get(key)
+        if img is not None:
+            self._images.move_to_end(key)
+            self.hits += 1
+            return img
+
+        self.misses += 1
+        if self.mmap_dir is not None:
+            img = self._load_mmap(path, key[1])
+        else:
+            img = self._decode(path, key[1])
+
+        self._images[key] = img
+        self.nbytes += _image_nbytes(img)
+        while self.nbytes > self.max_bytes and self._images:
+            _, evicted = self._images.popitem(last=False)
+            self.nbytes -= _image_nbytes(evicted)
+            self.evictions += 1
+        return img
+
+    def _decode(self, path: str, size: tuple[int, int]) -> Image.Image:
+        self.decodes += 1
+        with Image.open(path) as img:
+            if img.size != size:
+                return img.resize(size)
+            img.load()
+            return img.copy()
+
+    def _mmap_path(self, path: str, size: tuple[int, int]) -> str:
+        # ファイルの更新を検知できるよう、パスとmtime、サイズをキーにする
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}:{size[0]}x{size[1]}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(self.mmap_dir, f"{name}-{digest}")
+
+    def _load_mmap(self, path: str, size: tuple[int, int]) -> Image.Image:
+        prefix = self._mmap_path(path, size)
+        # 保存したモードはファイル名に含める（{prefix}.{mode}.npy）
+        for mode in _MMAP_MODES.values():
+            mmap_path = f"{prefix}.{mode}.npy"
+            if os.path.exists(mmap_path):
+                break
+        else:
+            img = self._decode(path, size)
+            if img.mode not in _MMAP_MODES:
+                # uint8の配列で表せないモードはメモリマップせずに保持する
+                return img
+            mode = _MMAP_MODES[img.mode]
+            if mode != img.mode:
+                img = img.convert(mode)
+            os.makedirs(self.mmap_dir, exist_ok=True)
+            mmap_path = f"{prefix}.{mode}.npy"
+            tmp_path = f"{mmap_path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, np.asarray(img))
+            os.replace(tmp_path, mmap_path)
+
+        array = np.load(mmap_path, mmap_mode="r")
+        if mode in _MAP_BUFFER_MODES:
+            # コピーせずにメモリマップ上の画素を参照する
+            size = (array.shape[1], array.shape[0])
+            return Image.frombuffer(mode, size, array, "raw", mode, 0, 1)
+        return Image.fromarray(np.asarray(array))
+
+    def clear(self):
+        self._images.clear()
+        self.nbytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._images),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "decodes": self.decodes,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.decodes = 0
+        self.evictions = 0
+
+
+class PlateCache:
+    """
+    背景画像にキャラクター画像を貼り付けた画像（プレート）を保持するLRUキャッシュ。
+    キーは(背景のパス, キャラクター画像のパスと位置, W, H)で、generate_dataと同じ手順で合成する。
+
+    max_usesを指定すると、1つのプレートをmax_uses回返した時点でキャッシュから外す。
+    同じプレートを使い続けないようにしつつ、合成の大部分を省略できる。
+
+    返す画像はキャッシュと共有しているため、呼び出し側で書き換えないこと。
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, max_uses: int = None):
+        self.max_bytes = max_bytes
+        self.max_uses = max_uses
+        self._plates = OrderedDict()  # key -> [画像, 使用回数]
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.retirements = 0
+
+    @staticmethod
+    def key(cfg) -> tuple:
+        return (
+            cfg.bg_cfg.path,
+            tuple((ch_cfg.path, ch_cfg.tl.tuple) for ch_cfg in cfg.character_cfg_list),
+            cfg.W,
+            cfg.H,
+        )
+
+    def get(self, cfg, assets: AssetCache = None) -> Image.Image:
+        """cfg(CFG1)の背景とキャラクターを合成した画像を返す。"""
+        assets = assets if assets is not None else asset_cache
+        key = self.key(cfg)
+        entry = self._plates.get(key)
+        if entry is not None:
+            self._plates.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = [compose_plate(cfg, assets), 0]
+            self._plates[key] = entry
+            self.nbytes += _image_nbytes(entry[0])
+            while self.nbytes > self.max_bytes and len(self._plates) > 1:
+                _, evicted = self._plates.popitem(last=False)
+                self.nbytes -= _image_nbytes(evicted[0])
+                self.evictions += 1
+
+        plate = entry[0]
+        entry[1] += 1
+        if self.max_uses is not None and entry[1] >= self.max_uses:
+            # 使用回数の上限に達したプレートは次回に合成し直す
+            del self._plates[key]
+            self.nbytes -= _image_nbytes(plate)
+            self.retirements += 1
+        return plate
+
+    def clear(self):
+        self._plates.clear()
+        self.nbytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._plates),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "retirements": self.retirements,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.retirements = 0
+
+
+def working_copy(img: Image.Image) -> Image.Image:
+    """AssetCacheが返した画像を書き換え可能なコピーにする。メモリマップのRGBXの画像はRGBにする"""
+    if img.mode == "RGBX":
+        return img.convert("RGB")
+    return img.copy()
+
+
+def compose_plate(cfg, assets: AssetCache) -> Image.Image:
+    # 背景画像にキャラクター画像を高さを合わせて貼り付ける
+    img = working_copy(assets.get(cfg.bg_cfg.path, (cfg.W, cfg.H)))
+    for ch_cfg in cfg.character_cfg_list:
+        fg_width, fg_height = assets.source_size(ch_cfg.path)
+        fg = assets.get(ch_cfg.path, (int(fg_width * (cfg.H / fg_height)), cfg.H))
+        img.paste(fg, ch_cfg.tl.tuple, fg)
+    return img
+
+
+# 元の画像のモード -> 保存するモード
+_MMAP_MODES = {"L": "L", "LA": "LA", "RGB": "RGBX", "RGBA": "RGBA"}
+# Image.frombufferがコピーせずに参照できるモード
+_MAP_BUFFER_MODES = ("L", "RGBX", "RGBA")
+
+
+def _image_nbytes(img: Image.Image) -> int:
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+# generate_dataが使うプロセス共通のキャッシュ
+asset_cache = AssetCache()
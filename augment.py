@@ -0,0 +1,304 @@
+"""
+生成した画像に、スクリーンショットらしい劣化（拡大縮小、色の変化、ぼかし、ノイズ、JPEGの圧縮ノイズ）を加える。
+
+params = [sample_params(cfg.augment, seed) for cfg, seed in ...]
+augment_batch(images, params)   # (N, H, W, 3または4)のuint8配列をその場で書き換える
+
+処理はサンプルごとの乱数シードから選んだパラメータ（AugmentParams）だけで決まるため、
+どのプロセスでどの組み合わせのバッチとして処理しても同じ結果になる。
+色の変化、ぼかし、ノイズはバッチ全体をまとめて配列演算で計算する。拡大縮小とJPEGはサンプルごとにPillowで処理する。
+拡大縮小は画像の大きさを変えずに左上を中心に行い、はみ出した部分は切り捨て、足りない部分は黒で埋める。
+テキストボックスの座標はAugmentParams.transform_boxesで同じように変換できる。
+"""
+
+import io
+from dataclasses import dataclass
+from statistics import NormalDist
+import numpy as np
+from PIL import Image
+from configs import AugmentCFG
+
+# RGBから輝度を計算する係数（ITU-R BT.601、PillowのconvertでLにする場合と同じ）
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+@dataclass
+class AugmentParams:
+    # 既定値はいずれも何もしない値
+    seed: int = 0  # ノイズの乱数シード
+    scale: float = 1.0
+    brightness: float = 1.0
+    contrast: float = 1.0
+    saturation: float = 1.0
+    blur_sigma: float = 0.0
+    noise_std: float = 0.0
+    jpeg_quality: int = None
+
+    @property
+    def jitter(self) -> bool:
+        return (self.brightness, self.contrast, self.saturation) != (1.0, 1.0, 1.0)
+
+    def transform_points(self, points: np.ndarray) -> np.ndarray:
+        """(..., 2)の座標(x, y)を拡大縮小後の画像の座標に変換する"""
+        return np.asarray(points, dtype=np.float64) * self.scale
+
+    def transform_boxes(self, boxes: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+        """
+        (N, 4)の矩形(x0, y0, x1, y1)を拡大縮小後の画像の座標に変換し、画像の大きさsize(W, H)で切り抜く。
+        座標は整数に丸める。
+        """
+        boxes = np.rint(self.transform_points(np.reshape(boxes, (-1, 2, 2))))
+        boxes[..., 0] = np.clip(boxes[..., 0], 0, size[0])
+        boxes[..., 1] = np.clip(boxes[..., 1], 0, size[1])
+        return boxes.reshape(-1, 4).astype(np.int64)
+
+
+def sample_params(cfg: AugmentCFG, seed: int) -> AugmentParams:
+    """cfgの確率と範囲からseedで決まるパラメータを選ぶ"""
+    rng = np.random.default_rng(seed)
+    # 適用するかどうかによらず同じ数の乱数を使い、一部の設定を変えても他のパラメータが変わらないようにする
+    apply = rng.random(5) < [cfg.scale_p, cfg.jitter_p, cfg.blur_p, cfg.noise_p, cfg.jpeg_p]
+    u = rng.random(7)
+    params = AugmentParams(seed=int(rng.integers(2**63)))
+    if apply[0]:
+        params.scale = float(cfg.scale[0] + (cfg.scale[1] - cfg.scale[0]) * u[0])
+    if apply[1]:
+        params.brightness = float(1 + cfg.brightness * (2 * u[1] - 1))
+        params.contrast = float(1 + cfg.contrast * (2 * u[2] - 1))
+        params.saturation = float(1 + cfg.saturation * (2 * u[3] - 1))
+    if apply[2]:
+        params.blur_sigma = float(
+            cfg.blur_sigma[0] + (cfg.blur_sigma[1] - cfg.blur_sigma[0]) * u[4]
+        )
+    if apply[3]:
+        params.noise_std = float(
+            cfg.noise_std[0] + (cfg.noise_std[1] - cfg.noise_std[0]) * u[5]
+        )
+    if apply[4]:
+        lo, hi = cfg.jpeg_quality
+        params.jpeg_quality = int(lo + round((hi - lo) * u[6]))
+    return params
+
+
+def _scale(img: np.ndarray, scale: float) -> np.ndarray:
+    """
+    左上を中心にscale倍する（バイリニア補間）。画像の大きさは変えず、縮小した場合は右と下を黒で埋める。
+    補間で画素を取り出す処理は配列演算では遅いため、サンプルごとにPillowでリサイズする。
+    """
+    h, w = img.shape[:2]
+    src = Image.fromarray(img)
+    if scale >= 1:
+        # 元の画像の(0, 0)-(w / scale, h / scale)の範囲を画像全体に拡大する
+        return np.asarray(src.resize((w, h), Image.BILINEAR, box=(0, 0, w / scale, h / scale)))
+    out = np.zeros_like(img)
+    small = src.resize((max(round(w * scale), 1), max(round(h * scale), 1)), Image.BILINEAR)
+    out[: small.height, : small.width] = np.asarray(small)
+    return out
+
+
+def _jitter(x: np.ndarray, params: list[AugmentParams]) -> np.ndarray:
+    """
+    彩度、コントラスト、明るさを順に変える。いずれもRGBの線形変換なので、サンプルごとの3x3行列にまとめて1回で計算する。
+    彩度: gray + s * (rgb - gray)、コントラスト: m + c * (v - m)（mは画像全体の輝度の平均）、明るさ: b * v
+    """
+    n = len(x)
+    rgb = x[..., :3].reshape(n, -1, 3)
+    # 彩度を変えても輝度は変わらないため、平均は元の画像の輝度から求める
+    mean = (rgb @ _LUMA).mean(axis=1)
+
+    matrix = np.empty((n, 3, 3), dtype=np.float32)
+    bias = np.empty((n, 1, 3), dtype=np.float32)
+    for i, p in enumerate(params):
+        saturate = p.saturation * np.eye(3, dtype=np.float32) + (1 - p.saturation) * _LUMA[None, :]
+        matrix[i] = (p.brightness * p.contrast * saturate).T
+        bias[i] = p.brightness * (1 - p.contrast) * mean[i]
+    out = np.matmul(rgb, matrix)
+    out += bias
+    if x.shape[3] == 3:
+        return out.reshape(x.shape)
+    x[..., :3] = out.reshape(x[..., :3].shape)
+    return x
+
+
+def _convolve(x: np.ndarray, kernels: np.ndarray, axis: int) -> np.ndarray:
+    # axis（1: 縦、2: 横）方向にサンプルごとのカーネルで畳み込む（端は端の画素を繰り返す）
+    radius = (kernels.shape[1] - 1) // 2
+    n, h, w, c = x.shape
+    # np.pad(mode="edge")と同じ。np.padは遅いため、確保した配列に直接書き込む
+    shape = [n, h, w, c]
+    shape[axis] += 2 * radius
+    padded = np.empty(shape, dtype=x.dtype)
+    index = [slice(None)] * 4
+    for dst, src in (
+        (slice(radius, -radius), slice(None)),
+        (slice(None, radius), slice(None, 1)),
+        (slice(-radius, None), slice(-1, None)),
+    ):
+        index_dst, index_src = list(index), list(index)
+        index_dst[axis], index_src[axis] = dst, src
+        padded[tuple(index_dst)] = x[tuple(index_src)]
+
+    # 行ごとに(幅 * チャンネル数)の1次元として、畳み込む窓をずらした参照で作る
+    # （チャンネル数の長さの最内ループは遅いため）
+    flat = padded.reshape(n, shape[1], -1)
+    step = flat.strides[1] if axis == 1 else flat.strides[2] * c
+    windows = np.lib.stride_tricks.as_strided(
+        flat,
+        shape=(n, h, w * c, kernels.shape[1]),
+        strides=flat.strides + (step,),
+        writeable=False,
+    )
+    return np.einsum("nhxk,nk->nhx", windows, kernels).reshape(n, h, w, c)
+
+
+def _blur(x: np.ndarray, sigmas: np.ndarray) -> np.ndarray:
+    """
+    サンプルごとのσのガウシアンカーネルで縦横に分けて畳み込む。
+    カーネルの半径はceil(3σ)で、同じ半径のサンプルごとにまとめて計算する
+    （カーネルの長さによって加算の順序が変わるため、同じバッチの他のサンプルによらず同じ結果にする）。
+    """
+    radii = np.maximum(np.ceil(3 * sigmas), 1).astype(np.int64)
+    out = None
+    for radius in np.unique(radii).tolist():
+        rows = np.flatnonzero(radii == radius)
+        taps = np.arange(-radius, radius + 1, dtype=np.float32)
+        kernels = np.exp(-0.5 * (taps / sigmas[rows, None]) ** 2)
+        kernels /= kernels.sum(axis=1, keepdims=True)
+
+        whole = len(rows) == len(x)
+        y = _convolve(_convolve(x if whole else x[rows], kernels, 1), kernels, 2)
+        if whole:
+            return y
+        if out is None:
+            out = np.empty_like(x)
+        out[rows] = y
+    return out
+
+
+def _jpeg(img: np.ndarray, quality: int) -> np.ndarray:
+    # JPEGのエンコードは配列演算にできないため、サンプルごとにPillowでエンコードしてデコードし直す
+    mode = "RGB" if img.shape[2] == 3 else "RGBA"
+    buf = io.BytesIO()
+    Image.fromarray(img[..., :3]).save(buf, format="JPEG", quality=quality)
+    out = np.asarray(Image.open(buf).convert("RGB"))
+    if mode == "RGBA":
+        out = np.concatenate([out, img[..., 3:]], axis=2)
+    return out
+
+
+# 浮動小数点数の作業用配列が大きくなりすぎないよう、この枚数ずつ処理する
+CHUNK_SIZE = 8
+
+
+def _noise_table() -> np.ndarray:
+    # 標準正規分布を256段階に量子化した値。乱数のバイト列から引くことで正規乱数を生成するより速くする
+    dist = NormalDist()
+    return np.array([dist.inv_cdf((k + 0.5) / 256) for k in range(256)], np.float32)
+
+
+_NOISE_TABLE = _noise_table()
+
+
+def _noise(shape: tuple, params: AugmentParams) -> np.ndarray:
+    rng = np.random.default_rng(params.seed)
+    index = np.frombuffer(rng.bytes(int(np.prod(shape))), dtype=np.uint8)
+    return (_NOISE_TABLE * np.float32(params.noise_std))[index].reshape(shape)
+
+
+def _augment_float(images: np.ndarray, params: list[AugmentParams]):
+    # 色の変化、ぼかし、ノイズをまとめて浮動小数点数で計算し、imagesをその場で書き換える
+    targets = [i for i, p in enumerate(params) if p.jitter or p.blur_sigma > 0 or p.noise_std > 0]
+    if not targets:
+        return
+    if len(targets) == len(images):
+        # 全ての画像が対象の場合はコピーを作らずにスライスで扱う
+        targets = slice(None)
+    else:
+        params = [params[i] for i in targets]
+    x = images[targets].astype(np.float32)
+    c = min(x.shape[3], 3)
+
+    jittered = [j for j, p in enumerate(params) if p.jitter]
+    if len(jittered) == len(params):
+        x = _jitter(x, params)
+    elif jittered:
+        x[jittered] = _jitter(x[jittered], [params[j] for j in jittered])
+
+    blurred = [j for j, p in enumerate(params) if p.blur_sigma > 0]
+    if blurred:
+        sigmas = np.array([params[j].blur_sigma for j in blurred], np.float32)
+        if len(blurred) == len(params):
+            x[..., :c] = _blur(x[..., :c], sigmas)
+        else:
+            x[blurred, ..., :c] = _blur(x[blurred, ..., :c], sigmas)
+
+    # ノイズはサンプルごとのシードで生成する
+    for j, p in enumerate(params):
+        if p.noise_std > 0:
+            x[j, ..., :c] += _noise(x.shape[1:3] + (c,), p)
+
+    np.rint(x, out=x)
+    np.clip(x, 0, 255, out=x)
+    images[targets] = x
+
+
+def augment_batch(images: np.ndarray, params: list[AugmentParams]) -> np.ndarray:
+    """
+    (N, H, W, 3または4)のuint8配列のi番目の画像にparams[i]の劣化を加え、その場で書き換えて返す。
+    処理は拡大縮小、色の変化、ぼかし、ノイズ、JPEGの順。アルファチャンネルは拡大縮小だけを適用する。
+    """
+    if len(params) != len(images):
+        raise ValueError(f"got {len(params)} params for {len(images)} images")
+
+    for i, p in enumerate(params):
+        if p.scale != 1.0:
+            images[i] = _scale(images[i], p.scale)
+
+    for start in range(0, len(images), CHUNK_SIZE):
+        chunk = images[start : start + CHUNK_SIZE]
+        _augment_float(chunk, params[start : start + CHUNK_SIZE])
+
+    for i, p in enumerate(params):
+        if p.jpeg_quality is not None:
+            images[i] = _jpeg(images[i], p.jpeg_quality)
+    return images
+
+
+def augment_image(img: Image.Image, params: AugmentParams) -> Image.Image:
+    """1枚の画像にparamsの劣化を加えた画像を返す（RGB、RGBA以外のモードはRGBに変換する）"""
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    images = np.array(img)[None]
+    return Image.fromarray(augment_batch(images, [params])[0])
+
+
+def transform_text_boxes(text_boxes: dict, params: AugmentParams, size: tuple[int, int]) -> dict:
+    """Outputs.text_boxesの全ての矩形をparamsの拡大縮小に合わせて変換したものを返す"""
+
+    def convert(boxes):
+        return params.transform_boxes(boxes, size).tolist()
+
+    return {
+        "options": [convert(options) for options in text_boxes["options"]],
+        "names": convert(text_boxes["names"]) if text_boxes["names"] else [],
+        "messages": convert(text_boxes["messages"]) if text_boxes["messages"] else [],
+    }
+
+
+def apply_augment(output, params: AugmentParams, image: bool = True):
+    """
+    generate_dataの出力（Outputs）にparamsの劣化を加え、テキストボックスと文字の座標も変換する。
+    image=Falseの場合は画像はそのままにして、あとでaugment_batchでまとめて処理する（座標は変換する）。
+    """
+    output.augment = params
+    if output.text_boxes is not None:
+        output.text_boxes = transform_text_boxes(
+            output.text_boxes, params, output.image.size
+        )
+    if output.char_boxes is not None:
+        output.char_boxes.boxes = params.transform_boxes(
+            output.char_boxes.boxes, output.image.size
+        ).astype(np.int16)
+    if image:
+        output.image = augment_image(output.image, params)
+    return output
@@ -0,0 +1,37 @@
+"""
+benchmark.pyとequivalence.pyで共有する入力（同梱のsample_images/とtexts/だけを使う）
+"""
+
+import csv
+from utils import split_sentence
+
+MESSAGE_CSV = "./texts/message_samples.csv"
+NAME_CSV = "./texts/name_samples.csv"
+BG_PATH = "./sample_images/sample_bg.png"
+CHARACTER_PATH = "./sample_images/sample_character.png"
+
+# 名前のような短いテキストから複数行にわたる長いメッセージまで
+LENGTHS = ("name", "sentence", "message", "long")
+
+
+def load_texts(path: str, column: str) -> list[str]:
+    with open(path, encoding="utf-8", newline="") as f:
+        return [row[column] for row in csv.DictReader(f) if row[column]]
+
+
+def get_texts(length: str) -> list[str]:
+    # ルビ付きのテキストを返す（ルビなしはremove_ruby_tagsで作る）
+    if length == "name":
+        return load_texts(NAME_CSV, "text_ruby_hiragana")
+    messages = load_texts(MESSAGE_CSV, "text_ruby_hiragana")
+    if length == "sentence":
+        return [split_sentence(message)[0] for message in messages]
+    if length == "message":
+        return messages
+    if length == "long":
+        # 3つずつつなげて3～4行になるメッセージにする
+        return [
+            "".join(messages[(i + k) % len(messages)] for k in range(3))
+            for i in range(len(messages))
+        ]
+    raise ValueError(f"unknown length: {length!r}")
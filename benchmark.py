@@ -0,0 +1,337 @@
+"""
+描画処理のベンチマーク
+
+python benchmark.py --save benchmarks/baseline.json
+python benchmark.py --compare benchmarks/baseline.json --threshold 10
+
+fonts/, sample_images/, texts/に同梱されたファイルだけを使い、固定したシードで設定を作るため、
+同じ環境であれば何度実行しても同じ入力で計測する。
+ベンチマークごとに1回あたりの処理時間のp50/p99、1秒あたりのサンプル数、実行後のピークRSSを出力する。
+ピークRSSはプロセス全体の最大値なので、それまでに実行したベンチマークの分も含む。
+startup/{モジュール名}は、新しいプロセスでモジュールをimportするのにかかる時間と、import後のピークRSSを計測する
+（データローダーのワーカーを起動するたびに払うコスト）。
+--compareを指定すると基準のJSONと比較し、--threshold[%]を超えて遅くなったベンチマークがあれば終了コード1で終了する。
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Callable
+import numpy as np
+import PIL
+from bench_fixtures import BG_PATH, CHARACTER_PATH, LENGTHS, get_texts
+from configs import CFG1, ImageCFG, Point, TextBoxCFG
+from generation_utils import (
+    create_box,
+    create_textarea,
+    get_random_color_pair,
+    get_tiled_option_cfgs,
+)
+from generators import generate_data
+from utils import remove_ruby_tags, split_sentence
+
+STARTUP_MODULES = ("configs", "generators", "streaming")
+
+# 新しいプロセスで実行し、import時間[秒]とピークRSS[MB]をJSONで出力する
+_STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+try:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak /= 1024 * 1024 if sys.platform == "darwin" else 1024
+except ImportError:
+    peak = None
+print(json.dumps({{"seconds": seconds, "peak_rss_mb": peak}}))
+"""
+
+
+def make_msgbox(text: str, rng: random.Random) -> TextBoxCFG:
+    font_hex, bg_hex = get_random_color_pair(rng=rng)
+    cfg = TextBoxCFG(
+        text=text,
+        tl=Point(100, 720),
+        br=Point(1820, 1040),
+        font_hex=font_hex,
+        bg_hex=bg_hex,
+        bg_alpha=200,
+    )
+    cfg.change_font_size(40)
+    cfg.change_ruby_font_size(20)
+    return cfg
+
+
+def make_cfg(text: str, name: str, rng: random.Random) -> CFG1:
+    cfg = CFG1()
+    cfg.bg_cfg = ImageCFG(path=BG_PATH)
+    cfg.character_cfg_list = [
+        ImageCFG(path=CHARACTER_PATH, tl=Point(rng.randint(0, 1200), 0))
+    ]
+    cfg.msgbox = make_msgbox(text, rng)
+
+    cfg.namebox = TextBoxCFG(
+        text=name,
+        tl=Point(100, 620),
+        br=Point(600, 710),
+        font_hex=cfg.msgbox.font_hex,
+        bg_hex=cfg.msgbox.bg_hex,
+        bg_alpha=200,
+    )
+    cfg.namebox.change_font_size(36)
+    cfg.namebox.change_ruby_font_size(16)
+
+    options = [
+        TextBoxCFG(text=remove_ruby_tags(option), br=Point(900, 120), centering=True)
+        for option in split_sentence(remove_ruby_tags(text))[:3]
+    ]
+    cfg.optionbox_list = get_tiled_option_cfgs(
+        len(options), 1, Point(200, 100), Point(1700, 550), options
+    )
+
+    cfg.noocrbox_list = [
+        TextBoxCFG(
+            text=label,
+            tl=Point(1400 + 130 * i, 20),
+            br=Point(1520 + 130 * i, 80),
+            bg_alpha=150,
+        )
+        for i, label in enumerate(["Save", "Load", "Log"])
+    ]
+    for noocr_cfg in cfg.noocrbox_list:
+        noocr_cfg.change_font_size(24)
+        noocr_cfg.change_ruby_font_size(10)
+    return cfg
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        # Windowsではresourceモジュールが使えない
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def measure(
+    func: Callable[[object], object], inputs: list, iterations: int, warmup: int
+) -> dict:
+    """inputsを順に繰り返してfuncをiterations回呼び出し、1回ごとの処理時間を計測する。"""
+    for i in range(warmup):
+        func(inputs[i % len(inputs)])
+
+    latencies = np.empty(iterations, dtype=np.float64)
+    t0 = time.perf_counter()
+    for i in range(iterations):
+        arg = inputs[i % len(inputs)]
+        start = time.perf_counter()
+        func(arg)
+        latencies[i] = time.perf_counter() - start
+    elapsed = time.perf_counter() - t0
+
+    return {
+        "iterations": iterations,
+        "samples_per_sec": iterations / elapsed,
+        "mean_ms": float(latencies.mean() * 1e3),
+        "p50_ms": float(np.percentile(latencies, 50) * 1e3),
+        "p99_ms": float(np.percentile(latencies, 99) * 1e3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def measure_startup(module: str, runs: int) -> dict:
+    """新しいPythonプロセスでmoduleをimportする時間をruns回計測する。プロセスの起動時間は含まない。"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    latencies = np.empty(runs, dtype=np.float64)
+    peaks = []
+    for i in range(runs):
+        proc = subprocess.run(
+            [sys.executable, "-c", _STARTUP_SCRIPT.format(module=module)],
+            cwd=root,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        latencies[i] = result["seconds"]
+        peaks.append(result["peak_rss_mb"])
+
+    return {
+        "iterations": runs,
+        "samples_per_sec": runs / latencies.sum(),
+        "mean_ms": float(latencies.mean() * 1e3),
+        "p50_ms": float(np.percentile(latencies, 50) * 1e3),
+        "p99_ms": float(np.percentile(latencies, 99) * 1e3),
+        "peak_rss_mb": max(peaks) if None not in peaks else None,
+    }
+
+
+def build_benchmarks(seed: int) -> dict[str, tuple[Callable, list]]:
+    """ベンチマーク名 -> (計測する関数, 入力のリスト)。入力は計測前にすべて作っておく。"""
+    rng = random.Random(seed)
+    names = get_texts("name")
+    benchmarks = {}
+
+    benchmarks["create_box"] = (
+        lambda args: create_box(*args),
+        [(1720, 320, get_random_color_pair(rng=rng)[1], 200)],
+    )
+
+    for length in LENGTHS:
+        texts = get_texts(length)
+        for ruby in (False, True):
+            cfgs = [
+                make_msgbox(text if ruby else remove_ruby_tags(text), rng)
+                for text in texts
+            ]
+            key = f"create_textarea/{length}/{'ruby' if ruby else 'plain'}"
+            benchmarks[key] = (create_textarea, cfgs)
+
+    # get_tiled_option_cfgsは引数のcfgを書き換えるため、呼び出すたびにコピーする
+    option_lists = [
+        [
+            TextBoxCFG(text=sentence, br=Point(900, 120), centering=True)
+            for sentence in split_sentence(remove_ruby_tags(text))[:4]
+        ]
+        for text in get_texts("message")
+    ]
+    benchmarks["get_tiled_option_cfgs"] = (
+        lambda options: get_tiled_option_cfgs(
+            len(options), 1, Point(200, 100), Point(1700, 550), copy.deepcopy(options)
+        ),
+        option_lists,
+    )
+
+    for length in LENGTHS:
+        texts = get_texts(length)
+        cfgs = [
+            make_cfg(text, names[i % len(names)], rng) for i, text in enumerate(texts)
+        ]
+        benchmarks[f"generate_data/{length}"] = (generate_data, cfgs)
+
+    return benchmarks
+
+
+def run(args) -> dict:
+    benchmarks = build_benchmarks(args.seed)
+    for module in STARTUP_MODULES:
+        benchmarks[f"startup/{module}"] = (module, None)
+    results = {}
+    for name, (func, inputs) in benchmarks.items():
+        if args.filter and not any(f in name for f in args.filter):
+            continue
+        if name.startswith("startup/"):
+            results[name] = measure_startup(func, args.startup_runs)
+        else:
+            iterations = args.iterations
+            if name.startswith("generate_data"):
+                iterations = max(1, iterations // 10)
+            results[name] = measure(func, inputs, iterations, args.warmup)
+        r = results[name]
+        print(
+            f"{name:40s} {r['samples_per_sec']:10.1f}/s "
+            f"p50 {r['p50_ms']:8.3f} ms  p99 {r['p99_ms']:8.3f} ms  "
+            f"rss {r['peak_rss_mb'] or 0:7.1f} MB",
+            file=sys.stderr,
+        )
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pillow": PIL.__version__,
+            "numpy": np.__version__,
+            "seed": args.seed,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "startup_runs": args.startup_runs,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    基準と比較して、1回あたりの平均時間（samples_per_secの逆数）かp50がthreshold[%]を超えて増加したベンチマークを返す。
+    p99は実行ごとのばらつきが大きいため、表示のみで判定には使わない。
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        slowdown = (base["samples_per_sec"] / result["samples_per_sec"] - 1) * 100
+        p50 = (result["p50_ms"] / base["p50_ms"] - 1) * 100
+        p99 = (result["p99_ms"] / base["p99_ms"] - 1) * 100
+        flag = "REGRESSION" if max(slowdown, p50) > threshold else ""
+        print(
+            f"{name:40s} time {slowdown:+7.1f}%  p50 {p50:+7.1f}%  p99 {p99:+7.1f}%  {flag}",
+            file=sys.stderr,
+        )
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--save", type=str, default=None, help="write results as JSON")
+    parser.add_argument(
+        "--compare", type=str, default=None, help="baseline JSON to compare with"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="regression threshold in percent (default: 10)",
+    )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        nargs="*",
+        default=None,
+        help="run only benchmarks whose name contains one of these strings",
+    )
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--startup-runs",
+        type=int,
+        default=10,
+        help="number of fresh processes for the startup benchmarks",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    current = run(args)
+
+    if args.save is not None:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(
+                f"{len(regressions)} benchmark(s) regressed by more than {args.threshold}%",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
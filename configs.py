@@ -1,7 +1,9 @@
+import copy
 import dataclasses
 from dataclasses import dataclass
 from PIL import ImageFont
-from utils import remove_ruby_tags
+from font_utils import get_font
+from utils import RubyMarkupError, parse_ruby, remove_ruby_tags
 
 
 @dataclass
@@ -36,10 +38,7 @@ DEFAULT_FONT_PATH: str = "./fonts/BIZUDGothic-Bold.ttf"
 
 
 def _get_default_font(size) -> ImageFont:
-    return ImageFont.truetype(
-        font=DEFAULT_FONT_PATH,
-        size=size,
-    )
+    return get_font(DEFAULT_FONT_PATH, size)
 
 
 @dataclass
@@ -67,19 +66,22 @@ class TextBoxCFG:
     ruby: str = ""
     # has_ruby: bool = True
 
-    tl: Point = Point(x=0, y=0)
-    br: Point = Point(x=200, y=100)
-    margin: Margin = Margin(top=20, right=30, left=30, bottom=20)
+    tl: Point = dataclasses.field(default_factory=lambda: Point(x=0, y=0))
+    br: Point = dataclasses.field(default_factory=lambda: Point(x=200, y=100))
+    margin: Margin = dataclasses.field(
+        default_factory=lambda: Margin(top=20, right=30, left=30, bottom=20)
+    )
 
     bg_hex: str = "#ffffff"
     bg_alpha: int = 255
 
     font_hex: str = "#000000"
 
-    _font: ImageFont = _get_default_font(50)
-    fallback_font: ImageFont = _get_default_font(50)
-    _ruby_font: ImageFont = _get_default_font(20)
-    fallback_ruby_font: ImageFont = _get_default_font(20)
+    # 省略した場合はDEFAULT_FONT_PATHのフォントを使う（importの時点ではフォントを開かない）
+    _font: ImageFont = None
+    fallback_font: ImageFont = None
+    _ruby_font: ImageFont = None
+    fallback_ruby_font: ImageFont = None
 
     line_spacing: int = 10
     character_spacing: int = 3
@@ -87,6 +89,17 @@ class TextBoxCFG:
     ruby_character_spacing: int = 1
     centering: bool = False
 
+    def __post_init__(self):
+        # get_fontはFontPoolで共有するため、2つ目以降のインスタンスではフォントを開き直さない
+        if self._font is None:
+            self._font = _get_default_font(50)
+        if self.fallback_font is None:
+            self.fallback_font = _get_default_font(50)
+        if self._ruby_font is None:
+            self._ruby_font = _get_default_font(20)
+        if self.fallback_ruby_font is None:
+            self.fallback_ruby_font = _get_default_font(20)
+
     @property
     def font(self):
         return self._font
@@ -95,8 +108,8 @@ class TextBoxCFG:
     def font(self, value: ImageFont):
         self._font = value
         # フォールバックフォントのサイズを合わせる
-        self.fallback_font = ImageFont.truetype(
-            font=self.fallback_font.path, size=self._font.size
+        self.fallback_font = get_font(
+            self.fallback_font.path, self._font.size, self.fallback_font.index
         )
 
     @property
@@ -106,8 +119,10 @@ class TextBoxCFG:
     @ruby_font.setter
     def ruby_font(self, value: ImageFont):
         self._ruby_font = value
-        self.fallback_ruby_font = ImageFont.truetype(
-            font=self.fallback_ruby_font.path, size=self._ruby_font.size
+        self.fallback_ruby_font = get_font(
+            self.fallback_ruby_font.path,
+            self._ruby_font.size,
+            self.fallback_ruby_font.index,
         )
 
     @property
@@ -172,20 +187,77 @@ class TextBoxCFG:
         return max_fs
 
     def change_font_size(self, size: int):
-        self.font = ImageFont.truetype(self.font.path, size=int(size))
+        self.font = get_font(self.font.path, int(size), self.font.index)
 
     def change_ruby_font_size(self, size: int):
-        self.ruby_font = ImageFont.truetype(self.ruby_font.path, size=int(size))
+        self.ruby_font = get_font(self.ruby_font.path, int(size), self.ruby_font.index)
 
     @property
     def has_ruby(self):
-        return "<ruby>" in self.text
+        try:
+            return parse_ruby(self.text).has_ruby
+        except RubyMarkupError:
+            # タグが不正な場合の判定は以前と同じにする（描画時にはlayout_textがエラーを上げる）
+            return "<ruby>" in self.text
+
+    def scaled(self, scale: float) -> "TextBoxCFG":
+        """
+        位置、大きさ、余白、文字間隔、フォントサイズをscale倍したコピーを返す。
+        座標とフォントサイズは整数に丸めるため、改行位置が元の大きさと完全に一致するとは限らない。
+        """
+        cfg = copy.copy(self)
+        cfg.tl = _scale_point(self.tl, scale)
+        cfg.br = _scale_point(self.br, scale)
+        cfg.margin = Margin(
+            top=round(self.margin.top * scale),
+            right=round(self.margin.right * scale),
+            bottom=round(self.margin.bottom * scale),
+            left=round(self.margin.left * scale),
+        )
+        cfg.line_spacing = round(self.line_spacing * scale)
+        cfg.character_spacing = round(self.character_spacing * scale)
+        cfg.ruby_line_spacing = round(self.ruby_line_spacing * scale)
+        cfg.ruby_character_spacing = round(self.ruby_character_spacing * scale)
+        cfg.change_font_size(max(round(self.font.size * scale), 1))
+        cfg.change_ruby_font_size(max(round(self.ruby_font.size * scale), 1))
+        return cfg
+
+
+def _scale_point(point: Point, scale: float) -> Point:
+    return Point(x=round(point.x * scale), y=round(point.y * scale))
 
 
 @dataclass
 class ImageCFG:
     path: str = "./sample_images/sample_bg.png"
-    tl: Point = Point(x=0, y=0)
+    tl: Point = dataclasses.field(default_factory=lambda: Point(x=0, y=0))
+
+
+@dataclass
+class AugmentCFG:
+    """
+    生成した画像に加える劣化（augment.augment_batch）の設定。
+    *_pはサンプルごとにその処理を適用する確率、タプルはパラメータを一様に選ぶ範囲(最小, 最大)。
+    """
+
+    # 左上を中心とした拡大縮小（テキストボックスの座標も同じ倍率で変換する）
+    scale_p: float = 0.0
+    scale: tuple[float, float] = (0.8, 1.2)
+
+    # 明るさ、コントラスト、彩度をそれぞれ1±brightnessなどの倍率で変える
+    jitter_p: float = 0.0
+    brightness: float = 0.2
+    contrast: float = 0.2
+    saturation: float = 0.2
+
+    blur_p: float = 0.0
+    blur_sigma: tuple[float, float] = (0.3, 1.5)
+
+    noise_p: float = 0.0
+    noise_std: tuple[float, float] = (2.0, 8.0)
+
+    jpeg_p: float = 0.0
+    jpeg_quality: tuple[int, int] = (30, 90)
 
 
 @dataclass
@@ -196,18 +268,53 @@ class CFG1:
     H: int = 1080
 
     # 背景画像
-    bg_cfg: ImageCFG = ImageCFG()
+    bg_cfg: ImageCFG = dataclasses.field(default_factory=ImageCFG)
 
     # キャラクターの位置
     character_cfg_list: list[ImageCFG] = dataclasses.field(default_factory=list)
 
-    msgbox: TextBoxCFG = TextBoxCFG()
-    namebox: TextBoxCFG = TextBoxCFG()
+    msgbox: TextBoxCFG = dataclasses.field(default_factory=TextBoxCFG)
+    namebox: TextBoxCFG = dataclasses.field(default_factory=TextBoxCFG)
     optionbox_list: list[TextBoxCFG] = dataclasses.field(default_factory=list)
 
     # 文字起こししない要素
     noocrbox_list: list[TextBoxCFG] = dataclasses.field(default_factory=list)
 
+    # 出力画像の倍率。1以外の場合、generate_dataは全ての座標と大きさをscale倍して直接その解像度で描画する
+    scale: float = 1.0
+
+    # 生成後に加える劣化（Noneの場合は加えない）。generate_dataの最後に適用する
+    augment: AugmentCFG = None
+
+    # テキストボックスの描画方法（render_backendsに登録した名前）
+    backend: str = "pillow"
+
+    # Trueの場合、generate_dataは文字ごとの矩形（layout.CharBoxes）をOutputs.char_boxesに出力する
+    char_boxes: bool = False
+
+    def scaled(self, scale: float = None) -> "CFG1":
+        """
+        画像サイズ、キャラクターの位置、全てのテキストボックスをscale倍したコピー（scale=1.0）を返す。
+        キャラクター画像は高さをHに合わせて描画するため、Hと同じ倍率になる。
+        scaleを省略した場合はself.scaleを使う。
+        """
+        scale = self.scale if scale is None else scale
+        return dataclasses.replace(
+            self,
+            W=round(self.W * scale),
+            H=round(self.H * scale),
+            bg_cfg=copy.copy(self.bg_cfg),
+            character_cfg_list=[
+                ImageCFG(path=ch_cfg.path, tl=_scale_point(ch_cfg.tl, scale))
+                for ch_cfg in self.character_cfg_list
+            ],
+            msgbox=self.msgbox.scaled(scale) if self.msgbox is not None else None,
+            namebox=self.namebox.scaled(scale) if self.namebox is not None else None,
+            optionbox_list=[cfg.scaled(scale) for cfg in self.optionbox_list],
+            noocrbox_list=[cfg.scaled(scale) for cfg in self.noocrbox_list],
+            scale=1.0,
+        )
+
 
 @dataclass
 class CFG_CHAT:
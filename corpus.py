@@ -0,0 +1,341 @@
+"""
+大きなテキストコーパスから任意のサンプルを読み出すためのオフセットインデックス
+
+corpus = TextCorpus("./corpus/messages.txt")              # 1行1サンプルのUTF-8テキスト
+corpus = TextCorpus("./corpus/messages.parquet", column="text_ruby_hiragana")
+text = corpus[i]
+text = corpus.sample(min_length=10, max_length=80, ruby=True)
+
+各サンプルの開始位置をuint64の配列としてインデックスファイル（{path}.idx.*）に保存し、
+本文とインデックスをメモリマップして読み出すため、ファイル全体をメモリに読み込まずに
+どのプロセスからでも定数時間でi番目のサンプルを取り出せる。
+Parquetの場合は、インデックスの作成時に列の値を1行1サンプルのテキスト（{path}.idx.txt）に書き出して同様に扱う。
+
+インデックスの作成時に、各サンプルのタグを除いた文字数とルビの有無も保存しておき、絞り込みに使う。
+元のファイルに追記された場合は、追記された部分だけを読み込んでインデックスを更新する。
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import random
+import numpy as np
+from utils import RubyMarkupError, parse_ruby
+
+FLAG_RUBY = 1  # ルビを含む
+FLAG_INVALID = 2  # ルビのタグが不正
+
+INDEX_VERSION = 1
+_CHUNK_SIZE = 16 * 1024 * 1024
+_TAIL_SIZE = 4096
+
+
+def _measure(text: str) -> tuple[int, int]:
+    """(タグを除いた文字数, フラグ)を返す"""
+    if "<" not in text:
+        return len(text), 0
+    try:
+        # コーパス全体でparse_rubyのキャッシュを埋めないよう、キャッシュを通さずに解析する
+        markup = parse_ruby.__wrapped__(text)
+    except RubyMarkupError:
+        return len(text), FLAG_INVALID
+    return len(markup.plain), FLAG_RUBY if markup.has_ruby else 0
+
+
+def _decode(data: bytes) -> str:
+    return data.decode("utf-8").rstrip("\r\n")
+
+
+def _empty_arrays() -> tuple[list, list, list]:
+    return (
+        [np.zeros(0, dtype=np.uint64)],
+        [np.zeros(0, dtype=np.uint32)],
+        [np.zeros(0, dtype=np.uint8)],
+    )
+
+
+def _tail_hash(path: str, end: int) -> str:
+    # 追記ではなく書き換えられた場合を検出するため、インデックス済みの範囲の末尾をハッシュ値で比較する
+    with open(path, "rb") as f:
+        f.seek(max(end - _TAIL_SIZE, 0))
+        return hashlib.sha1(f.read(min(end, _TAIL_SIZE))).hexdigest()
+
+
+class TextCorpus:
+    """
+    path: 1行1サンプルのUTF-8テキスト、またはParquetファイル
+    column: Parquetの場合に読み込む列名
+    index_path: インデックスファイルのパスの先頭部分（省略した場合は{path}.idx）
+    update: インデックスが古い場合に更新する（Falseの場合は既存のインデックスをそのまま使う）
+
+    プロセス間で受け渡すと、受け取った側でファイルをメモリマップし直す。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        column: str = None,
+        index_path: str = None,
+        update: bool = True,
+    ):
+        self.path = path
+        self.column = column
+        self.index_path = index_path if index_path is not None else f"{path}.idx"
+        if update or not os.path.exists(self._file("json")):
+            self.build()
+        self._open()
+
+    def _file(self, suffix: str) -> str:
+        return f"{self.index_path}.{suffix}"
+
+    @property
+    def text_path(self) -> str:
+        # メモリマップして読み出すテキスト
+        return self.path if self.column is None else self._file("txt")
+
+    def _open(self):
+        with open(self._file("json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(self._file("offsets.npy"), mmap_mode="r")
+        self.lengths = np.load(self._file("lengths.npy"), mmap_mode="r")
+        self.flags = np.load(self._file("flags.npy"), mmap_mode="r")
+        self._fp = open(self.text_path, "rb")
+        size = os.fstat(self._fp.fileno()).st_size
+        # 空のファイルはメモリマップできない
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._fp.close()
+
+    def __getstate__(self):
+        return {"path": self.path, "column": self.column, "index_path": self.index_path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(f"corpus index out of range: {i}")
+        return _decode(self._mm[int(self.offsets[i]) : int(self.offsets[i + 1])])
+
+    @property
+    def has_ruby(self) -> np.ndarray:
+        return (self.flags & FLAG_RUBY) != 0
+
+    def indices(
+        self,
+        min_length: int = None,
+        max_length: int = None,
+        ruby: bool = None,
+        valid_only: bool = True,
+    ) -> np.ndarray:
+        """
+        条件を満たすサンプルの番号を返す。文字数はタグとルビを除いた文字数。
+        ruby: Trueはルビを含むもの、Falseはルビを含まないもの、Noneは両方
+        valid_only: ルビのタグが不正なサンプルを除く
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if min_length is not None:
+            mask &= self.lengths >= min_length
+        if max_length is not None:
+            mask &= self.lengths <= max_length
+        if ruby is not None:
+            mask &= self.has_ruby == ruby
+        if valid_only:
+            mask &= (self.flags & FLAG_INVALID) == 0
+        return np.flatnonzero(mask)
+
+    def sample(self, rng: random.Random = None, **filters) -> str:
+        """条件（indicesと同じ引数）を満たすサンプルを1つ選ぶ。rngを省略した場合はグローバルなrandomを使う"""
+        rng = rng if rng is not None else random
+        if not filters:
+            return self[rng.randrange(len(self))]
+        candidates = self.indices(**filters)
+        if len(candidates) == 0:
+            raise ValueError(f"no samples match {filters}")
+        return self[int(candidates[rng.randrange(len(candidates))])]
+
+    def build(self):
+        """インデックスを作成する。作成済みの場合は、追記された部分だけを読み込んで更新する。"""
+        stat = os.stat(self.path)
+        meta = self._load_meta()
+        if meta is not None and meta["source_size"] == stat.st_size and meta[
+            "source_mtime_ns"
+        ] == stat.st_mtime_ns:
+            return
+
+        if self.column is None:
+            index_meta = self._build_text(meta, stat.st_size)
+        else:
+            index_meta = self._build_parquet(meta)
+
+        meta = {
+            "version": INDEX_VERSION,
+            "source": os.path.abspath(self.path),
+            "column": self.column,
+            "source_size": stat.st_size,
+            "source_mtime_ns": stat.st_mtime_ns,
+            **index_meta,
+        }
+        tmp = f"{self._file('json')}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self._file("json"))
+
+    def _load_meta(self) -> dict:
+        if not os.path.exists(self._file("json")):
+            return None
+        with open(self._file("json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION or meta.get("column") != self.column:
+            return None
+        return meta
+
+    def _load_arrays(self, n: int) -> tuple[list, list, list]:
+        # 作成済みのインデックスのうち、先頭n個のサンプルを引き継ぐ
+        offsets = np.load(self._file("offsets.npy"))[: n + 1]
+        lengths = np.load(self._file("lengths.npy"))[:n]
+        flags = np.load(self._file("flags.npy"))[:n]
+        return [offsets[:-1]], [lengths], [flags]
+
+    def _save_arrays(self, offsets: list, end: int, lengths: list, flags: list):
+        arrays = {
+            "offsets.npy": np.append(
+                np.concatenate(offsets).astype(np.uint64), np.uint64(end)
+            ),
+            "lengths.npy": np.concatenate(lengths).astype(np.uint32),
+            "flags.npy": np.concatenate(flags).astype(np.uint8),
+        }
+        for suffix, array in arrays.items():
+            tmp = f"{self._file(suffix)}.{os.getpid()}.tmp.npy"
+            np.save(tmp, array)
+            os.replace(tmp, self._file(suffix))
+
+    def _build_text(self, meta: dict, size: int) -> dict:
+        # 改行で終わる行までを確定した範囲とし、追記された場合はその後ろから読み込む
+        start, n = 0, 0
+        if (
+            meta is not None
+            and meta["complete_end"] <= size
+            and _tail_hash(self.path, meta["complete_end"]) == meta["tail_hash"]
+        ):
+            start, n = meta["complete_end"], meta["complete_lines"]
+
+        offsets, lengths, flags = _empty_arrays()
+        if n:
+            offsets, lengths, flags = self._load_arrays(n)
+
+        # 行ごとの値はチャンクごとの配列に書き込み、最後に連結する（行数が多くてもPythonのintのリストを作らない）
+        complete_lines = n
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            pos = start  # 読み込み済みの位置
+            line_start = start
+            pending = b""  # 改行で終わっていない行の読み込み済みの部分
+            while True:
+                chunk = f.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 0x0A)
+                if len(newlines):
+                    # 各行の開始位置は、直前の行の改行の次の位置
+                    chunk_offsets = np.empty(len(newlines), dtype=np.uint64)
+                    chunk_offsets[0] = line_start
+                    chunk_offsets[1:] = newlines[:-1] + (pos + 1)
+                    chunk_lengths = np.empty(len(newlines), dtype=np.uint32)
+                    chunk_flags = np.empty(len(newlines), dtype=np.uint8)
+                    prev = 0
+                    for j, nl in enumerate(newlines.tolist()):
+                        line = pending + chunk[prev:nl] if j == 0 else chunk[prev:nl]
+                        chunk_lengths[j], chunk_flags[j] = _measure(_decode(line))
+                        prev = nl + 1
+                    offsets.append(chunk_offsets)
+                    lengths.append(chunk_lengths)
+                    flags.append(chunk_flags)
+                    complete_lines += len(newlines)
+                    line_start = pos + prev
+                    pending = chunk[prev:]
+                else:
+                    pending += chunk
+                pos += len(chunk)
+
+        complete_end = line_start
+        if pending:
+            # 最後の行が改行で終わっていない場合も読み出せるようにする（次回の更新で読み直す）
+            length, flag = _measure(_decode(pending))
+            offsets.append(np.array([line_start], dtype=np.uint64))
+            lengths.append(np.array([length], dtype=np.uint32))
+            flags.append(np.array([flag], dtype=np.uint8))
+
+        self._save_arrays(offsets, pos, lengths, flags)
+        return {
+            "num_samples": complete_lines + (1 if pending else 0),
+            "complete_end": complete_end,
+            "complete_lines": complete_lines,
+            "tail_hash": _tail_hash(self.path, complete_end),
+        }
+
+    def _build_parquet(self, meta: dict) -> dict:
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(self.path)
+        text_path = self.text_path
+        n = 0
+        if (
+            meta is not None
+            and meta["num_samples"] <= parquet.metadata.num_rows
+            and os.path.exists(text_path)
+            and os.path.getsize(text_path) == meta["text_size"]
+        ):
+            # 行が追加された場合は、追加された行だけをテキストに書き足す
+            n = meta["num_samples"]
+
+        offsets, lengths, flags = _empty_arrays()
+        if n:
+            offsets, lengths, flags = self._load_arrays(n)
+
+        num_samples = n
+        with open(text_path, "ab" if n else "wb") as f:
+            pos = f.tell()
+            row = 0
+            for batch in parquet.iter_batches(columns=[self.column]):
+                values = batch.column(0).to_pylist()
+                if row + len(values) <= n:
+                    row += len(values)
+                    continue
+                skip = max(n - row, 0)
+                row += len(values)
+                values = values[skip:]
+                # バッチごとの配列に書き込む
+                batch_sizes = np.empty(len(values), dtype=np.uint64)
+                batch_lengths = np.empty(len(values), dtype=np.uint32)
+                batch_flags = np.empty(len(values), dtype=np.uint8)
+                for j, text in enumerate(values):
+                    text = "" if text is None else text
+                    batch_lengths[j], batch_flags[j] = _measure(text)
+                    data = text.encode("utf-8") + b"\n"
+                    f.write(data)
+                    batch_sizes[j] = len(data)
+                ends = np.cumsum(batch_sizes) + np.uint64(pos)
+                offsets.append(ends - batch_sizes)
+                lengths.append(batch_lengths)
+                flags.append(batch_flags)
+                num_samples += len(values)
+                if len(values):
+                    pos = int(ends[-1])
+
+        self._save_arrays(offsets, pos, lengths, flags)
+        return {
+            "num_samples": num_samples,
+            "text_size": pos,
+        }
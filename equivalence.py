@@ -0,0 +1,229 @@
+"""
+2つの描画バックエンドの出力が同じになるかを確認する
+
+python equivalence.py                          # reference（1文字ずつ描画する元の実装）とpillowを比較
+python equivalence.py --samples 500 --verbose
+
+texts/のテキストから固定したシードでテキストボックスの設定を作り、同じ背景画像に2つのバックエンドで描画して比較する。
+ルビ、フォントにない文字（フォールバック）、中央揃え、はみ出し（ボックスに入りきらないテキスト）の場合を含む。
+フォールバックのケースは、--fallback-font（省略した場合は--fontと同じディレクトリにある別のフォント）が
+--fontと異なる場合だけ実行する。
+サンプルごとに画素の差の最大値と差のある画素数、描画済みのテキスト（rendered_text）の違いを出力し、
+最後にケースごとの件数とバックエンドの処理速度の比を出力する。
+1つでも一致しないサンプルがあれば終了コード1で終了する。
+"""
+
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+import numpy as np
+from PIL import Image
+from bench_fixtures import BG_PATH, get_texts
+from configs import DEFAULT_FONT_PATH, Point, TextBoxCFG
+from font_utils import char_in_font, get_font
+from generation_utils import get_random_color_pair
+from render_backends import available_backends, get_backend
+from utils import remove_ruby_tags
+
+CASES = ("plain", "ruby", "fallback", "centering", "truncation")
+
+# フォールバックのケースでテキストに混ぜる文字（記号や絵文字などフォントにないことが多いもの）
+FALLBACK_CHARS = "♪♡☆★①②※〜…―‼⁉♨☺✿😀🎵"
+
+
+def _insert_fallback_chars(text: str, rng: random.Random) -> str:
+    # タグの途中に入れないよう、ルビを除いたテキストに混ぜる
+    chars = list(remove_ruby_tags(text))
+    for _ in range(rng.randint(1, 4)):
+        chars.insert(rng.randint(0, len(chars)), rng.choice(FALLBACK_CHARS))
+    return "".join(chars)
+
+
+def make_case(
+    case: str, rng: random.Random, font_path: str, fallback_font_path: str
+) -> TextBoxCFG:
+    """caseの種類のテキストボックスの設定を1つ作る"""
+    font_hex, bg_hex = get_random_color_pair(rng=rng)
+    if case == "truncation":
+        text = rng.choice(get_texts("long"))
+        width, height = rng.randint(300, 900), rng.randint(80, 200)
+    elif case == "centering":
+        text = remove_ruby_tags(rng.choice(get_texts("sentence")))
+        width, height = rng.randint(900, 1500), rng.randint(90, 160)
+    else:
+        text = rng.choice(get_texts("message"))
+        width, height = rng.randint(1200, 1800), rng.randint(250, 350)
+
+    if case == "plain":
+        text = remove_ruby_tags(text)
+    elif case == "fallback":
+        text = _insert_fallback_chars(text, rng)
+
+    x, y = rng.randint(0, 1920 - width), rng.randint(0, 1080 - height)
+    cfg = TextBoxCFG(
+        text=text,
+        tl=Point(x, y),
+        br=Point(x + width, y + height),
+        font_hex=font_hex,
+        bg_hex=bg_hex,
+        bg_alpha=rng.randint(100, 255),
+        line_spacing=rng.randint(0, 20),
+        character_spacing=rng.randint(0, 6),
+        centering=case == "centering",
+        _font=get_font(font_path, 50),
+        fallback_font=get_font(fallback_font_path, 50),
+        _ruby_font=get_font(font_path, 20),
+        fallback_ruby_font=get_font(fallback_font_path, 20),
+    )
+    cfg.change_font_size(rng.randint(24, 48))
+    cfg.change_ruby_font_size(rng.randint(10, 20))
+    return cfg
+
+
+def find_fallback_font(font_path: str) -> str:
+    """font_pathと同じディレクトリにある別のフォントを返す。ない場合はNone"""
+    same = os.path.realpath(font_path)
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(font_path), "*.[to]tf"))):
+        if os.path.realpath(path) != same:
+            return path
+    return None
+
+
+def build_corpus(
+    samples: int,
+    seed: int,
+    font_path: str,
+    fallback_font_path: str,
+    cases: tuple[str, ...] = CASES,
+) -> list[tuple[str, TextBoxCFG]]:
+    rng = random.Random(seed)
+    return [
+        (case, make_case(case, rng, font_path, fallback_font_path))
+        for case in (cases[i % len(cases)] for i in range(samples))
+    ]
+
+
+def render(backend, base: Image.Image, cfg: TextBoxCFG) -> tuple:
+    """(画像, 描画済みのテキスト, 例外)と処理時間[秒]を返す。ルビのはみ出しなどの例外も結果として比較する。"""
+    start = time.perf_counter()
+    img, rendered_text, error = None, None, None
+    try:
+        target = base.copy()
+        rendered_text = backend.draw_textbox(target, cfg)
+        img = target
+    except ValueError as e:
+        error = f"{type(e).__name__}: {e}"
+    return (img, rendered_text, error), time.perf_counter() - start
+
+
+def compare(a: tuple, b: tuple) -> dict:
+    img_a, text_a, error_a = a
+    img_b, text_b, error_b = b
+    result = {
+        "max_diff": 0,
+        "n_diff": 0,
+        "text_match": text_a == text_b,
+        "error_match": error_a == error_b,
+    }
+    if img_a is not None and img_b is not None:
+        diff = np.abs(
+            np.asarray(img_a, dtype=np.int16) - np.asarray(img_b, dtype=np.int16)
+        )
+        result["max_diff"] = int(diff.max())
+        result["n_diff"] = int(np.count_nonzero(diff.max(axis=-1)))
+    result["ok"] = (
+        result["max_diff"] == 0 and result["text_match"] and result["error_match"]
+    )
+    return result
+
+
+def run(args) -> bool:
+    backend_a, backend_b = get_backend(args.a), get_backend(args.b)
+    font_path = args.font
+    fallback_font_path = args.fallback_font or find_fallback_font(font_path)
+    cases = CASES
+    if fallback_font_path is None or os.path.realpath(
+        fallback_font_path
+    ) == os.path.realpath(font_path):
+        # 同じフォントにフォールバックしてもフォールバックの描画は確認できないため、ケースから除く
+        print(
+            "skipping the fallback case: no fallback font different from --font "
+            "(pass --fallback-font)"
+        )
+        fallback_font_path = font_path
+        cases = tuple(case for case in CASES if case != "fallback")
+    corpus = build_corpus(args.samples, args.seed, font_path, fallback_font_path, cases)
+    base = Image.open(BG_PATH).convert("RGB").resize((1920, 1080))
+
+    times = {args.a: 0.0, args.b: 0.0}
+    counts = {case: [0, 0] for case in cases}  # [サンプル数, 一致しなかった数]
+    n_fallback = 0
+    for i, (case, cfg) in enumerate(corpus):
+        out_a, seconds_a = render(backend_a, base, cfg)
+        out_b, seconds_b = render(backend_b, base, cfg)
+        times[args.a] += seconds_a
+        times[args.b] += seconds_b
+        if any(not char_in_font(cfg.font, c) for c in cfg.text):
+            n_fallback += 1
+
+        result = compare(out_a, out_b)
+        counts[case][0] += 1
+        if not result["ok"]:
+            counts[case][1] += 1
+        if args.verbose or not result["ok"]:
+            print(
+                f"{i:5d} {case:10s} max_diff {result['max_diff']:3d} "
+                f"n_diff {result['n_diff']:7d} "
+                f"text {'ok' if result['text_match'] else 'MISMATCH'} "
+                f"error {'ok' if result['error_match'] else 'MISMATCH'}"
+            )
+            if not result["text_match"]:
+                print(f"      {args.a}: {out_a[1]!r}\n      {args.b}: {out_b[1]!r}")
+            if not result["error_match"]:
+                print(f"      {args.a}: {out_a[2]}\n      {args.b}: {out_b[2]}")
+
+    n_bad = sum(bad for _, bad in counts.values())
+    print(f"\n{args.a} vs {args.b}: {len(corpus)} samples, {n_bad} mismatched")
+    for case, (n, bad) in counts.items():
+        print(f"  {case:10s} {n:5d} samples  {bad:5d} mismatched")
+    print(f"  samples using fallback glyphs: {n_fallback}")
+    for name, seconds in times.items():
+        print(f"  {name:10s} {len(corpus) / seconds:10.1f} samples/s")
+    print(f"  {args.b} is {times[args.a] / times[args.b]:.2f}x {args.a}")
+    return n_bad == 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--a", type=str, default="reference", choices=available_backends()
+    )
+    parser.add_argument("--b", type=str, default="pillow", choices=available_backends())
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--font", type=str, default=DEFAULT_FONT_PATH)
+    parser.add_argument(
+        "--fallback-font",
+        type=str,
+        default=None,
+        help="font for characters missing from --font "
+        "(default: another font in the directory of --font; "
+        "the fallback case is skipped if there is none)",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="print every sample, not only mismatches"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not run(args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
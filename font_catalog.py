@@ -0,0 +1,294 @@
+"""
+フォントディレクトリの全フォントのカバレッジとメトリクスをまとめたカタログ
+
+catalog = FontCatalog("./fonts")
+i = catalog.sample("描画するテキスト")     # テキストの全ての文字を描画できるフォントを1つ選ぶ
+font = catalog.get_font(i, 50)
+
+ディレクトリ以下の.ttf/.otf/.ttc/.otcをフェイスごとに1回だけTTFontで読み込み、
+描画できる文字（get_coverageと同じく、cmapに含まれ輪郭を持つ文字）とアセンダー、ディセンダーを
+インデックスファイル（{font_dir}.catalog.*）に保存する。
+カバレッジは(文字, フォント)のビット行列として保存してメモリマップするため、
+フォントを読み込まずに、テキストを描画できるフォントを1回の行列演算で絞り込める。
+フォントファイルが追加、更新（mtimeかサイズが変わったもの）、削除された場合は、その分だけ読み込み直す。
+"""
+
+import json
+import os
+import random
+from dataclasses import dataclass
+import numpy as np
+from PIL import ImageFont
+from font_utils import GlyphCoverage, get_font, load_ttfont
+
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc", ".otc")
+
+CATALOG_VERSION = 1
+
+
+@dataclass
+class FontEntry:
+    path: str
+    index: int  # フェイス番号
+    family: str
+    style: str
+    units_per_em: int
+    ascent: int  # hheaのアセンダー（フォント単位）
+    descent: int  # hheaのディセンダー（フォント単位、負の値）
+    n_codepoints: int  # cmapに含まれる文字数
+    n_empty: int  # cmapには含まれるが輪郭を持たない文字数（スペースなど）
+
+    @property
+    def has_empty(self) -> bool:
+        return self.n_empty > 0
+
+    def metrics(self, size: int) -> tuple[float, float]:
+        """フォントサイズsizeでの(アセンダー, ディセンダー)[px]"""
+        return (
+            self.ascent * size / self.units_per_em,
+            self.descent * size / self.units_per_em,
+        )
+
+
+def _num_faces(path: str) -> int:
+    # フォントコレクションはヘッダーにフェイス数を持つ
+    with open(path, "rb") as f:
+        header = f.read(12)
+    if header[:4] != b"ttcf":
+        return 1
+    return int.from_bytes(header[8:12], "big")
+
+
+def _scan(font_dir: str) -> list[str]:
+    paths = []
+    for root, dirs, files in os.walk(font_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(FONT_EXTENSIONS):
+                paths.append(os.path.relpath(os.path.join(root, name), font_dir))
+    return paths
+
+
+def _read_face(path: str, index: int) -> tuple[dict, GlyphCoverage]:
+    """フェイスのメタデータとカバレッジを返す。TTFontで読み込めない場合は(None, None)"""
+    # カタログの作成中に読み込んだフォントでload_ttfontのキャッシュを埋めないよう、キャッシュを通さずに読み込む
+    ttfont = load_ttfont.__wrapped__(path, index)
+    if ttfont is None:
+        return None, None
+    try:
+        coverage = GlyphCoverage.from_ttfont(ttfont)
+        name = ttfont["name"]
+        info = {
+            "family": str(name.getBestFamilyName() or ""),
+            "style": str(name.getBestSubFamilyName() or ""),
+            "units_per_em": int(ttfont["head"].unitsPerEm),
+            "ascent": int(ttfont["hhea"].ascent),
+            "descent": int(ttfont["hhea"].descent),
+            "n_codepoints": len(coverage.codepoints),
+            "n_empty": len(coverage.empty),
+        }
+    except Exception:
+        return None, None
+    finally:
+        ttfont.close()
+    return info, coverage
+
+
+class FontCatalog:
+    """
+    font_dir: フォントを探すディレクトリ（サブディレクトリも含む）
+    index_path: インデックスファイルのパスの先頭部分（省略した場合は{font_dir}.catalog）
+    update: フォントが追加、更新、削除されている場合にインデックスを更新する
+        （Falseの場合は既存のインデックスをそのまま使う）
+
+    TTFontで読み込めないフォントはカタログに含めない。
+    プロセス間で受け渡すと、受け取った側でインデックスをメモリマップし直す。
+    """
+
+    def __init__(self, font_dir: str, index_path: str = None, update: bool = True):
+        self.font_dir = font_dir
+        self.index_path = (
+            index_path
+            if index_path is not None
+            else f"{os.path.normpath(font_dir)}.catalog"
+        )
+        if update or not os.path.exists(self._file("json")):
+            self.build()
+        self._open()
+
+    def _file(self, suffix: str) -> str:
+        return f"{self.index_path}.{suffix}"
+
+    def _open(self):
+        with open(self._file("json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.entries = [
+            FontEntry(
+                path=os.path.join(self.font_dir, face["path"]),
+                **{k: v for k, v in face.items() if k not in ("path", "mtime_ns", "size")},
+            )
+            for face in self.meta["faces"]
+        ]
+        # 行: カタログ内のいずれかのフォントのcmapに含まれる文字（昇順）、列: フォント（ビットをパック）
+        # drawableは輪郭を持つ文字、emptyは輪郭を持たない文字
+        self.codepoints = np.load(self._file("codepoints.npy"), mmap_mode="r")
+        self.drawable = np.load(self._file("drawable.npy"), mmap_mode="r")
+        self.empty = np.load(self._file("empty.npy"), mmap_mode="r")
+
+    def __getstate__(self):
+        return {"font_dir": self.font_dir, "index_path": self.index_path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i: int) -> FontEntry:
+        return self.entries[i]
+
+    def get_font(self, i: int, size: int) -> ImageFont.FreeTypeFont:
+        entry = self.entries[i]
+        return get_font(entry.path, size, entry.index)
+
+    def coverage(self, i: int) -> GlyphCoverage:
+        """i番目のフォントのカバレッジ（get_coverageと同じもの）をインデックスから復元する"""
+        byte, bit = divmod(i, 8)
+        mask = np.uint8(0x80 >> bit)
+        cmap = (self.drawable[:, byte] | self.empty[:, byte]) & mask
+        return GlyphCoverage(
+            frozenset(self.codepoints[cmap != 0].tolist()),
+            frozenset(self.codepoints[(self.empty[:, byte] & mask) != 0].tolist()),
+        )
+
+    def covering(self, text: str) -> np.ndarray:
+        """
+        textの全ての文字を描画できるフォントの番号を返す。
+        スペースや改行のような空白文字はどのフォントでも描画されないため無視する。
+        ルビのタグは文字として扱うため、parse_ruby(text).plainなどタグを除いたテキストを渡すこと。
+        """
+        chars = {c for c in text if not c.isspace()}
+        if not chars:
+            return np.arange(len(self))
+        cps = np.frombuffer("".join(chars).encode("utf-32-le"), dtype=np.uint32)
+        rows = np.searchsorted(self.codepoints, cps)
+        rows = np.minimum(rows, len(self.codepoints) - 1)
+        if len(self.codepoints) == 0 or not (self.codepoints[rows] == cps).all():
+            # どのフォントのcmapにもない文字を含む
+            return np.zeros(0, dtype=np.int64)
+        bits = np.bitwise_and.reduce(self.drawable[rows], axis=0)
+        return np.flatnonzero(np.unpackbits(bits, count=len(self)))
+
+    def sample(self, text: str = "", rng: random.Random = None) -> int:
+        """
+        textの全ての文字を描画できるフォントを1つ選び、その番号を返す。該当するフォントがない場合はNone。
+        rngを省略した場合はグローバルなrandomを使う。
+        """
+        rng = rng if rng is not None else random
+        candidates = self.covering(text)
+        if len(candidates) == 0:
+            return None
+        return int(candidates[rng.randrange(len(candidates))])
+
+    def build(self):
+        """インデックスを作成する。作成済みの場合は、追加、更新されたフォントだけを読み込む。"""
+        files = []
+        for rel in _scan(self.font_dir):
+            stat = os.stat(os.path.join(self.font_dir, rel))
+            files.append([rel, stat.st_mtime_ns, stat.st_size])
+        old = self._load_previous()
+        if old is not None and self.meta["files"] == files:
+            return
+
+        faces, coverages = [], []
+        for rel, mtime_ns, size in files:
+            path = os.path.join(self.font_dir, rel)
+            reused = (old or {}).get((rel, mtime_ns, size))
+            if reused is not None:
+                for face, i in reused:
+                    faces.append(face)
+                    coverages.append(self.coverage(i))
+                continue
+
+            try:
+                n_faces = _num_faces(path)
+            except OSError:
+                continue
+            for index in range(n_faces):
+                info, coverage = _read_face(path, index)
+                if info is None:
+                    continue
+                faces.append(
+                    {
+                        "path": rel,
+                        "index": index,
+                        "mtime_ns": mtime_ns,
+                        "size": size,
+                        **info,
+                    }
+                )
+                coverages.append(coverage)
+
+        self._save(files, faces, coverages)
+
+    def _load_previous(self) -> dict:
+        # (相対パス, mtime, サイズ)ごとに、作成済みのインデックスのフェイスと番号を返す
+        if not os.path.exists(self._file("json")):
+            return None
+        with open(self._file("json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != CATALOG_VERSION:
+            return None
+        self.meta = meta
+        self.codepoints = np.load(self._file("codepoints.npy"))
+        self.drawable = np.load(self._file("drawable.npy"))
+        self.empty = np.load(self._file("empty.npy"))
+        previous = {}
+        for i, face in enumerate(meta["faces"]):
+            key = (face["path"], face["mtime_ns"], face["size"])
+            previous.setdefault(key, []).append((face, i))
+        return previous
+
+    def _save(self, files: list, faces: list[dict], coverages: list[GlyphCoverage]):
+        codepoints = set()
+        for coverage in coverages:
+            codepoints |= coverage.codepoints
+        codepoints = np.array(sorted(codepoints), dtype=np.uint32)
+
+        n_bytes = (len(faces) + 7) // 8
+        drawable = np.zeros((len(codepoints), n_bytes), dtype=np.uint8)
+        empty = np.zeros((len(codepoints), n_bytes), dtype=np.uint8)
+        for i, coverage in enumerate(coverages):
+            byte, bit = divmod(i, 8)
+            mask = np.uint8(0x80 >> bit)
+            for matrix, cps in (
+                (drawable, coverage.codepoints - coverage.empty),
+                (empty, coverage.empty),
+            ):
+                if cps:
+                    rows = np.searchsorted(
+                        codepoints, np.fromiter(cps, dtype=np.uint32, count=len(cps))
+                    )
+                    matrix[rows, byte] |= mask
+
+        arrays = {
+            "codepoints.npy": codepoints,
+            "drawable.npy": drawable,
+            "empty.npy": empty,
+        }
+        for suffix, array in arrays.items():
+            tmp = f"{self._file(suffix)}.{os.getpid()}.tmp.npy"
+            np.save(tmp, array)
+            os.replace(tmp, self._file(suffix))
+
+        meta = {
+            "version": CATALOG_VERSION,
+            "font_dir": os.path.abspath(self.font_dir),
+            "files": files,
+            "faces": faces,
+        }
+        tmp = f"{self._file('json')}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self._file("json"))
@@ -0,0 +1,307 @@
+import functools
+import hashlib
+import os
+from collections import OrderedDict
+from PIL import ImageFont
+
+# Unicodeの全コードポイント数（ビットセットの長さ）
+N_CODEPOINTS = 0x110000
+
+# カバレッジインデックスの保存先（未設定の場合はディスクに保存しない）
+COVERAGE_CACHE_DIR: str = os.environ.get("VNVDU_CACHE_DIR")
+
+
+class FontPool:
+    """
+    (パス, サイズ, フェイス番号)ごとにFreeTypeFontを共有するプロセス共通のプール。
+    FreeTypeFontは描画時に状態を変更しないため、複数のTextBoxCFGで同じインスタンスを使い回せる。
+    maxsizeを超えた場合は最も長く使われていないフォントを破棄する。
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._fonts = OrderedDict()
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def get(self, path: str, size: int, index: int = 0) -> ImageFont.FreeTypeFont:
+        key = (path, int(size), index)
+        font = self._fonts.get(key)
+        if font is not None:
+            self._fonts.move_to_end(key)
+            self.hits += 1
+            return font
+
+        # ファイルを開くのはここだけ
+        font = ImageFont.truetype(font=path, size=int(size), index=index)
+        self.loads += 1
+        self._fonts[key] = font
+        while len(self._fonts) > self.maxsize:
+            self._fonts.popitem(last=False)
+            self.evictions += 1
+        return font
+
+    def clear(self):
+        self._fonts.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._fonts),
+            "maxsize": self.maxsize,
+            "loads": self.loads,
+            "hits": self.hits,
+            "evictions": self.evictions,
+        }
+
+    def reset_stats(self):
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+
+
+font_pool = FontPool()
+
+
+def get_font(path: str, size: int, index: int = 0) -> ImageFont.FreeTypeFont:
+    return font_pool.get(path, size, index)
+
+
+class AdvanceTable:
+    """
+    (フォント, サイズ)ごとの文字の送り幅テーブル。
+    送り幅はfont.getlengthで文字ごとに1回だけ計測し、BMPの文字は密なfloat32配列、
+    それ以外の文字は辞書に保持する。getlengthはヒンティング済みの送り幅を1/64px単位で返すため、
+    float32でも値は正確に保持される。
+    """
+
+    def __init__(self, font: ImageFont.FreeTypeFont):
+        # numpyの読み込みは遅いため、configsなどを読み込む時点ではなく最初にテーブルを作る時点まで遅らせる
+        import numpy as np
+
+        self.font = font
+        self.bmp = np.full(0x10000, np.nan, dtype=np.float32)
+        self.astral = {}
+        self.measured = 0
+
+    def codepoints(self, text: str) -> "np.ndarray":
+        import numpy as np
+
+        return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+
+    def widths(self, text: str) -> "np.ndarray":
+        """textの各文字の送り幅をfloat64の配列で返す。"""
+        import numpy as np
+
+        cps = self.codepoints(text)
+        if len(cps) == 0:
+            return np.zeros(0, dtype=np.float64)
+        if cps.max() >= 0x10000:
+            return np.array([self.width(c) for c in text], dtype=np.float64)
+
+        widths = self.bmp[cps]
+        unknown = np.isnan(widths)
+        if unknown.any():
+            for cp in np.unique(cps[unknown]).tolist():
+                self.bmp[cp] = self.font.getlength(chr(cp))
+                self.measured += 1
+            widths = self.bmp[cps]
+        return widths.astype(np.float64)
+
+    def width(self, char: str) -> float:
+        cp = ord(char)
+        if cp < 0x10000:
+            w = self.bmp[cp]
+            if w != w:  # NaN
+                w = self.bmp[cp] = self.font.getlength(char)
+                self.measured += 1
+            return float(w)
+        if char not in self.astral:
+            self.astral[char] = self.font.getlength(char)
+            self.measured += 1
+        return self.astral[char]
+
+
+_advance_tables = OrderedDict()
+ADVANCE_TABLE_MAXSIZE = 256
+
+
+def get_advance_table(font: ImageFont.FreeTypeFont) -> AdvanceTable:
+    key = (font.path, font.size, font.index, font.layout_engine)
+    table = _advance_tables.get(key)
+    if table is None:
+        table = _advance_tables[key] = AdvanceTable(font)
+        while len(_advance_tables) > ADVANCE_TABLE_MAXSIZE:
+            _advance_tables.popitem(last=False)
+    else:
+        _advance_tables.move_to_end(key)
+    return table
+
+
+@functools.lru_cache(maxsize=50)
+def load_ttfont(path, index: int = 0):
+    # fontToolsの読み込みは遅いため、カバレッジを調べる時点まで遅らせる
+    from fontTools.ttLib import TTFont
+
+    try:
+        return TTFont(path, fontNumber=index, lazy=True)
+    except Exception:
+        return None
+
+
+class GlyphCoverage:
+    """
+    フォントが描画できる文字の集合。
+
+    codepoints: すべてのUnicode cmapサブテーブルに含まれる文字
+    empty: cmapには含まれるが、輪郭を持たず何も描画されない文字（スペースなど）
+    フォールバックフォントを使うかどうかは、codepointsに含まれかつemptyに含まれないかで判定する。
+    """
+
+    def __init__(self, codepoints: frozenset, empty: frozenset):
+        self.codepoints = frozenset(codepoints)
+        self.empty = frozenset(empty) & self.codepoints
+        self._drawable = frozenset(chr(cp) for cp in self.codepoints - self.empty)
+
+    def has_char(self, char: str) -> bool:
+        return char in self._drawable
+
+    __contains__ = has_char
+
+    def covers(self, text: str) -> bool:
+        return self._drawable.issuperset(text)
+
+    def missing(self, text: str) -> set:
+        return set(text) - self._drawable
+
+    def __len__(self):
+        return len(self._drawable)
+
+    @staticmethod
+    def _to_bits(codepoints) -> "np.ndarray":
+        import numpy as np
+
+        bits = np.zeros(N_CODEPOINTS, dtype=bool)
+        bits[np.fromiter(codepoints, dtype=np.int64, count=len(codepoints))] = True
+        return np.packbits(bits)
+
+    @staticmethod
+    def _from_bits(packed: "np.ndarray") -> frozenset:
+        import numpy as np
+
+        bits = np.unpackbits(packed, count=N_CODEPOINTS)
+        return frozenset(np.flatnonzero(bits).tolist())
+
+    def save(self, path: str):
+        # ビットセットとして保存する（1フォントあたり非圧縮で約140KB）
+        import numpy as np
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                codepoints=self._to_bits(self.codepoints),
+                empty=self._to_bits(self.empty),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "GlyphCoverage":
+        import numpy as np
+
+        with np.load(path) as data:
+            return cls(
+                cls._from_bits(data["codepoints"]), cls._from_bits(data["empty"])
+            )
+
+    @classmethod
+    def from_ttfont(cls, ttfont: "TTFont") -> "GlyphCoverage":
+        # 最初のサブテーブルだけでなく、すべてのUnicodeサブテーブルを確認する
+        # 同じ文字が複数のテーブルにある場合はgetBestCmapの対応を優先する
+        cmap = {}
+        for table in ttfont["cmap"].tables:
+            if table.isUnicode():
+                cmap.update(table.cmap)
+        cmap.update(ttfont.getBestCmap() or {})
+
+        empty_names = _empty_glyph_names(ttfont)
+        empty = {cp for cp, name in cmap.items() if name in empty_names}
+        return cls(frozenset(cmap.keys()), frozenset(empty))
+
+
+def _empty_glyph_names(ttfont: "TTFont") -> set:
+    # 輪郭を持たないグリフ名を返す
+    # getmask(char).size[1] == 0 となる文字をフォントごとに1回だけ調べるのと同等
+    if "glyf" in ttfont:
+        glyf = ttfont["glyf"]
+        return {name for name in glyf.keys() if glyf[name].numberOfContours == 0}
+
+    from fontTools.pens.boundsPen import BoundsPen
+
+    glyphset = ttfont.getGlyphSet()
+    empty = set()
+    for name in glyphset.keys():
+        pen = BoundsPen(glyphset)
+        glyphset[name].draw(pen)
+        if pen.bounds is None:
+            empty.add(name)
+    return empty
+
+
+def _coverage_cache_path(cache_dir: str, path: str, index: int) -> str:
+    # ファイルの更新を検知できるよう、パスとmtime、サイズをキーにする
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{index}:{stat.st_mtime_ns}:{stat.st_size}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, "coverage", f"{name}-{digest}.npz")
+
+
+# 1フォントあたりCJKフォントでは数MBになるため、プロセス内で保持するフォント数を制限する
+COVERAGE_MAXSIZE = 50
+
+
+@functools.lru_cache(maxsize=COVERAGE_MAXSIZE)
+def get_coverage(path: str, index: int = 0, cache_dir: str = None) -> GlyphCoverage:
+    """
+    フォントファイルのカバレッジインデックスを返す。
+    プロセス内では直近に使ったCOVERAGE_MAXSIZE個のフォントの結果を保持し、cache_dir（省略時はCOVERAGE_CACHE_DIR）が
+    設定されている場合はディスクに保存して、他のワーカープロセスから再利用する。
+    TTFontで読み込めないフォントの場合はNoneを返す。
+    """
+    cache_dir = cache_dir or COVERAGE_CACHE_DIR
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = _coverage_cache_path(cache_dir, path, index)
+        if os.path.exists(cache_path):
+            return GlyphCoverage.load(cache_path)
+
+    ttfont = load_ttfont(path, index)
+    if ttfont is None:
+        return None
+    coverage = GlyphCoverage.from_ttfont(ttfont)
+
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        coverage.save(cache_path)
+    return coverage
+
+
+def ttfont_has_glyph(path, glyph, index: int = 0) -> bool:
+    # 文字がフォントのcmapに含まれるかを返す（TTFontで読み込めないフォントの場合はTrue）
+    coverage = get_coverage(path, index)
+    if coverage is None:
+        return True
+    return ord(glyph) in coverage.codepoints
+
+
+def char_in_font(font, char):
+    # 文字がcmapに含まれていても、代替文字を設定していない場合なにもレンダリングされない場合がある
+    # スペースなどの一部の文字もなにもレンダリングされないが、それらをフォールバックフォントで描画しても問題ないため、
+    # cmapにない文字と輪郭のない文字は一律フォールバックフォントを使うことにする
+    # 判定はフォントごとに1回だけ構築するカバレッジインデックスで行う
+    coverage = get_coverage(font.path, font.index)
+    if coverage is None:
+        # TTFontで読み込めないフォントは実際にレンダリングして確認する
+        return font.getmask(char).size[1] != 0
+    return coverage.has_char(char)
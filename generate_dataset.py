@@ -0,0 +1,299 @@
+"""
+学習データをシャードに分けてオフラインで生成するCLI
+
+python generate_dataset.py --factory my_configs:make_cfg --output ./dataset -n 100000
+
+--factoryには引数なしでCFG1を返す関数を「モジュール名:関数名」の形式で指定する。
+シャードk（0始まり）にはk*shard_size番目から(k+1)*shard_size-1番目までのサンプルが入り、
+各サンプルはstreaming.generate_sampleと同様に(seed, サンプル番号)だけから生成される。
+シャードの書き込みが終わるとマニフェスト（shard-XXXXXX.json）を書き出すため、
+途中で止まった場合も同じコマンドを再実行すればマニフェストのないシャードから再開できる。
+-nを増やして再実行した場合など、マニフェストのサンプルの範囲が現在の引数と異なるシャードは書き直す。
+seed、factory、shard-size、format、image-formatが異なる出力先に書き込もうとした場合はエラーにする。
+--shardsで担当するシャード（'3'）またはシャードの範囲（'0:10'）を指定すれば、複数のマシンで分担して生成できる。
+
+出力形式
+tar: WebDataset形式。サンプルごとに{key}.{png,jpg,webp}, {key}.gt.json, {key}.gt_ruby.json
+parquet: key, index, image, gt_parse, gt_parse_ruby列（datasetsライブラリでそのまま読み込める）
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import importlib
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+from streaming import generate_sample
+
+IMAGE_FORMATS = {"png": "PNG", "jpg": "JPEG", "webp": "WEBP"}
+
+
+def load_factory(spec: str):
+    module_name, _, func_name = spec.partition(":")
+    if not func_name:
+        raise ValueError(f"--factory must be 'module:function', got {spec!r}")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def module_root(spec: str) -> str:
+    """--factoryのモジュールを読み込んだsys.pathのディレクトリを返す（読み込み済みであること）"""
+    module_name = spec.partition(":")[0]
+    path = os.path.abspath(sys.modules[module_name].__file__)
+    if os.path.basename(path) == "__init__.py":
+        path = os.path.dirname(path)
+    for _ in range(module_name.count(".") + 1):
+        path = os.path.dirname(path)
+    return path
+
+
+def encode_image(img, image_format: str, quality: int) -> bytes:
+    buf = io.BytesIO()
+    if image_format == "png":
+        img.save(buf, format="PNG")
+    else:
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(buf, format=IMAGE_FORMATS[image_format], quality=quality)
+    return buf.getvalue()
+
+
+_worker_args = None
+
+
+def _init_worker(factory_spec, factory_root, seed, max_retries, image_format, quality):
+    global _worker_args
+    # spawnやforkserverで起動したワーカーは親プロセスで追加したsys.pathを引き継がないことがある
+    if factory_root not in sys.path:
+        sys.path.insert(0, factory_root)
+    _worker_args = (load_factory(factory_spec), seed, max_retries, image_format, quality)
+
+
+def _generate_and_encode(index: int) -> dict:
+    # 生成と画像のエンコードはワーカープロセスで行い、エンコード済みのバイト列だけを返す
+    cfg_factory, seed, max_retries, image_format, quality = _worker_args
+    output = generate_sample(cfg_factory, seed, index, max_retries)
+    return {
+        "index": index,
+        "image": encode_image(output.image, image_format, quality),
+        "gt_parse": json.dumps(output.to_gt_parse(), ensure_ascii=False),
+        "gt_parse_ruby": json.dumps(output.to_gt_parse_ruby(), ensure_ascii=False),
+    }
+
+
+def shard_name(shard: int) -> str:
+    return f"shard-{shard:06d}"
+
+
+def shard_range(args, shard: int) -> range:
+    return range(
+        shard * args.shard_size,
+        min((shard + 1) * args.shard_size, args.num_samples),
+    )
+
+
+def write_tar(path: str, samples: list[dict], image_format: str):
+    def add(tar, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+
+    with tarfile.open(path, "w") as tar:
+        for sample in samples:
+            key = f"{sample['index']:09d}"
+            add(tar, f"{key}.{image_format}", sample["image"])
+            add(tar, f"{key}.gt.json", sample["gt_parse"].encode("utf-8"))
+            add(tar, f"{key}.gt_ruby.json", sample["gt_parse_ruby"].encode("utf-8"))
+
+
+def write_parquet(path: str, samples: list[dict], image_format: str):
+    # pyarrowはdatasetsの依存ライブラリとしてインストールされる
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.table(
+        {
+            "key": [f"{s['index']:09d}" for s in samples],
+            "index": pa.array([s["index"] for s in samples], type=pa.int64()),
+            "image": pa.array([s["image"] for s in samples], type=pa.binary()),
+            "gt_parse": [s["gt_parse"] for s in samples],
+            "gt_parse_ruby": [s["gt_parse_ruby"] for s in samples],
+        }
+    )
+    pq.write_table(table, path)
+
+
+WRITERS = {"tar": write_tar, "parquet": write_parquet}
+
+
+def write_shard(args, shard: int, samples: list[dict]) -> dict:
+    name = shard_name(shard)
+    path = os.path.join(args.output, f"{name}.{args.format}")
+    tmp_path = f"{path}.tmp"
+    WRITERS[args.format](tmp_path, samples, args.image_format)
+    os.replace(tmp_path, path)
+
+    manifest = {
+        "shard": shard,
+        "file": os.path.basename(path),
+        "format": args.format,
+        "image_format": args.image_format,
+        "factory": args.factory,
+        "seed": args.seed,
+        "shard_size": args.shard_size,
+        "start": samples[0]["index"],
+        "end": samples[-1]["index"] + 1,
+        "num_samples": len(samples),
+        "max_retries": args.max_retries,
+        "bytes": os.path.getsize(path),
+    }
+    # マニフェストはシャードの書き込みが完了してから書き出す（マニフェストがあるシャードは完成している）
+    manifest_path = os.path.join(args.output, f"{name}.json")
+    with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    return manifest
+
+
+def is_complete(args, shard: int) -> bool:
+    """
+    シャードが現在の引数で書き込み済みかを返す。サンプルの範囲だけが異なる場合はFalse（書き直す）。
+    異なる設定で生成した出力先の場合はValueErrorを上げる。
+    """
+    manifest_path = os.path.join(args.output, f"{shard_name(shard)}.json")
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    # 異なる設定で生成したシャードと混ぜない
+    expected = {
+        "seed": args.seed,
+        "factory": args.factory,
+        "shard_size": args.shard_size,
+        "format": args.format,
+        "image_format": args.image_format,
+    }
+    mismatched = {
+        key: manifest.get(key)
+        for key, value in expected.items()
+        if manifest.get(key, value) != value
+    }
+    if mismatched:
+        settings = " ".join(f"{key}={value!r}" for key, value in mismatched.items())
+        raise ValueError(f"{manifest_path} was generated with {settings}; use another --output")
+
+    indices = shard_range(args, shard)
+    if (manifest["start"], manifest["end"], manifest["num_samples"]) != (
+        indices.start,
+        indices.stop,
+        len(indices),
+    ):
+        return False
+    return os.path.exists(os.path.join(args.output, manifest["file"]))
+
+
+def parse_shards(spec: str) -> tuple[int, int]:
+    """
+    --shardsの値を(最初のシャード, 最後のシャード+1)にする。'5'はシャード5だけ、'5:'は5以降（終わりはNone）。
+    """
+    start, colon, end = spec.partition(":")
+    try:
+        first = int(start) if start else 0
+        if not colon:
+            return first, first + 1
+        return first, int(end) if end else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"expected 'N', 'START:END', 'START:' or ':END', got {spec!r}"
+        ) from None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--factory", required=True, help="module:function that returns CFG1")
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("-n", "--num-samples", type=int, required=True)
+    parser.add_argument("--shard-size", type=int, default=1000, help="samples per shard")
+    parser.add_argument(
+        "--shards",
+        type=parse_shards,
+        default=None,
+        help="shard or range of shards to write, e.g. '3' or '0:10' (default: all)",
+    )
+    parser.add_argument("--format", choices=sorted(WRITERS), default="tar")
+    parser.add_argument("--image-format", choices=sorted(IMAGE_FORMATS), default="png")
+    parser.add_argument("--quality", type=int, default=95, help="jpg/webp quality")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-retries", type=int, default=3)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # --factoryのモジュールをカレントディレクトリから読み込めるようにする
+    sys.path.insert(0, os.getcwd())
+    load_factory(args.factory)
+
+    num_shards = (args.num_samples + args.shard_size - 1) // args.shard_size
+    first, last = 0, num_shards
+    if args.shards is not None:
+        first, end = args.shards
+        last = min(end, num_shards) if end is not None else num_shards
+
+    os.makedirs(args.output, exist_ok=True)
+    todo = [shard for shard in range(first, last) if not is_complete(args, shard)]
+    print(
+        f"{len(todo)} of {last - first} shards to write in {args.output}",
+        file=sys.stderr,
+    )
+
+    workers = args.workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(
+            args.factory,
+            module_root(args.factory),
+            args.seed,
+            args.max_retries,
+            args.image_format,
+            args.quality,
+        ),
+    ) as executor:
+        # シャードをまたいで常にwindow個のサンプルを投入しておき、シャードを書き込む間もワーカーを動かし続ける
+        window = workers * 16
+        tasks = ((shard, index) for shard in todo for index in shard_range(args, shard))
+        pending = collections.deque()
+        samples = []
+        t0 = time.perf_counter()
+        while True:
+            for shard, index in tasks:
+                pending.append((shard, executor.submit(_generate_and_encode, index)))
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+
+            shard, future = pending.popleft()
+            samples.append(future.result())
+            if len(samples) < len(shard_range(args, shard)):
+                continue
+
+            manifest = write_shard(args, shard, samples)
+            samples = []
+            elapsed = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            print(
+                f"{manifest['file']}: {manifest['num_samples']} samples, "
+                f"{manifest['bytes'] / 1e6:.1f} MB, {manifest['num_samples'] / elapsed:.1f} samples/s",
+                file=sys.stderr,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
 import dataclasses
+import random
 from dataclasses import dataclass
 from PIL import Image
 from utils import remove_ruby_tags
+from asset_cache import AssetCache, PlateCache, asset_cache, working_copy
+from augment import AugmentParams, apply_augment, sample_params
 from configs import CFG1
-from generation_utils import create_textarea, create_textbox
+from instrumentation import profiler
+from layout import CharBoxes, layout_text
+from overlay_cache import OverlayCache, TextBoxCache
+from render_backends import get_backend
 
 
 @dataclass
@@ -14,6 +20,21 @@ class Outputs:
     name_text_ruby: str = None
     option_texts_ruby: list = dataclasses.field(default_factory=list)
 
+    # サンプル番号（generate_streamで生成した場合のみ）
+    index: int = None
+
+    # 段階ごとの経過時間[秒]（instrumentation.profilerをrecord_samples=Trueで有効にした場合のみ）
+    timings: dict = None
+
+    # テキストボックスの画像上の矩形[x0, y0, x1, y1]（to_gt_parseと同じキーと並び）
+    text_boxes: dict = None
+
+    # 画像に加えた劣化（cfg.augmentが設定されている場合のみ）
+    augment: AugmentParams = None
+
+    # 文字ごとの矩形（cfg.char_boxes=Trueの場合のみ）
+    char_boxes: CharBoxes = None
+
     @property
     def text(self):
         return remove_ruby_tags(self.text_ruby) if self.text_ruby else None
@@ -51,44 +72,119 @@ class Outputs:
         return gt_parse_ruby
 
 
+def _box(cfg) -> list[int]:
+    return [cfg.tl.x, cfg.tl.y, cfg.br.x, cfg.br.y]
+
+
 # CFG1用の画像生成関数
 # メッセージボックス1つ、名前ボックス0～1個、選択肢0～N個
-def generate_data(cfg: CFG1) -> Outputs:
+# 背景画像とキャラクター画像はデコード・リサイズ済みのものをassetsから取得する
+# overlaysを指定すると、文字起こししないUI要素とテキストボックスの背景を描画済みのものを使う
+# platesを指定すると、背景画像とキャラクター画像を合成済みのものを使う
+# textboxesを指定すると、同じ内容のテキストボックスは描画済みの画像を使う
+# cfg.scaleが1以外の場合は、全ての座標と大きさをscale倍した解像度で描画する
+# cfg.char_boxes=Trueの場合は、文字起こしするテキストボックスのレイアウトから文字ごとの矩形を作る
+# テキストボックスはcfg.backendの名前のrender_backendsのバックエンドで描画する
+# cfg.augmentが設定されている場合は、augment_seed（省略した場合はrandomから選ぶ）で決まる劣化を加える
+# augment_image=Falseの場合は画像には加えず、座標の変換とOutputs.augmentのパラメータだけを決める
+def generate_data(
+    cfg: CFG1,
+    assets: AssetCache = None,
+    overlays: OverlayCache = None,
+    plates: PlateCache = None,
+    textboxes: TextBoxCache = None,
+    augment_seed: int = None,
+    augment_image: bool = True,
+) -> Outputs:
+    backend = get_backend(cfg.backend)
     output = Outputs()
-
-    # bg
-    bg = Image.open(cfg.bg_cfg.path).resize((cfg.W, cfg.H))
-    img = bg.copy()
-
-    # characters
-    for ch_cfg in cfg.character_cfg_list:
-        fg = Image.open(ch_cfg.path)
-        fg = fg.resize((int(fg.width * (cfg.H / fg.height)), cfg.H))
-        img.paste(fg, ch_cfg.tl.tuple, fg)
+    output.text_boxes = {"options": [], "names": [], "messages": []}
+    assets = assets if assets is not None else asset_cache
+    if cfg.scale != 1.0:
+        # 縮小した解像度で直接描画する
+        cfg = cfg.scaled()
+
+    if profiler.enabled:
+        profiler.begin_sample()
+
+    if plates is not None:
+        # bg, characters
+        with profiler.stage("plate"):
+            img = plates.get(cfg, assets).copy()
+    else:
+        # bg
+        with profiler.stage("background"):
+            bg = assets.get(cfg.bg_cfg.path, (cfg.W, cfg.H))
+            img = working_copy(bg)
+
+        # characters
+        with profiler.stage("characters"):
+            for ch_cfg in cfg.character_cfg_list:
+                fg_width, fg_height = assets.source_size(ch_cfg.path)
+                fg = assets.get(ch_cfg.path, (int(fg_width * (cfg.H / fg_height)), cfg.H))
+                img.paste(fg, ch_cfg.tl.tuple, fg)
+
+    # UI要素（overlaysを使う場合は合成済みの画像を貼り付ける）
+    if overlays is not None:
+        with profiler.stage("noocr"):
+            overlay, overlay_tl = overlays.get_overlay(cfg.noocrbox_list)
+            if overlay is not None:
+                img.paste(overlay, overlay_tl, overlay)
+
+    char_boxes, box_kinds = [], []
+
+    def draw_textbox(box_cfg, kind=None):
+        layout = None
+        if kind is not None and cfg.char_boxes:
+            # 描画に使うレイアウトから矩形を作る（描画側でレイアウトを計算し直さない）
+            layout = layout_text(box_cfg)
+            char_boxes.append(CharBoxes.from_layout(layout, box_cfg, len(box_kinds)))
+            box_kinds.append(kind)
+        frame = overlays.get_frame(box_cfg) if overlays is not None else None
+        if textboxes is not None:
+            box_img, rendered = textboxes.get(box_cfg, frame, backend, layout)
+            img.paste(box_img, box_cfg.tl.tuple, box_img)
+            return rendered
+        return backend.draw_textbox(img, box_cfg, frame, layout)
 
     # UI要素
-    for noocr_cfg in cfg.noocrbox_list:
-        noocrbox_img, _ = create_textbox(noocr_cfg)
-        img.paste(noocrbox_img, noocr_cfg.tl.tuple, noocrbox_img)
-        # ★OCR対象ではないため、outputに追加しない
+    if overlays is None:
+        with profiler.stage("noocr"):
+            for noocr_cfg in cfg.noocrbox_list:
+                draw_textbox(noocr_cfg)
+                # ★OCR対象ではないため、outputに追加しない
 
     # message
     if cfg.msgbox is not None:
-        msgbox_img, rendered_msg = create_textbox(cfg.msgbox)
-        img.paste(msgbox_img, cfg.msgbox.tl.tuple, msgbox_img)
-        output.text_ruby = rendered_msg
+        with profiler.stage("message"):
+            output.text_ruby = draw_textbox(cfg.msgbox, "messages")
+            output.text_boxes["messages"].append(_box(cfg.msgbox))
 
     # name
     if cfg.namebox is not None:
-        namebox_img, rendered_name = create_textbox(cfg.namebox)
-        img.paste(namebox_img, cfg.namebox.tl.tuple, namebox_img)
-        output.name_text_ruby = rendered_name
+        with profiler.stage("name"):
+            output.name_text_ruby = draw_textbox(cfg.namebox, "names")
+            output.text_boxes["names"].append(_box(cfg.namebox))
 
     # options
-    for option_cfg in cfg.optionbox_list:
-        optionbox_img, rendered_option = create_textbox(option_cfg)
-        img.paste(optionbox_img, option_cfg.tl.tuple, optionbox_img)
-        output.option_texts_ruby.append(rendered_option)
+    with profiler.stage("options"):
+        for option_cfg in cfg.optionbox_list:
+            output.option_texts_ruby.append(draw_textbox(option_cfg, "options"))
+        if cfg.optionbox_list:
+            output.text_boxes["options"].append(
+                [_box(option_cfg) for option_cfg in cfg.optionbox_list]
+            )
 
     output.image = img
+    if cfg.char_boxes:
+        output.char_boxes = CharBoxes.concat(char_boxes, box_kinds)
+
+    if cfg.augment is not None:
+        with profiler.stage("augment"):
+            if augment_seed is None:
+                augment_seed = random.getrandbits(63)
+            apply_augment(output, sample_params(cfg.augment, augment_seed), augment_image)
+
+    if profiler.enabled:
+        output.timings = profiler.end_sample()
     return output
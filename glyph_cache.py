@@ -0,0 +1,102 @@
+import math
+from collections import OrderedDict
+from PIL import Image, ImageFont
+
+
+class GlyphAtlas:
+    """
+    ラスタライズ済みのグリフ（アルファマスクとオフセット）を保持するLRUキャッシュ。
+
+    キーは(フォントパス, フェイス番号, サイズ, 文字, 描画開始位置の小数部)。
+    FreeTypeはヒンティングの都合で描画開始位置の小数部によってマスクが変わるため、
+    subpixel=Noneの場合は小数部をそのままキーに含め、ImageDraw.textと画素単位で一致する結果を返す。
+    subpixel=Nを指定すると小数部を1/N px単位に丸めてキャッシュのヒット率を上げる。
+    この場合、グリフの位置ずれは最大1/(2N) pxで、差異はアンチエイリアスされた輪郭の画素に限られる。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, subpixel: int = None):
+        self.max_bytes = max_bytes
+        self.subpixel = subpixel
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _quantize(self, frac: float) -> float:
+        if self.subpixel is None:
+            return frac
+        return round(frac * self.subpixel) / self.subpixel
+
+    def get(self, font: ImageFont.FreeTypeFont, char: str, start=(0.0, 0.0)):
+        """
+        (マスク画像, オフセット)を返す。マスク画像はmode="L"。
+        """
+        start = (self._quantize(start[0]), self._quantize(start[1]))
+        key = (font.path, font.index, font.size, font.layout_engine, char, start)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        core, offset = font.getmask2(char, "L", start=start)
+        mask = Image.frombytes("L", core.size, bytes(core)) if core.size[1] else None
+        entry = (mask, offset)
+
+        self._entries[key] = entry
+        self.nbytes += _entry_nbytes(entry)
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _entry_nbytes(evicted)
+            self.evictions += 1
+        return entry
+
+    def draw(
+        self,
+        img: Image.Image,
+        xy: tuple[float, float],
+        char: str,
+        font: ImageFont.FreeTypeFont,
+        fill,
+    ):
+        """
+        ImageDraw.Draw(img).text(xy, char, fill=fill, font=font)と同等の描画をキャッシュ済みマスクで行う。
+        """
+        x, y = xy
+        start = (math.modf(x)[0], math.modf(y)[0])
+        mask, offset = self.get(font, char, start)
+        if mask is None:
+            return
+        img.paste(fill, (int(x) + offset[0], int(y) + offset[1]), mask)
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+def _entry_nbytes(entry) -> int:
+    mask, _ = entry
+    return 0 if mask is None else mask.size[0] * mask.size[1]
+
+
+# create_textareaが使うプロセス共通のアトラス
+glyph_atlas = GlyphAtlas()
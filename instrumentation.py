@@ -0,0 +1,126 @@
+import json
+import time
+from collections import Counter
+from asset_cache import asset_cache
+from font_utils import font_pool
+from glyph_cache import glyph_atlas
+
+
+class _NullStage:
+    # 計測が無効な場合に使う何もしないコンテキストマネージャ
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    """
+    生成処理の段階ごとの経過時間とカウンタを集計する。
+    既定では無効で、無効な間はstage()が共有の空のコンテキストマネージャを返すだけなのでほぼ負荷がない。
+
+    with profiler.stage("message"):
+        ...
+    profiler.count("glyphs", n)
+
+    record_samples=Trueの場合は、generate_dataがサンプルごとの経過時間をOutputs.timingsに付与する。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.record_samples = False
+        self.reset()
+
+    def enable(self, record_samples: bool = False):
+        self.enabled = True
+        self.record_samples = record_samples
+
+    def disable(self):
+        self.enabled = False
+        self.record_samples = False
+
+    def reset(self):
+        self.times = {}  # name -> [回数, 合計秒, 最大秒]
+        self.counters = Counter()
+        self.samples = 0
+        self._sample_times = None
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def add_time(self, name: str, seconds: float):
+        entry = self.times.get(name)
+        if entry is None:
+            self.times[name] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+        if self._sample_times is not None:
+            self._sample_times[name] = self._sample_times.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def begin_sample(self):
+        self.samples += 1
+        if self.record_samples:
+            self._sample_times = {}
+
+    def end_sample(self) -> dict:
+        sample_times, self._sample_times = self._sample_times, None
+        return sample_times
+
+    def to_dict(self) -> dict:
+        return {
+            "samples": self.samples,
+            "stages": {
+                name: {
+                    "count": count,
+                    "total_s": total,
+                    "mean_ms": total / count * 1e3,
+                    "max_ms": max_s * 1e3,
+                }
+                for name, (count, total, max_s) in self.times.items()
+            },
+            "counters": dict(self.counters),
+            "caches": {
+                "glyph_atlas": glyph_atlas.stats(),
+                "font_pool": font_pool.stats(),
+                "asset_cache": asset_cache.stats(),
+            },
+        }
+
+    def to_json(self, path: str = None, indent: int = 2) -> str:
+        text = json.dumps(self.to_dict(), ensure_ascii=False, indent=indent)
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+        return text
+
+
+# generate_dataなどが使うプロセス共通のプロファイラ
+profiler = Profiler()
@@ -0,0 +1,564 @@
+import copy
+import dataclasses
+from collections import OrderedDict
+from dataclasses import dataclass
+import numpy as np
+from PIL import Image
+from configs import TextBoxCFG
+from font_utils import char_in_font, get_advance_table
+from glyph_cache import glyph_atlas
+from utils import parse_ruby
+
+
+@dataclass
+class LineBreaks:
+    x: np.ndarray  # 各文字の左端のx座標
+    line: np.ndarray  # 各文字の行番号
+    line_starts: np.ndarray  # 各行の最初の文字のインデックス
+    prefix: np.ndarray  # 送り幅（文字幅+文字間隔）の累積和。prefix[k]は行頭からではなく文字列の先頭からの値
+    n_chars: int  # 描画できた文字数（はみ出した場合は改行前までの文字数）
+
+
+def break_lines(
+    widths: np.ndarray,
+    extents: np.ndarray,
+    character_spacing: float,
+    left: float,
+    right: float,
+    max_lines: int = None,
+) -> LineBreaks:
+    """
+    文字幅の累積和と二分探索で各文字の位置と改行位置を求める。
+
+    widths: 各文字の送り幅
+    extents: 改行判定に使う各文字の幅。ルビ対象の1文字目はルビ対象文字列全体の送り幅、
+        ルビ対象の2文字目以降は改行しないため-inf
+    left, right: 文字を配置できるx座標の範囲。x + extent > right の文字の前で改行する
+    max_lines: 描画できる最大行数。超える場合は改行した文字の手前までを描画済みとする
+
+    1文字ずつ判定する場合と同様に、改行した文字は次の行の先頭に判定なしで配置される。
+    """
+    n = len(widths)
+    prefix = np.zeros(n + 1, dtype=np.float64)
+    np.cumsum(widths + character_spacing, out=prefix[1:])
+    # 各文字を行頭基準で配置したときの改行判定位置（prefix[k] + extent）
+    reach = prefix[:-1] + extents
+
+    line_starts = []
+    start = 0  # 行頭の文字
+    search = 0  # 改行判定を始める文字（最初の行以外は行頭の次の文字から）
+    n_chars = n
+    while True:
+        line_starts.append(start)
+        if search >= n:
+            break
+        # 行頭からの累積最大値は単調増加なので、最初にはみ出す文字を二分探索で求められる
+        reach_max = np.maximum.accumulate(reach[search:] - prefix[start]) + left
+        k = search + int(np.searchsorted(reach_max, right, side="right"))
+        if k >= n:
+            break
+        if max_lines is not None and len(line_starts) >= max_lines:
+            # 改行した行が入りきらない場合は改行までに描画した文字列を返す
+            n_chars = k
+            break
+        start, search = k, k + 1
+
+    line_starts = np.asarray(line_starts, dtype=np.int64)
+    line = np.zeros(n, dtype=np.int64)
+    if len(line_starts) > 1:
+        line[line_starts[1:]] = 1
+        line = np.cumsum(line)
+    x = left + (prefix[:-1] - prefix[line_starts[line]])
+    return LineBreaks(
+        x=x[:n_chars],
+        line=line[:n_chars],
+        line_starts=line_starts,
+        prefix=prefix,
+        n_chars=n_chars,
+    )
+
+
+def get_height(font):
+    return font.size
+    # baselineからascentとdescentの合計を返す
+    # フォントによっては行間が大きくなりすぎるので、やめてフォントサイズを返すことにした
+    # return font.getmetrics()[0] + font.getmetrics()[1]
+
+
+@dataclass
+class TextLayout:
+    """
+    テキストエリア1つ分のレイアウト結果。画像を確保せずに、描画する文字とその位置だけを保持する。
+    座標はテキストエリア（TextBoxCFG.sizeの大きさ）の左上を原点とし、ImageDraw.textに渡すxyと同じ意味を持つ。
+    font_ids, ruby_font_idsは0が本来のフォント、1がフォールバックフォントを表す。
+    """
+
+    text: str  # 元のテキスト（タグ付き）
+    rendered_text: str  # 描画できたテキスト（はみ出す場合は描画できたところまで）
+    text_max_x: float  # テキストとルビの右端のx座標（centeringに使う）
+    size: tuple[int, int]
+    fill: str
+    fonts: tuple  # (font, fallback_font)
+    ruby_fonts: tuple  # (ruby_font, fallback_ruby_font)
+
+    # 本文の文字（描画できた文字のみ）
+    codepoints: np.ndarray  # uint32 (n,)
+    x: np.ndarray  # float64 (n,)
+    y: np.ndarray  # float64 (n,)
+    widths: np.ndarray  # float64 (n,) 送り幅
+    line: np.ndarray  # int64 (n,) 行番号
+    font_ids: np.ndarray  # uint8 (n,)
+
+    # ルビの文字
+    ruby_codepoints: np.ndarray  # uint32 (m,)
+    ruby_x: np.ndarray  # float64 (m,)
+    ruby_y: np.ndarray  # float64 (m,)
+    ruby_widths: np.ndarray  # float64 (m,)
+    ruby_font_ids: np.ndarray  # uint8 (m,)
+    ruby_group: np.ndarray  # int64 (m,) 各ルビ文字が属するルビのインデックス
+
+    # ルビ対象の文字範囲。ルビiはcodepoints[group_start[i]:group_end[i]]の上に描画される
+    group_start: np.ndarray  # int64 (g,)
+    group_end: np.ndarray  # int64 (g,)
+
+    @property
+    def chars(self) -> str:
+        return _decode(self.codepoints)
+
+    @property
+    def ruby_chars(self) -> str:
+        return _decode(self.ruby_codepoints)
+
+    @property
+    def truncated(self) -> bool:
+        return self.rendered_text != self.text
+
+
+def _decode(codepoints: np.ndarray) -> str:
+    return codepoints.astype("<u4").tobytes().decode("utf-32-le")
+
+
+def _font_ids(font, chars: str) -> np.ndarray:
+    return np.fromiter(
+        (0 if char_in_font(font, c) else 1 for c in chars),
+        dtype=np.uint8,
+        count=len(chars),
+    )
+
+
+def layout_text(cfg: TextBoxCFG) -> TextLayout:
+    """
+    cfgのテキストの配置を計算する。画像は確保しない。
+    改行しても入りきらない場合は描画できたところまでをrendered_textに返し、
+    ルビがテキストエリアの左右からはみ出す場合はValueErrorを上げる。
+    """
+    text = cfg.text
+    has_ruby = cfg.has_ruby
+    size = cfg.size
+    margin = cfg.margin
+    line_spacing = cfg.line_spacing
+    character_spacing = cfg.character_spacing
+    ruby_line_spacing = cfg.ruby_line_spacing
+    ruby_character_spacing = cfg.ruby_character_spacing
+
+    font = cfg.font
+    ruby_font = cfg.ruby_font
+
+    # ルビの描画位置を確保するための高さ
+    ruby_height = get_height(ruby_font) + ruby_line_spacing if has_ruby else 0
+    line_height = get_height(font) + line_spacing + ruby_height
+
+    # テキスト描画の開始位置
+    y = margin.top + ruby_height
+
+    # <ruby>漢字<rt>かんじ</rt></ruby> の形式を想定（文字列ごとにキャッシュされた解析結果を使う）
+    markup = parse_ruby(text)
+    chars = markup.plain
+    groups = markup.ruby_segments
+
+    # 文字幅はフォントごとに1回だけ計測した送り幅テーブルから取得する
+    widths = get_advance_table(font).widths(chars)
+
+    # 改行判定に使う幅
+    # ルビ対象中は改行しないため、ルビ対象文字の1文字目にルビ対象文字列全体の長さを先読みして改行判定する
+    extents = widths.copy()
+    for g in groups:
+        if g.start < g.end:
+            extents[g.start] = (widths[g.start : g.end] + character_spacing).sum()
+            extents[g.start + 1 : g.end] = -np.inf
+
+    # 改行した行が入りきるか判定するため、描画できる行数を求める
+    max_lines = None
+    if line_height > 0:
+        next_line_bottom = get_height(font) + ruby_height
+        max_lines = 1 + max(0, (size.height - next_line_bottom - y) // line_height)
+
+    breaks = break_lines(
+        widths,
+        extents,
+        character_spacing,
+        left=margin.left,
+        right=size.width - margin.right,
+        max_lines=max_lines,
+    )
+    n_chars = breaks.n_chars
+    xs = breaks.x.tolist()
+    ys = (y + breaks.line * line_height).tolist()
+
+    # centeringのためにテキストの右端を記憶する
+    text_max_x = -1
+    if n_chars > 0:
+        text_max_x = max(text_max_x, float((breaks.x + widths[:n_chars]).max()))
+
+    # 改行までに描画したルビの配置を計算する
+    ruby_table = get_advance_table(ruby_font)
+    drawn_groups = []
+    ruby_chars = []
+    ruby_x = []
+    ruby_y = []
+    ruby_widths = []
+    ruby_group = []
+    for g in groups:
+        if g.end > n_chars:
+            break
+
+        if g.start < g.end:
+            last = g.end - 1
+            ruby_target_x_left = xs[g.start]
+            # ruby対象文字列の右端のx座標
+            ruby_target_x_right = (
+                xs[last] + (widths[last] + character_spacing)
+            ) - character_spacing
+            ruby_line_y = ys[g.start]
+        else:
+            # ルビ対象文字列が空の場合は、直前の文字の次の位置
+            if g.start > 0:
+                pen_x = xs[g.start - 1] + (widths[g.start - 1] + character_spacing)
+                ruby_line_y = ys[g.start - 1]
+            else:
+                pen_x = margin.left
+                ruby_line_y = y
+            ruby_target_x_left = pen_x
+            ruby_target_x_right = pen_x - character_spacing
+
+        ruby = g.ruby
+        ruby_target_width = ruby_target_x_right - ruby_target_x_left
+        ruby_center_x = (ruby_target_x_left + ruby_target_x_right) / 2
+
+        # ルビ対象文字列の幅と、ルビを普通に配置した時の幅を両方計算して比較する
+        _ruby_widths = ruby_table.widths(ruby)
+        ruby_characters_width = sum(_ruby_widths.tolist())
+        ruby_calcled_width = ruby_characters_width + (
+            ruby_character_spacing * (len(ruby) + 1)
+        )
+        if ruby_target_width > ruby_calcled_width and len(ruby) > 1:
+            # ルビ対象文字列の幅が広い場合は、ruby_target_xの間に均等割り付け
+            _ruby_character_spacing = (ruby_target_width - ruby_characters_width) / (
+                len(ruby) + 1
+            )
+            _ruby_x = ruby_target_x_left + _ruby_character_spacing
+        else:
+            # 幅が足りない場合（私（わたくし）など）は、ruby_center_x周りにruby_character_spacingで配置
+            _ruby_x = ruby_center_x - ruby_calcled_width / 2
+            _ruby_character_spacing = ruby_character_spacing
+
+            if _ruby_x < 0:
+                # 一文字目に長いrubyがある場合描画範囲からはみ出すことがあるため、エラーを上げる
+                raise ValueError(
+                    f"Ruby overflowed from the left of the text area. {_ruby_x}"
+                )
+
+        # 各ルビ文字のx座標（1文字ずつ加算する場合と同じ順序で累積和をとる）
+        _ruby_xs = np.cumsum(
+            np.concatenate([[_ruby_x], _ruby_widths + _ruby_character_spacing])
+        )
+        ruby_rights = _ruby_xs[1:] - _ruby_character_spacing
+        if len(ruby):
+            text_max_x = max(text_max_x, float(ruby_rights.max()))
+            overflowed = np.flatnonzero(ruby_rights > size.width)
+            if len(overflowed):
+                # 右側にはみ出した場合は描画されないため、エラーを上げる
+                raise ValueError(
+                    f"Ruby overflowed from the right of the text area. {ruby_rights[overflowed[0]]} > {size.width}"
+                )
+
+        ruby_chars.append(ruby)
+        ruby_x.append(_ruby_xs[:-1])
+        ruby_y.append(np.full(len(ruby), ruby_line_y - ruby_height, dtype=np.float64))
+        ruby_widths.append(_ruby_widths)
+        ruby_group.append(np.full(len(ruby), len(drawn_groups), dtype=np.int64))
+        drawn_groups.append(g)
+
+    if n_chars < len(chars):
+        # 改行までに描画した文字列を返す（ルビは</ruby>まで含める）
+        rendered_text = text[: markup.source_offset(n_chars)]
+    else:
+        rendered_text = text
+
+    chars = chars[:n_chars]
+    ruby_chars = "".join(ruby_chars)
+    return TextLayout(
+        text=text,
+        rendered_text=rendered_text,
+        text_max_x=text_max_x,
+        size=size.tuple,
+        fill=cfg.font_hex,
+        fonts=(font, cfg.fallback_font),
+        ruby_fonts=(ruby_font, cfg.fallback_ruby_font),
+        codepoints=get_advance_table(font).codepoints(chars),
+        x=breaks.x,
+        y=np.asarray(ys, dtype=np.float64),
+        widths=widths[:n_chars],
+        line=breaks.line,
+        font_ids=_font_ids(font, chars),
+        ruby_codepoints=ruby_table.codepoints(ruby_chars),
+        ruby_x=_concat(ruby_x, np.float64),
+        ruby_y=_concat(ruby_y, np.float64),
+        ruby_widths=_concat(ruby_widths, np.float64),
+        ruby_font_ids=_font_ids(ruby_font, ruby_chars),
+        ruby_group=_concat(ruby_group, np.int64),
+        group_start=np.array([g.start for g in drawn_groups], dtype=np.int64),
+        group_end=np.array([g.end for g in drawn_groups], dtype=np.int64),
+    )
+
+
+def _concat(arrays: list, dtype) -> np.ndarray:
+    if not arrays:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
+
+
+def rasterize(
+    layout: TextLayout, img: Image.Image = None, offset: tuple[int, int] = (0, 0)
+) -> Image.Image:
+    """
+    レイアウトを描画する。imgを省略した場合はlayout.sizeの透明なRGBA画像を確保して描画する。
+    offsetを指定すると、img上の(offset)をテキストエリアの左上として描画する。
+    """
+    if img is None:
+        img = Image.new("RGBA", layout.size, (0, 0, 0, 0))  # 背景色（透明）
+    ox, oy = offset
+    fill = layout.fill
+
+    chars = layout.chars
+    xs = layout.x.tolist()
+    ys = layout.y.tolist()
+    font_ids = layout.font_ids.tolist()
+
+    ruby_chars = layout.ruby_chars
+    ruby_xs = layout.ruby_x.tolist()
+    ruby_ys = layout.ruby_y.tolist()
+    ruby_font_ids = layout.ruby_font_ids.tolist()
+    # ルビは対象文字列の描画後、次の文字の描画前に描画する
+    ruby_before = layout.group_end[layout.ruby_group].tolist()
+
+    j = 0
+    for k in range(len(chars) + 1):
+        while j < len(ruby_chars) and ruby_before[j] == k:
+            glyph_atlas.draw(
+                img,
+                (ruby_xs[j] + ox, ruby_ys[j] + oy),
+                ruby_chars[j],
+                font=layout.ruby_fonts[ruby_font_ids[j]],
+                fill=fill,
+            )
+            j += 1
+        if k == len(chars):
+            break
+
+        # ImageDraw.textと同じ結果になるよう、キャッシュ済みのグリフマスクを貼り付ける
+        glyph_atlas.draw(
+            img,
+            (xs[k] + ox, ys[k] + oy),
+            chars[k],
+            font=layout.fonts[font_ids[k]],
+            fill=fill,
+        )
+    return img
+
+
+def ruby_font_size_for(font_size: int, ruby_font_size: int) -> int:
+    # ルビはfontサイズの1/4～1/2にする
+    return max(min(ruby_font_size, font_size // 2), font_size // 4, 1)
+
+
+def fits_box(layout: TextLayout, cfg: TextBoxCFG) -> bool:
+    """
+    テキスト全体がmarginの内側に収まっているかを判定する。
+    layout_textは1行目を高さに関係なく配置し、ルビ対象文字列の途中では改行しないため、
+    切り捨てがないことに加えて、本文の右端と最終行の下端も確認する。
+    """
+    if layout.truncated:
+        return False
+    if len(layout.x) == 0:
+        return True
+    right = float((layout.x + layout.widths).max())
+    bottom = float(layout.y.max()) + get_height(layout.fonts[0])
+    return (
+        right <= cfg.size.width - cfg.margin.right
+        and bottom <= cfg.size.height - cfg.margin.bottom
+    )
+
+
+_fit_font_size_cache = OrderedDict()
+FIT_FONT_SIZE_CACHE_MAXSIZE = 65536
+
+
+def fit_font_size(cfg: TextBoxCFG, min_size: int = 1, max_size: int = None) -> int:
+    """
+    ルビを含むテキスト全体がテキストボックスに収まる最大のフォントサイズを返す。
+    ルビのフォントサイズはruby_font_size_forで本文に合わせて調整する前提で計算する。
+    画像は描画せずlayout_textの結果だけで二分探索し、結果は(テキスト, ボックスの形状, フォントとフォールバックフォント)ごとにメモ化する。
+    min_sizeでも収まらない場合はmin_sizeを返す。
+    """
+    if max_size is None:
+        max_size = cfg.size.height - (cfg.margin.top + cfg.margin.bottom)
+    max_size = max(min_size, max_size)
+
+    key = (
+        cfg.text,
+        cfg.size.tuple,
+        dataclasses.astuple(cfg.margin),
+        cfg.line_spacing,
+        cfg.character_spacing,
+        cfg.ruby_line_spacing,
+        cfg.ruby_character_spacing,
+        (cfg.font.path, cfg.font.index, cfg.font.layout_engine),
+        (cfg.fallback_font.path, cfg.fallback_font.index),
+        (cfg.ruby_font.path, cfg.ruby_font.index, cfg.ruby_font.size),
+        (cfg.fallback_ruby_font.path, cfg.fallback_ruby_font.index),
+        min_size,
+        max_size,
+    )
+    size = _fit_font_size_cache.get(key)
+    if size is not None:
+        _fit_font_size_cache.move_to_end(key)
+        return size
+
+    # 引数のcfgは書き換えない
+    trial = copy.copy(cfg)
+    ruby_font_size = cfg.ruby_font.size
+
+    def fits(font_size: int) -> bool:
+        trial.change_font_size(font_size)
+        trial.change_ruby_font_size(ruby_font_size_for(font_size, ruby_font_size))
+        try:
+            return fits_box(layout_text(trial), trial)
+        except ValueError:
+            # ルビがはみ出す場合は収まらないとみなす
+            return False
+
+    # フォントサイズが大きいほど文字幅と行の高さが大きくなるため、収まるかどうかは単調とみなして二分探索する
+    lo, hi = min_size, max_size
+    if fits(hi):
+        lo = hi
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if fits(mid):
+            lo = mid
+        else:
+            hi = mid - 1
+
+    _fit_font_size_cache[key] = lo
+    while len(_fit_font_size_cache) > FIT_FONT_SIZE_CACHE_MAXSIZE:
+        _fit_font_size_cache.popitem(last=False)
+    return lo
+
+
+@dataclass
+class CharBoxes:
+    """
+    1枚の画像に描画した文字ごとの矩形（文字単位の検出やOCRの学習用）。列ごとの配列で持つ。
+    矩形はImageDraw.textに渡す位置から、横は送り幅、縦はフォントのアセンダーとディセンダーの合計の範囲で、
+    テキストボックスの範囲に切り抜いた画像上の座標[x0, y0, x1, y1]（空白文字も含む）。
+    """
+
+    boxes: np.ndarray  # int16 (n, 4)
+    codepoints: np.ndarray  # uint32 (n,)
+    box_id: np.ndarray  # int16 (n,) 文字を描画したテキストボックスの番号
+    ruby: np.ndarray  # bool (n,) ルビの文字か
+    box_kinds: list = dataclasses.field(default_factory=list)  # 番号ごとの種類（"messages", "names", "options"）
+
+    def __len__(self):
+        return len(self.codepoints)
+
+    @property
+    def chars(self) -> str:
+        return _decode(self.codepoints)
+
+    @classmethod
+    def from_layout(cls, layout: TextLayout, cfg: TextBoxCFG, box_id: int = 0) -> "CharBoxes":
+        """cfg.tlに描画したlayoutの文字の矩形を作る（本文の文字の後にルビの文字を並べる）"""
+        dx = 0
+        if cfg.centering:
+            dx = int((cfg.size.width - layout.text_max_x - cfg.margin.left) // 2)
+        ox, oy = cfg.tl.x + dx, cfg.tl.y
+
+        def boxes(x, y, widths, font_ids, fonts):
+            heights = np.array([sum(font.getmetrics()) for font in fonts], dtype=np.float64)
+            return np.stack(
+                [
+                    np.floor(x),
+                    np.floor(y),
+                    np.ceil(x + widths),
+                    np.ceil(y + heights[font_ids]),
+                ],
+                axis=-1,
+            )
+
+        xyxy = np.concatenate(
+            [
+                boxes(layout.x, layout.y, layout.widths, layout.font_ids, layout.fonts),
+                boxes(
+                    layout.ruby_x,
+                    layout.ruby_y,
+                    layout.ruby_widths,
+                    layout.ruby_font_ids,
+                    layout.ruby_fonts,
+                ),
+            ]
+        )
+        xyxy += (ox, oy, ox, oy)
+        # ボックスの外は描画されないため、ボックスの範囲に切り抜く
+        np.clip(xyxy[:, 0::2], cfg.tl.x, cfg.br.x, out=xyxy[:, 0::2])
+        np.clip(xyxy[:, 1::2], cfg.tl.y, cfg.br.y, out=xyxy[:, 1::2])
+
+        n, m = len(layout.codepoints), len(layout.ruby_codepoints)
+        return cls(
+            boxes=xyxy.astype(np.int16),
+            codepoints=np.concatenate([layout.codepoints, layout.ruby_codepoints]).astype(
+                np.uint32, copy=False
+            ),
+            box_id=np.full(n + m, box_id, dtype=np.int16),
+            ruby=np.arange(n + m) >= n,
+        )
+
+    @classmethod
+    def concat(cls, parts: list["CharBoxes"], box_kinds: list = None) -> "CharBoxes":
+        return cls(
+            boxes=_concat([p.boxes for p in parts], np.int16).reshape(-1, 4),
+            codepoints=_concat([p.codepoints for p in parts], np.uint32),
+            box_id=_concat([p.box_id for p in parts], np.int16),
+            ruby=_concat([p.ruby for p in parts], np.bool_),
+            box_kinds=list(box_kinds or []),
+        )
+
+    def to_dict(self) -> dict:
+        """np.savezやpyarrowでそのまま保存できる配列の辞書にする（box_kindsは文字列の配列）"""
+        return {
+            "boxes": self.boxes,
+            "codepoints": self.codepoints,
+            "box_id": self.box_id,
+            "ruby": self.ruby,
+            "box_kinds": np.array(self.box_kinds, dtype=str),
+        }
+
+    @classmethod
+    def from_dict(cls, data) -> "CharBoxes":
+        return cls(
+            boxes=np.asarray(data["boxes"], dtype=np.int16).reshape(-1, 4),
+            codepoints=np.asarray(data["codepoints"], dtype=np.uint32),
+            box_id=np.asarray(data["box_id"], dtype=np.int16),
+            ruby=np.asarray(data["ruby"], dtype=np.bool_),
+            box_kinds=[str(kind) for kind in data["box_kinds"]],
+        )
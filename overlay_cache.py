@@ -0,0 +1,211 @@
+import hashlib
+from collections import OrderedDict
+from PIL import Image, ImageFont
+from configs import TextBoxCFG
+from generation_utils import create_box, create_textbox
+
+
+def _font_key(font: ImageFont.FreeTypeFont) -> tuple:
+    return (font.path, font.index, font.size, font.layout_engine)
+
+
+def textbox_key(cfg: TextBoxCFG, position: bool = True) -> str:
+    """
+    描画結果に影響するTextBoxCFGのフィールドから安定したハッシュ値を作る。
+    呼び出した時点のフィールドから計算するため、cfgを書き換えた後も正しいキーになる。
+    position=Falseの場合は位置を含めず大きさだけを使う（ボックス単体の画像のキャッシュ用）。
+    """
+    fields = (
+        cfg.text,
+        (cfg.tl.tuple, cfg.br.tuple) if position else cfg.size.tuple,
+        (cfg.margin.top, cfg.margin.right, cfg.margin.bottom, cfg.margin.left),
+        cfg.bg_hex,
+        cfg.bg_alpha,
+        cfg.font_hex,
+        _font_key(cfg.font),
+        _font_key(cfg.fallback_font),
+        _font_key(cfg.ruby_font),
+        _font_key(cfg.fallback_ruby_font),
+        cfg.line_spacing,
+        cfg.character_spacing,
+        cfg.ruby_line_spacing,
+        cfg.ruby_character_spacing,
+        cfg.centering,
+    )
+    return hashlib.sha1(repr(fields).encode("utf-8")).hexdigest()
+
+
+class OverlayCache:
+    """
+    サンプルによらず同じ画像になるUI要素を描画済みの状態で保持するLRUキャッシュ。
+
+    get_overlay: noocrbox_listのような文字起こししないテキストボックスを、
+        まとめて1枚のRGBA画像に合成したもの（要素全体を囲む範囲に切り抜き、左上の座標と組で返す）
+    get_frame: メッセージボックスや名前ボックスのテキストを描画する前の背景（create_boxの結果）
+
+    キーはtextbox_keyで作るため、同じ設定を共有する多数のサンプルで描画を1回にできる。
+    返す画像はキャッシュと共有しているため、呼び出し側で書き換えないこと。
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key, build):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        entry = build()
+        self._entries[key] = entry
+        self.nbytes += _entry_nbytes(entry)
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _entry_nbytes(evicted)
+            self.evictions += 1
+        return entry
+
+    def get_overlay(
+        self, cfgs: list[TextBoxCFG]
+    ) -> tuple[Image.Image, tuple[int, int]]:
+        """
+        cfgsのテキストボックスを順に重ねた(RGBA画像, 左上の座標)を返す。cfgsが空の場合は(None, (0, 0))。
+        重なりのない要素は1つずつimg.pasteした場合と同じ画素になる。
+        """
+        if not cfgs:
+            return None, (0, 0)
+        key = ("overlay",) + tuple(textbox_key(cfg) for cfg in cfgs)
+        return self._lookup(key, lambda: _compose_overlay(cfgs))
+
+    def get_frame(self, cfg: TextBoxCFG) -> Image.Image:
+        key = ("frame", cfg.size.tuple, cfg.bg_hex, cfg.bg_alpha)
+        return self._lookup(
+            key,
+            lambda: create_box(*cfg.size.tuple, hex=cfg.bg_hex, alpha=cfg.bg_alpha),
+        )
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class TextBoxCache:
+    """
+    create_textboxで描画したテキストボックスの画像と描画済みのテキストを保持するLRUキャッシュ。
+    名前や選択肢のように同じ文字列が繰り返し現れる場合に、描画を1回にする。
+
+    キーは参照した時点のcfgのフィールドから作るため（textbox_key(cfg, position=False)）、
+    get_tiled_option_cfgsのようにcfgを書き換えた後でも古い画像を返すことはない。
+    位置はキーに含めないため、同じ内容で位置だけが異なるボックスは同じ画像を共有する。
+    backendを指定した場合はそのバックエンドのcreate_textboxで描画し、キーにバックエンドの名前を含める。
+    返す画像はキャッシュと共有しているため、呼び出し側で書き換えないこと。
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(
+        self, cfg: TextBoxCFG, box: Image.Image = None, backend=None, layout=None
+    ) -> tuple[Image.Image, str]:
+        """
+        create_textbox(cfg, box)と同じ(画像, 描画済みのテキスト)を返す。
+        layout: 計算済みのlayout_text(cfg)の結果（描画する場合にだけ使う）
+        """
+        key = textbox_key(cfg, position=False)
+        if backend is not None:
+            key = (backend.name, key)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        entry = (
+            create_textbox(cfg, box, layout)
+            if backend is None
+            else backend.create_textbox(cfg, box, layout)
+        )
+        self._entries[key] = entry
+        self.nbytes += _entry_nbytes(entry)
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _entry_nbytes(evicted)
+            self.evictions += 1
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+def _compose_overlay(cfgs: list[TextBoxCFG]) -> tuple[Image.Image, tuple[int, int]]:
+    left = min(cfg.tl.x for cfg in cfgs)
+    top = min(cfg.tl.y for cfg in cfgs)
+    right = max(cfg.br.x for cfg in cfgs)
+    bottom = max(cfg.br.y for cfg in cfgs)
+
+    overlay = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+    for cfg in cfgs:
+        box, _ = create_textbox(cfg)
+        # 透明な画像へのpasteはアルファ値も線形補間してしまうため、アルファ合成で重ねる
+        overlay.alpha_composite(box, (cfg.tl.x - left, cfg.tl.y - top))
+    return overlay, (left, top)
+
+
+def _entry_nbytes(entry) -> int:
+    img = entry[0] if isinstance(entry, tuple) else entry
+    if img is None:
+        return 0
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+# generate_data(overlays=overlay_cache, textboxes=textbox_cache)で使うプロセス共通のキャッシュ
+overlay_cache = OverlayCache()
+textbox_cache = TextBoxCache()
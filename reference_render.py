@@ -0,0 +1,211 @@
+"""
+ImageDraw.textで1文字ずつ描画する、layout_textに置き換える前のテキストボックスの描画（render_backendsのreference）
+
+generation_utils.create_textareaを置き換えた時点の実装を固定したもので、他の描画方法の正解として使う。
+描画結果を変えないよう、このモジュールは変更しないこと（描画済みのテキストの扱いを除いて元の実装と同じ）。
+"""
+
+from PIL import Image, ImageDraw
+from configs import TextBoxCFG
+from font_utils import char_in_font
+from generation_utils import create_box
+from layout import get_height
+
+
+def create_textbox(cfg: TextBoxCFG, box: Image.Image = None) -> tuple[Image.Image, str]:
+    """box: 作成済みのテキストボックスの背景（省略した場合はcreate_boxで作る）"""
+    box = (
+        create_box(*cfg.size.tuple, hex=cfg.bg_hex, alpha=cfg.bg_alpha)
+        if box is None
+        else box.copy()
+    )
+    textarea, rendered_text, max_x = create_textarea(cfg)
+
+    textarea_tl = (0, 0)
+    if cfg.centering:
+        textarea_tl = (int((cfg.size.width - max_x - cfg.margin.left) // 2), 0)
+    box.paste(textarea, textarea_tl, textarea)
+    return box, rendered_text
+
+
+def create_textarea(cfg: TextBoxCFG) -> tuple[Image.Image, str, int]:
+    """
+    ImageDraw.textで1文字ずつ描画する元の実装。
+    描画済みのテキストがルビで終わる場合に</ruby>まで含める点だけが元の実装と異なる。
+    テキストを描画した画像、描画済みのテキスト（はみ出す場合は描画したところまで）、テキストの右端を返す。
+    """
+    rendered_text = ""  # 描画済みのテキスト（改行ではみ出す場合は描画したところまでを返却する）
+
+    text = cfg.text
+    has_ruby = cfg.has_ruby
+    size = cfg.size
+    margin = cfg.margin
+    line_spacing = cfg.line_spacing
+    character_spacing = cfg.character_spacing
+    ruby_line_spacing = cfg.ruby_line_spacing
+    ruby_character_spacing = cfg.ruby_character_spacing
+    font_hex = cfg.font_hex
+
+    font = cfg.font
+    fallback_font = cfg.fallback_font  # 文字がない場合のフォールバック先
+
+    ruby_font = cfg.ruby_font
+    fallback_ruby_font = cfg.fallback_ruby_font
+
+    # テキストはw, hの範囲に描画する
+    # ルビのはみ出しはmarginまで許容し、それ以上はみ出すと描画されない
+    text_img = Image.new("RGBA", (size.width, size.height), (0, 0, 0, 0))
+    text_img_draw = ImageDraw.Draw(text_img)
+
+    # centeringのためにテキストの右端を記憶する
+    text_max_x = -1
+
+    # テキスト描画の開始位置
+    x = margin.left
+    y = margin.top
+
+    if has_ruby:
+        # ルビの描画位置を確保するために、ルビの高さをyに加算
+        y += get_height(ruby_font) + ruby_line_spacing
+
+    # テキストを1文字ずつ描画する際の一時情報
+    in_ruby_target = False
+
+    ruby = ""
+    ruby_target = ""
+    ruby_target_x = {"left": -1, "right": -1}
+    ruby_newline_checked = False
+
+    # テキストを1文字ずつ描画
+    # <ruby>漢字<rt>かんじ</rt></ruby> の形式を想定
+    # 一つの<ruby>タグに複数の<rt>は含められない（rubyタグ自体を複数使って記述する必要がある）
+    next_i = -1
+    for i, c in enumerate(text):
+        # タグの読み飛ばし
+        if next_i > i:
+            continue
+
+        if c == "<":  # タグ記述の開始時
+            tag = text[i : i + text[i:].index(">") + 1]  # <ruby>の場合、tag = "<ruby>"
+
+            if tag == "<ruby>":
+                ruby_newline_checked = False  # このループで文字描画前にルビ対象文字中に改行があるかを判定する
+                ruby_target = text[i + 6 : i + 6 + text[i + 6 :].index("<")]  # ルビ対象文字列
+                ruby_target_x["left"] = x  # ruby対象文字列の開始x
+                in_ruby_target = True
+                next_i = i + 6  # タグが終わるまで読み飛ばす（次の文字はルビ対象文字列の1文字目）
+
+            elif tag == "</ruby>":
+                in_ruby_target = False
+                next_i = i + 7  # タグが終わるまで読み飛ばす
+
+            elif tag == "<rt>":
+                ruby = text[i + 4 : i + 4 + text[i + 4 :].index("<")]  # ルビ文字列
+                ruby_target_x["right"] = x - character_spacing  # ruby対象文字列の右端のx座標
+                next_i = i + 4 + text[i + 4 :].index("<")  # ルビの最期まで読み飛ばす（次の文字は</rt>の<）
+
+            elif tag == "</rt>":
+                if has_ruby:
+                    # ルビを一括で描画する
+                    ruby_target_width = ruby_target_x["right"] - ruby_target_x["left"]
+                    ruby_center_x = (ruby_target_x["left"] + ruby_target_x["right"]) / 2
+
+                    # ルビ対象文字列の幅と、ルビを普通に配置した時の幅を両方計算して比較する
+                    ruby_characters_width = sum(
+                        [ruby_font.getlength(rc) for rc in ruby]
+                    )
+                    ruby_calcled_width = ruby_characters_width + (
+                        ruby_character_spacing * (len(ruby) + 1)
+                    )
+                    if ruby_target_width > ruby_calcled_width and len(ruby) > 1:
+                        # ルビ対象文字列の幅が広い場合は、ruby_target_xの間に均等割り付け
+                        _ruby_character_spacing = (
+                            ruby_target_width - ruby_characters_width
+                        ) / (len(ruby) + 1)
+                        ruby_x = ruby_target_x["left"] + _ruby_character_spacing
+                    else:
+                        # 幅が足りない場合（私（わたくし）など）は、ruby_center_x周りにruby_character_spacingで配置
+                        ruby_x = ruby_center_x - ruby_calcled_width / 2
+                        _ruby_character_spacing = ruby_character_spacing
+
+                        if ruby_x < 0:
+                            # 一文字目に長いrubyがある場合描画範囲からはみ出すことがあるため、エラーを上げる
+                            raise ValueError(
+                                f"Ruby overflowed from the left of the text area. {ruby_x}"
+                            )
+
+                    # 高さ計算
+                    ruby_y = y - (get_height(ruby_font) + ruby_line_spacing)
+
+                    # ルビを1文字ずつ描画
+                    for rc in ruby:
+                        text_img_draw.text(
+                            (ruby_x, ruby_y),
+                            rc,
+                            fill=font_hex,
+                            font=ruby_font
+                            if char_in_font(ruby_font, rc)
+                            else fallback_ruby_font,
+                        )
+                        ruby_x += ruby_font.getlength(rc) + _ruby_character_spacing
+                        text_max_x = max(text_max_x, ruby_x - _ruby_character_spacing)
+                        if ruby_x - _ruby_character_spacing > size.width:
+                            # 右側にはみ出した場合は描画されないため、エラーを上げる
+                            raise ValueError(
+                                f"Ruby overflowed from the right of the text area. {ruby_x - _ruby_character_spacing} > {size.width}"
+                            )
+                # 元の実装は"<"までを返していたが、layout_textに合わせて</ruby>まで含める
+                rendered_text = text[: i + len("</rt></ruby>")]
+
+                # ルビ情報リセット
+                ruby_target_x = {"left": -1, "right": -1}
+                ruby = ""
+                ruby_target = ""
+                next_i = i + 5  # タグが終わるまで読み飛ばす
+
+            else:
+                raise ValueError(f"Invalid tag: {tag}")
+            continue
+
+        # 改行判定
+        insert_new_line = False
+        if in_ruby_target:
+            if not ruby_newline_checked:
+                # ルビ対象中は改行しない
+                # ルビ対象文字の1文字目にルビ終了までの長さを先読みして改行判定
+                insert_new_line = x + sum(
+                    [font.getlength(_c) + character_spacing for _c in ruby_target]
+                ) > (size.width - margin.right)
+                if insert_new_line:
+                    ruby_target_x["left"] = margin.left
+                ruby_newline_checked = True
+        else:
+            insert_new_line = x + font.getlength(c) > (size.width - margin.right)
+
+        # 改行処理
+        if insert_new_line:
+            y += get_height(font) + line_spacing
+            if has_ruby:
+                y += get_height(ruby_font) + ruby_line_spacing
+            x = margin.left
+
+            # 改行した行が入りきるか判定
+            next_line_bottom_y = y + get_height(font)
+            if has_ruby:
+                next_line_bottom_y += get_height(ruby_font) + ruby_line_spacing
+            if next_line_bottom_y > text_img.size[1]:
+                return text_img, rendered_text, text_max_x  # 改行までに描画した文字列を返す
+
+        # draw character
+        text_img_draw.text(
+            (x, y),
+            c,
+            fill=font_hex,
+            font=font if char_in_font(font, c) else fallback_font,
+        )
+        rendered_text = text[: i + 1]
+
+        x += font.getlength(c) + character_spacing
+        text_max_x = max(text_max_x, x - character_spacing)
+
+    return text_img, text, text_max_x
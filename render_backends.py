@@ -0,0 +1,89 @@
+"""
+テキストボックスを描画する実装（バックエンド）の切り替え
+
+reference: ImageDraw.textで1文字ずつ描画する元の実装（reference_render）。他のバックエンドの正解として使う
+pillow: layout_textでレイアウトを計算し、グリフアトラスから貼り付ける（create_textbox、既定）
+
+CFG1.backendに名前を指定して選ぶ。
+新しいバックエンドはRenderBackendを継承してregister_backendで登録する。
+equivalence.pyで、同じ入力を2つのバックエンドで描画した結果を比較できる。
+"""
+
+from abc import ABC, abstractmethod
+from PIL import Image
+from configs import TextBoxCFG
+from generation_utils import create_textbox
+from layout import TextLayout
+import reference_render
+
+
+class RenderBackend(ABC):
+    """
+    テキストボックスの描画方法。generate_dataはテキストボックスごとに
+    rendered_text = backend.draw_textbox(img, cfg, box)
+    を呼び出す（既定の実装は、create_textboxで作った画像をimgのcfg.tlに貼り付ける）。
+    box: 作成済みのテキストボックスの背景（create_boxの結果）。使わないバックエンドは無視してよい
+    layout: 計算済みのlayout_text(cfg)の結果（文字ごとの矩形を出力する場合に渡す）。使わないバックエンドは無視してよい
+    """
+
+    name: str = None
+
+    @abstractmethod
+    def create_textbox(
+        self, cfg: TextBoxCFG, box: Image.Image = None, layout: TextLayout = None
+    ) -> tuple[Image.Image, str]:
+        """テキストボックス1つ分のRGBA画像と描画済みのテキストを返す"""
+
+    def draw_textbox(
+        self,
+        img: Image.Image,
+        cfg: TextBoxCFG,
+        box: Image.Image = None,
+        layout: TextLayout = None,
+    ) -> str:
+        box_img, rendered_text = self.create_textbox(cfg, box, layout)
+        img.paste(box_img, cfg.tl.tuple, box_img)
+        return rendered_text
+
+
+class ReferenceBackend(RenderBackend):
+    name = "reference"
+
+    def create_textbox(
+        self, cfg: TextBoxCFG, box: Image.Image = None, layout: TextLayout = None
+    ) -> tuple[Image.Image, str]:
+        return reference_render.create_textbox(cfg, box)
+
+
+class PillowBackend(RenderBackend):
+    name = "pillow"
+
+    def create_textbox(
+        self, cfg: TextBoxCFG, box: Image.Image = None, layout: TextLayout = None
+    ) -> tuple[Image.Image, str]:
+        return create_textbox(cfg, box, layout)
+
+
+_backends = {}
+
+
+def register_backend(backend: RenderBackend):
+    """backend.nameの名前で登録する。同じ名前のバックエンドは置き換える"""
+    if not backend.name:
+        raise ValueError("backend must have a name")
+    _backends[backend.name] = backend
+
+
+def get_backend(name: str) -> RenderBackend:
+    backend = _backends.get(name)
+    if backend is None:
+        raise ValueError(f"unknown backend: {name!r} (available: {sorted(_backends)})")
+    return backend
+
+
+def available_backends() -> list[str]:
+    return sorted(_backends)
+
+
+register_backend(ReferenceBackend())
+register_backend(PillowBackend())
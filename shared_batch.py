@@ -0,0 +1,215 @@
+import concurrent.futures
+import json
+import os
+import multiprocessing
+import sys
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Iterator
+import numpy as np
+from augment import AugmentParams, augment_batch, augment_image
+from configs import CFG1
+from streaming import generate_sample
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """
+    別のプロセスが作成した共有メモリを開く。解放は作成したプロセスが行うため、resource_trackerに登録しない。
+    Python 3.13未満では開くだけで登録され（track=Falseは3.13以降のみ）、開いたプロセスのresource_trackerが
+    終了時に共有メモリを削除したり、リークの警告を出したりするため、開いた後に登録を取り消す。
+    ただし、multiprocessingで起動したプロセスが親のresource_trackerを引き継いでいる場合は、
+    作成したプロセスの登録と同じものになるため取り消さない（取り消すと作成したプロセスの登録が消える）。
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shared_tracker = (
+        multiprocessing.parent_process() is not None
+        and resource_tracker._resource_tracker._fd is not None
+    )
+    shm = shared_memory.SharedMemory(name=name)
+    if not shared_tracker:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class SharedBatch:
+    """
+    共有メモリ上に確保した(N, H, W, 3)のuint8配列と、各サンプルの正解データ。
+
+    arrayは共有メモリをそのまま参照しているため、torch.from_numpy(batch.array)などでコピーせずに利用できる。
+    別プロセスからはSharedBatch.attach(batch.name, batch.shape)で同じ配列を参照できる。
+    使い終わったらrelease()（またはwith文）で共有メモリを解放すること。
+    """
+
+    def __init__(self, shape: tuple[int, int, int, int], name: str = None):
+        self.shape = tuple(shape)
+        nbytes = int(np.prod(self.shape))
+        self._owner = name is None
+        if self._owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        else:
+            self.shm = _attach_shared_memory(name)
+        self.array = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        # to_gt_parse / to_gt_parse_ruby の結果
+        self.gt_parse = [None] * self.shape[0]
+        self.gt_parse_ruby = [None] * self.shape[0]
+        self.indices = np.full(self.shape[0], -1, dtype=np.int64)
+
+    @classmethod
+    def attach(cls, name: str, shape: tuple[int, int, int, int]) -> "SharedBatch":
+        return cls(shape, name=name)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def __len__(self):
+        return self.shape[0]
+
+    def gt_json(self, ruby: bool = False) -> list[str]:
+        gt = self.gt_parse_ruby if ruby else self.gt_parse
+        return [json.dumps(g, ensure_ascii=False) for g in gt]
+
+    def release(self):
+        # arrayへの参照が残っているとcloseできないため先に外す
+        self.array = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _render_into(cfg_factory, seed, max_retries, name, shape, slot, index):
+    # モデルの入力解像度で直接描画し、劣化はバッチがそろってからaugment_batchでまとめて加える
+    size = (shape[2], shape[1])
+    output = generate_sample(
+        cfg_factory, seed, index, max_retries, augment_image=False, size=size
+    )
+    img = output.image.convert("RGB")
+    augment = output.augment
+    if img.size != size:
+        # 縦横比が異なり直接描画できない場合は、generate_dataと同じ結果になるよう
+        # 描画した解像度で劣化を加えてからリサイズする
+        if augment is not None:
+            img = augment_image(img, augment)
+            augment = None
+        img = img.resize(size)
+
+    shm = _attach_shared_memory(name)
+    try:
+        array = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        array[slot] = np.asarray(img)
+        del array
+    finally:
+        shm.close()
+    return slot, index, output.to_gt_parse(), output.to_gt_parse_ruby(), augment
+
+
+_worker_args = None
+
+
+def _init_worker(cfg_factory, seed, max_retries):
+    global _worker_args
+    _worker_args = (cfg_factory, seed, max_retries)
+
+
+def _render_in_worker(name, shape, slot, index):
+    return _render_into(*_worker_args, name, shape, slot, index)
+
+
+class BatchGenerator:
+    """
+    サンプルをN個ずつ共有メモリ上の(N, H, W, 3)配列に直接書き込んで生成する。
+    ワーカーは画像を共有メモリに書き込み、正解データだけを返すため、画像をプロセス間でコピーしない。
+
+    cfg_factory, seed, max_retriesの意味はstreaming.generate_streamと同じで、
+    i番目のサンプルはワーカー数によらず同じになる。
+    size: 出力する画像の(W, H)。設定のW, Hと縦横比が同じ場合はcfg.scaleでその解像度に直接描画し、
+        異なる場合は描画した画像をリサイズする
+    設定にaugmentがある場合は、バッチの全てのサンプルを書き込んだ後にaugment_batchでまとめて劣化を加える。
+    """
+
+    def __init__(
+        self,
+        cfg_factory: Callable[[], CFG1],
+        batch_size: int,
+        size: tuple[int, int] = (CFG1.W, CFG1.H),
+        workers: int = None,
+        seed: int = 0,
+        max_retries: int = 3,
+    ):
+        self.cfg_factory = cfg_factory
+        self.batch_size = batch_size
+        self.size = tuple(size)
+        self.seed = seed
+        self.max_retries = max_retries
+        self.workers = workers
+        self.executor = None
+        if workers != 0:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count(),
+                initializer=_init_worker,
+                initargs=(cfg_factory, seed, max_retries),
+            )
+
+    def generate(self, start: int = 0) -> SharedBatch:
+        """start番目からbatch_size個のサンプルを生成する。"""
+        shape = (self.batch_size, self.size[1], self.size[0], 3)
+        batch = SharedBatch(shape)
+        try:
+            if self.executor is None:
+                results = [
+                    _render_into(
+                        self.cfg_factory,
+                        self.seed,
+                        self.max_retries,
+                        batch.name,
+                        shape,
+                        slot,
+                        start + slot,
+                    )
+                    for slot in range(self.batch_size)
+                ]
+            else:
+                futures = [
+                    self.executor.submit(
+                        _render_in_worker, batch.name, shape, slot, start + slot
+                    )
+                    for slot in range(self.batch_size)
+                ]
+                results = [future.result() for future in futures]
+        except BaseException:
+            batch.release()
+            raise
+
+        params = [AugmentParams()] * self.batch_size
+        for slot, index, gt_parse, gt_parse_ruby, augment in results:
+            batch.indices[slot] = index
+            batch.gt_parse[slot] = gt_parse
+            batch.gt_parse_ruby[slot] = gt_parse_ruby
+            if augment is not None:
+                params[slot] = augment
+        if any(augment is not None for *_, augment in results):
+            augment_batch(batch.array, params)
+        return batch
+
+    def __iter__(self) -> Iterator[SharedBatch]:
+        start = 0
+        while True:
+            yield self.generate(start)
+            start += self.batch_size
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
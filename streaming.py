@@ -0,0 +1,152 @@
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import os
+import random
+from typing import Callable, Iterator
+import numpy as np
+from configs import CFG1
+from generators import Outputs, generate_data
+
+
+def seed_sample(seed: int, index: int, attempt: int = 0) -> int:
+    """
+    サンプルごとの乱数シードを決め、randomとnumpy.randomのグローバルな状態を初期化する。
+    シードは(seed, index, attempt)だけで決まるため、どのワーカーで生成しても同じサンプルになる。
+    """
+    state = np.random.SeedSequence([seed, index, attempt]).generate_state(2)
+    sample_seed = (int(state[0]) << 32) | int(state[1])
+    random.seed(sample_seed)
+    np.random.seed(state)
+    return sample_seed
+
+
+@contextlib.contextmanager
+def _keep_global_random_state():
+    # workers=0などで呼び出し元のプロセスで生成する場合に、呼び出し元の乱数の状態を変えないようにする
+    state = random.getstate(), np.random.get_state()
+    try:
+        yield
+    finally:
+        random.setstate(state[0])
+        np.random.set_state(state[1])
+
+
+def _fit_scale(cfg: CFG1, size: tuple[int, int], default: float) -> float:
+    # CFG1.scaledと同じ丸めでsizeになる倍率。ない場合はdefault
+    scale = size[1] / cfg.H
+    if (round(cfg.W * scale), round(cfg.H * scale)) == tuple(size):
+        return scale
+    return default
+
+
+def generate_sample(
+    cfg_factory: Callable[[], CFG1],
+    seed: int,
+    index: int,
+    max_retries: int = 3,
+    augment_image: bool = True,
+    size: tuple[int, int] = None,
+) -> Outputs:
+    """
+    index番目のサンプルを生成する。cfg_factoryは引数なしで呼び出し、randomなどのグローバルな乱数を使ってよい。
+    ルビのはみ出しなどでValueErrorが発生した場合は、シードを変えてmax_retries回までやり直す。
+    cfg.augmentが設定されている場合は、サンプルのシードから選んだ劣化を加える
+    （augment_image=Falseの場合は画像には加えず、Outputs.augmentのパラメータだけを決める）。
+    size: 出力する画像の(W, H)。cfgのW, Hと縦横比が同じ場合は、cfg.scaleでその解像度に直接描画する
+    （縦横比が異なる場合はcfgのままにする）。
+    randomとnumpy.randomのグローバルな状態は、呼び出す前の状態に戻す。
+    """
+    with _keep_global_random_state():
+        for attempt in range(max_retries + 1):
+            sample_seed = seed_sample(seed, index, attempt)
+            try:
+                cfg = cfg_factory()
+                if size is not None:
+                    cfg.scale = _fit_scale(cfg, size, cfg.scale)
+                output = generate_data(
+                    cfg, augment_seed=sample_seed, augment_image=augment_image
+                )
+            except ValueError:
+                if attempt == max_retries:
+                    raise
+                continue
+            output.index = index
+            return output
+
+
+_worker_cfg_factory = None
+_worker_seed = None
+_worker_max_retries = 0
+
+
+def _init_worker(cfg_factory, seed, max_retries):
+    global _worker_cfg_factory, _worker_seed, _worker_max_retries
+    _worker_cfg_factory = cfg_factory
+    _worker_seed = seed
+    _worker_max_retries = max_retries
+
+
+def _generate_in_worker(index: int) -> Outputs:
+    return generate_sample(_worker_cfg_factory, _worker_seed, index, _worker_max_retries)
+
+
+def generate_stream(
+    cfg_factory: Callable[[], CFG1],
+    n: int = None,
+    workers: int = None,
+    seed: int = 0,
+    ordered: bool = False,
+    prefetch: int = 4,
+    max_retries: int = 3,
+) -> Iterator[Outputs]:
+    """
+    cfg_factoryで作った設定からサンプルを生成し、Outputsを順に返すイテレータ。
+
+    n: 生成するサンプル数（Noneの場合は無限に生成する）
+    workers: ワーカープロセス数（Noneの場合はCPU数、0の場合はこのプロセスで生成する）
+    seed: 乱数シード。i番目のサンプルは(seed, i)から決まる乱数で生成されるため、ワーカー数によらず同じ結果になる
+    ordered: Trueの場合はi=0,1,2,...の順に返し、Falseの場合は生成が終わった順に返す（Outputs.indexで区別できる）
+    prefetch: ワーカーあたりの先行生成数
+    max_retries: ValueErrorが発生した場合にシードを変えてやり直す回数
+
+    cfg_factoryはワーカーに渡すため、モジュールのトップレベルで定義された関数にすること。
+    """
+    indices = itertools.count() if n is None else iter(range(n))
+
+    if workers == 0:
+        for index in indices:
+            yield generate_sample(cfg_factory, seed, index, max_retries)
+        return
+
+    workers = workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(cfg_factory, seed, max_retries),
+    ) as executor:
+        # 無限に生成する場合でもメモリを使い切らないよう、実行中のタスク数を制限する
+        window = workers * prefetch
+        pending = collections.deque()
+        try:
+            for index in itertools.islice(indices, window):
+                pending.append(executor.submit(_generate_in_worker, index))
+
+            while pending:
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    future = next(f for f in pending if f in done)
+                    pending.remove(future)
+
+                output = future.result()
+                for index in itertools.islice(indices, 1):
+                    pending.append(executor.submit(_generate_in_worker, index))
+                yield output
+        finally:
+            for future in pending:
+                future.cancel()
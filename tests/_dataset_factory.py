@@ -0,0 +1,51 @@
+# テストでワーカーやgenerate_dataset.pyの--factoryに渡す設定
+import os
+import random
+import numpy as np
+from configs import CFG1, AugmentCFG, ImageCFG, Margin, Point, TextBoxCFG
+from font_utils import get_font
+from generation_utils import get_random_color_pair
+
+
+def make_cfg() -> CFG1:
+    # 背景だけの小さな画像
+    return CFG1(
+        W=32,
+        H=18,
+        bg_cfg=ImageCFG(path=os.environ["VNVDU_TEST_BG"]),
+        msgbox=None,
+        namebox=None,
+    )
+
+
+def make_random_cfg() -> CFG1:
+    # randomとnumpy.randomのグローバルな状態からメッセージを作る
+    font_path = os.environ["VNVDU_TEST_FONT"]
+    font_hex, bg_hex = get_random_color_pair()
+    words = ["alpha", "beta", "gamma", "delta", "<ruby>epsilon<rt>eps</rt></ruby>"]
+    text = " ".join(random.choice(words) for _ in range(int(np.random.randint(2, 8))))
+    msgbox = TextBoxCFG(
+        text=text,
+        tl=Point(4, 40),
+        br=Point(316, 116),
+        margin=Margin(*np.random.randint(2, 8, 4).tolist()),
+        font_hex=font_hex,
+        bg_hex=bg_hex,
+        _font=get_font(font_path, 16),
+        fallback_font=get_font(font_path, 16),
+        _ruby_font=get_font(font_path, 8),
+        fallback_ruby_font=get_font(font_path, 8),
+    )
+    return CFG1(
+        W=320,
+        H=120,
+        bg_cfg=ImageCFG(path=os.environ["VNVDU_TEST_BG"]),
+        msgbox=msgbox,
+        namebox=None,
+    )
+
+
+def make_augmented_cfg() -> CFG1:
+    cfg = make_random_cfg()
+    cfg.augment = AugmentCFG(scale_p=0.5, jitter_p=0.5, blur_p=1.0, noise_p=1.0)
+    return cfg
@@ -0,0 +1,45 @@
+import glob
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# 同梱のfonts/にフォントがない環境では、システムのフォントを使う
+FONT_CANDIDATES = sorted(glob.glob(os.path.join(ROOT, "fonts", "*.[to]tf"))) + [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/Library/Fonts/Arial.ttf",
+    "C:/Windows/Fonts/arial.ttf",
+]
+
+
+@pytest.fixture(scope="session")
+def font_path():
+    for path in FONT_CANDIDATES:
+        if os.path.exists(path):
+            return path
+    pytest.skip("no TrueType font available")
+
+
+@pytest.fixture
+def make_textbox(font_path):
+    from configs import Point, TextBoxCFG
+    from font_utils import get_font
+
+    def make(text: str, width: int = 600, height: int = 200, **kwargs) -> TextBoxCFG:
+        tl = kwargs.pop("tl", Point(0, 0))
+        cfg = TextBoxCFG(
+            text=text,
+            tl=tl,
+            br=Point(tl.x + width, tl.y + height),
+            _font=get_font(font_path, 32),
+            fallback_font=get_font(font_path, 32),
+            _ruby_font=get_font(font_path, 14),
+            fallback_ruby_font=get_font(font_path, 14),
+            **kwargs,
+        )
+        return cfg
+
+    return make
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from PIL import Image
+from asset_cache import AssetCache, PlateCache, compose_plate, working_copy
+from configs import CFG1, ImageCFG, Point
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    rng = np.random.default_rng(0)
+    path = tmp_path / "bg.png"
+    Image.fromarray(rng.integers(0, 256, (90, 160, 3), dtype=np.uint8)).save(path)
+    return str(path)
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "LA"])
+def test_mmap_matches_decode(tmp_path, image_path, mode):
+    path = str(tmp_path / f"src_{mode}.png")
+    Image.open(image_path).convert(mode).save(path)
+    expected = AssetCache().get(path, (80, 45))
+    for _ in range(2):  # 1回目は保存、2回目は保存済みのファイルを読み込む
+        img = AssetCache(mmap_dir=str(tmp_path / "mmap")).get(path, (80, 45))
+        copy = working_copy(img)
+        assert copy.mode == mode
+        assert np.array_equal(np.asarray(copy), np.asarray(expected))
+
+
+def test_mmap_rgb_shares_pages(tmp_path, image_path):
+    cache = AssetCache(mmap_dir=str(tmp_path / "mmap"))
+    img = cache.get(image_path, (80, 45))
+    assert img.mode == "RGBX" and img.readonly
+
+    # ファイルを書き換えると、コピーしていなければ画像にも反映される
+    (npy,) = (tmp_path / "mmap").glob("*.RGBX.npy")
+    array = np.load(npy, mmap_mode="r+")
+    array[0, 0, 0] ^= 0xFF
+    array.flush()
+    assert img.getpixel((0, 0))[0] == array[0, 0, 0]
+
+
+@pytest.fixture
+def plate_cfg(tmp_path, image_path):
+    rng = np.random.default_rng(1)
+    array = rng.integers(0, 256, (60, 30, 4), dtype=np.uint8)
+    array[..., 3] = np.where(array[..., 3] > 128, 255, 0)
+    fg_path = str(tmp_path / "fg.png")
+    Image.fromarray(array).save(fg_path)
+    return CFG1(
+        W=160,
+        H=90,
+        bg_cfg=ImageCFG(path=image_path),
+        character_cfg_list=[ImageCFG(path=fg_path, tl=Point(50, 0))],
+        msgbox=None,
+        namebox=None,
+    )
+
+
+def test_plate_cache_max_uses(plate_cfg):
+    assets = AssetCache()
+    cache = PlateCache(max_uses=3)
+    plates = [cache.get(plate_cfg, assets) for _ in range(7)]
+    # 3回ごとに合成し直す
+    assert plates[0] is plates[1] is plates[2]
+    assert plates[3] is plates[4] is plates[5]
+    assert plates[2] is not plates[3] and plates[5] is not plates[6]
+    assert (cache.hits, cache.misses, cache.retirements) == (4, 3, 2)
+
+    expected = np.asarray(compose_plate(plate_cfg, assets))
+    for plate in plates:
+        assert np.array_equal(np.asarray(plate), expected)
+
+
+def test_plate_cache_without_limit(plate_cfg):
+    cache = PlateCache()
+    plates = [cache.get(plate_cfg, AssetCache()) for _ in range(5)]
+    assert all(plate is plates[0] for plate in plates)
+    assert (cache.hits, cache.misses, cache.retirements) == (4, 1, 0)
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_working_copy_does_not_alias(tmp_path, image_path, mmap):
+    cache = AssetCache(mmap_dir=str(tmp_path / "mmap") if mmap else None)
+    img = cache.get(image_path, (80, 45))
+    before = np.array(img)
+    copy = working_copy(img)
+    copy.paste((1, 2, 3), (0, 0, 80, 45))
+    assert np.array_equal(np.asarray(img), before)
+    assert cache.get(image_path, (80, 45)) is img
@@ -0,0 +1,82 @@
+import random
+import numpy as np
+import pytest
+from PIL import Image
+from augment import AugmentParams, augment_batch, augment_image, sample_params
+from configs import CFG1, AugmentCFG, ImageCFG
+from generators import generate_data
+
+ALL = AugmentCFG(scale_p=0.5, jitter_p=0.7, blur_p=0.5, noise_p=0.5, jpeg_p=0.3)
+
+
+def _images(n, channels, seed=0):
+    rng = np.random.default_rng(seed)
+    # 一様な乱数よりぼかしやJPEGの差が出やすいよう、なめらかな模様にノイズを加える
+    y, x = np.mgrid[0:48, 0:64]
+    base = (np.sin(x / 5.0)[..., None] * np.cos(y / 7.0)[..., None] + 1) * 100
+    images = base + rng.integers(0, 50, (n, 48, 64, channels))
+    return np.clip(images, 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("channels", [3, 4])
+def test_augment_batch_matches_augment_image(channels):
+    images = _images(20, channels)
+    params = [sample_params(ALL, seed) for seed in range(len(images))]
+    assert any(p.scale != 1.0 for p in params)
+    assert any(p.blur_sigma > 0 for p in params)
+    assert any(p.noise_std > 0 for p in params)
+    assert any(p.jpeg_quality is not None for p in params)
+
+    expected = [
+        np.asarray(augment_image(Image.fromarray(img), p))
+        for img, p in zip(images, params)
+    ]
+    batch = augment_batch(images.copy(), params)
+    for i, img in enumerate(expected):
+        np.testing.assert_array_equal(batch[i], img, err_msg=f"sample {i}")
+
+
+def test_augment_batch_does_not_depend_on_batch_order():
+    images = _images(11, 3, seed=1)
+    params = [sample_params(ALL, seed) for seed in range(len(images))]
+    order = np.random.default_rng(2).permutation(len(images))
+    batch = augment_batch(images.copy(), params)
+    shuffled = augment_batch(images[order], [params[i] for i in order])
+    np.testing.assert_array_equal(shuffled, batch[order])
+
+
+def test_default_params_keep_the_image():
+    images = _images(3, 4)
+    out = augment_batch(images.copy(), [AugmentParams()] * 3)
+    np.testing.assert_array_equal(out, images)
+
+
+def test_generate_data_applies_cfg_augment(tmp_path):
+    bg = tmp_path / "bg.png"
+    Image.fromarray(_images(1, 3)[0]).save(bg)
+
+    def make_cfg(augment):
+        return CFG1(
+            W=64, H=48, bg_cfg=ImageCFG(path=str(bg)), msgbox=None, namebox=None, augment=augment
+        )
+
+    plain = generate_data(make_cfg(None))
+    assert plain.augment is None
+
+    augment = AugmentCFG(jitter_p=1.0, noise_p=1.0)
+    output = generate_data(make_cfg(augment), augment_seed=3)
+    assert output.augment == sample_params(augment, 3)
+    expected = augment_image(plain.image, sample_params(augment, 3))
+    np.testing.assert_array_equal(np.asarray(output.image), np.asarray(expected))
+
+    # augment_image=Falseの場合はパラメータだけを決める
+    deferred = generate_data(make_cfg(augment), augment_seed=3, augment_image=False)
+    assert deferred.augment == output.augment
+    np.testing.assert_array_equal(np.asarray(deferred.image), np.asarray(plain.image))
+
+    # シードを省略した場合はrandomから選ぶ
+    random.seed(0)
+    a = generate_data(make_cfg(augment))
+    random.seed(0)
+    b = generate_data(make_cfg(augment))
+    assert a.augment == b.augment
@@ -0,0 +1,59 @@
+import random
+import numpy as np
+import pytest
+import corpus
+from corpus import FLAG_INVALID, FLAG_RUBY, TextCorpus
+
+LINES = ["", "plain", "漢字かな", "<ruby>漢字<rt>かんじ</rt></ruby>です", "a < b", "crlf\r"]
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # 行がチャンクの境界をまたぐ場合を確認するため、チャンクを小さくする
+    monkeypatch.setattr(corpus, "_CHUNK_SIZE", 7)
+
+
+def check(c: TextCorpus, texts):
+    measured = [corpus._measure(text) for text in texts]
+    assert len(c) == len(texts)
+    assert [c[i] for i in range(len(c))] == [text.rstrip("\r\n") for text in texts]
+    assert c.lengths.tolist() == [length for length, _ in measured]
+    assert c.flags.tolist() == [flag for _, flag in measured]
+    assert c.offsets.dtype == np.uint64
+
+
+def test_text_index(tmp_path):
+    rng = random.Random(0)
+    lines = [rng.choice(LINES) * rng.randint(1, 4) for _ in range(200)] + ["last"]
+    path = tmp_path / "corpus.txt"
+    path.write_bytes("\n".join(lines).encode("utf-8"))  # 最後の行は改行なし
+    c = TextCorpus(str(path))
+    check(c, [line.rstrip("\r") for line in lines])
+    assert set(c.flags.tolist()) == {0, FLAG_RUBY, FLAG_INVALID}
+    c.close()
+
+    # 追記した場合は追記した部分だけを読み込む（改行のない最後の行は読み直す）
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("tail\n<ruby>字<rt>じ</rt></ruby>\n")
+    c = TextCorpus(str(path))
+    lines = lines[:-1] + [lines[-1] + "tail", "<ruby>字<rt>じ</rt></ruby>"]
+    check(c, [line.rstrip("\r") for line in lines])
+    assert c.meta["complete_lines"] == len(lines)
+    c.close()
+
+
+def test_parquet_index(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "corpus.parquet")
+    values = [LINES[i % len(LINES)] for i in range(40)] + [None]
+    pq.write_table(pa.table({"text": values}), path, row_group_size=6)
+    c = TextCorpus(path, column="text")
+    check(c, [v or "" for v in values])
+    c.close()
+
+    values += ["追加", "<ruby>行<rt>ぎょう</rt></ruby>"]
+    pq.write_table(pa.table({"text": values}), path, row_group_size=6)
+    c = TextCorpus(path, column="text")
+    check(c, [v or "" for v in values])
+    c.close()
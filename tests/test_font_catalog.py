@@ -0,0 +1,82 @@
+import glob
+import os
+import shutil
+import numpy as np
+import pytest
+from conftest import FONT_CANDIDATES
+from font_catalog import FontCatalog
+from font_utils import get_coverage
+
+
+def _fonts():
+    paths = [p for p in FONT_CANDIDATES if os.path.exists(p)]
+    for path in list(paths):
+        paths += glob.glob(os.path.join(os.path.dirname(path), "*.[to]tf"))
+    return sorted(set(paths))
+
+
+@pytest.fixture
+def fonts():
+    paths = _fonts()
+    if len(paths) < 3:
+        pytest.skip("needs at least 3 TrueType fonts")
+    return paths[:3]
+
+
+def assert_same_coverage(a, b):
+    assert a.codepoints == b.codepoints
+    assert a.empty == b.empty
+
+
+def assert_same_catalog(a, b):
+    assert a.meta["files"] == b.meta["files"]
+    assert a.meta["faces"] == b.meta["faces"]
+    for name in ("codepoints", "drawable", "empty"):
+        assert np.array_equal(getattr(a, name), getattr(b, name))
+
+
+def test_catalog_matches_get_coverage(tmp_path, fonts):
+    font_dir = tmp_path / "fonts"
+    font_dir.mkdir()
+    for path in fonts:
+        shutil.copy(path, font_dir)
+    (font_dir / "broken.ttf").write_bytes(b"not a font")
+
+    catalog = FontCatalog(str(font_dir))
+    assert len(catalog) == len(fonts)
+    for i, entry in enumerate(catalog.entries):
+        assert_same_coverage(catalog.coverage(i), get_coverage(entry.path, entry.index))
+
+    text = "Hello"
+    expected = [
+        i for i, entry in enumerate(catalog.entries)
+        if get_coverage(entry.path, entry.index).covers(text)
+    ]
+    assert catalog.covering(text).tolist() == expected
+
+
+def test_catalog_incremental_update(tmp_path, fonts):
+    font_dir = tmp_path / "fonts"
+    font_dir.mkdir()
+    for path in fonts[:2]:
+        shutil.copy(path, font_dir)
+    index_path = str(tmp_path / "incremental")
+    FontCatalog(str(font_dir), index_path)
+
+    # 1つ追加して1つ削除し、残りの1つは更新する
+    shutil.copy(fonts[2], font_dir)
+    os.remove(font_dir / os.path.basename(fonts[0]))
+    updated = font_dir / os.path.basename(fonts[1])
+    os.utime(updated, ns=(0, os.stat(updated).st_mtime_ns + 10**9))
+
+    catalog = FontCatalog(str(font_dir), index_path)
+    fresh = FontCatalog(str(font_dir), str(tmp_path / "fresh"))
+    assert_same_catalog(catalog, fresh)
+    assert [os.path.basename(e.path) for e in catalog.entries] == sorted(
+        os.path.basename(p) for p in fonts[1:]
+    )
+    for i, entry in enumerate(catalog.entries):
+        assert_same_coverage(catalog.coverage(i), get_coverage(entry.path, entry.index))
+
+    # 変更がない場合はそのまま使う
+    assert_same_catalog(FontCatalog(str(font_dir), index_path), fresh)
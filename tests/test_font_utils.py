@@ -0,0 +1,12 @@
+import generation_utils
+from font_utils import get_font
+
+
+def test_moved_functions_are_still_importable(font_path):
+    font = get_font(font_path, 32)
+    assert generation_utils.char_in_font(font, "A")
+    assert not generation_utils.char_in_font(font, " ")
+    assert generation_utils.ttfont_has_glyph(font_path, " ")
+    assert not generation_utils.ttfont_has_glyph(font_path, "\U0010fffd")
+    assert generation_utils.load_ttfont(font_path) is not None
+    assert generation_utils.get_height(font) == 32
@@ -0,0 +1,105 @@
+import concurrent.futures
+import json
+import os
+import tarfile
+import pytest
+from PIL import Image
+import generate_dataset
+
+FACTORY = "_dataset_factory:make_cfg"
+
+
+@pytest.fixture
+def output(tmp_path, monkeypatch):
+    bg = tmp_path / "bg.png"
+    Image.new("RGB", (64, 36), (40, 80, 120)).save(bg)
+    monkeypatch.setenv("VNVDU_TEST_BG", str(bg))
+    monkeypatch.syspath_prepend(os.path.dirname(__file__))
+    return str(tmp_path / "dataset")
+
+
+def run(output, *args):
+    generate_dataset.main(
+        ["--factory", FACTORY, "--output", output, "--workers", "1", *args]
+    )
+
+
+def tar_indices(path):
+    with tarfile.open(path) as tar:
+        return sorted({int(name.split(".")[0]) for name in tar.getnames()})
+
+
+def manifest(output, shard):
+    with open(os.path.join(output, f"shard-{shard:06d}.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_resume_rewrites_shards_with_a_different_range(output):
+    run(output, "-n", "10", "--shard-size", "8")
+    assert tar_indices(os.path.join(output, "shard-000001.tar")) == [8, 9]
+    mtime = os.path.getmtime(os.path.join(output, "shard-000000.tar"))
+
+    run(output, "-n", "12", "--shard-size", "8")
+    assert tar_indices(os.path.join(output, "shard-000001.tar")) == [8, 9, 10, 11]
+    assert manifest(output, 1)["num_samples"] == 4
+    assert manifest(output, 1)["shard_size"] == 8
+    # 範囲が同じシャードは書き直さない
+    assert os.path.getmtime(os.path.join(output, "shard-000000.tar")) == mtime
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--shard-size", "4"],
+        ["--shard-size", "8", "--seed", "1"],
+        ["--shard-size", "8", "--image-format", "jpg"],
+        ["--shard-size", "8", "--format", "parquet"],
+    ],
+)
+def test_resume_with_other_settings_raises(output, args):
+    run(output, "-n", "8", "--shard-size", "8")
+    with pytest.raises(ValueError, match="use another --output"):
+        run(output, "-n", "8", *args)
+
+
+def test_missing_shard_file_is_rewritten(output):
+    run(output, "-n", "4", "--shard-size", "4")
+    os.remove(os.path.join(output, "shard-000000.tar"))
+    run(output, "-n", "4", "--shard-size", "4")
+    assert tar_indices(os.path.join(output, "shard-000000.tar")) == [0, 1, 2, 3]
+
+
+def test_shards_selects_one_shard_or_a_range(output):
+    run(output, "-n", "20", "--shard-size", "4", "--shards", "2")
+    assert sorted(os.listdir(output)) == ["shard-000002.json", "shard-000002.tar"]
+
+    run(output, "-n", "20", "--shard-size", "4", "--shards", "3:")
+    assert tar_indices(os.path.join(output, "shard-000004.tar")) == [16, 17, 18, 19]
+    assert not os.path.exists(os.path.join(output, "shard-000001.tar"))
+
+
+@pytest.mark.parametrize("spec", ["x", "1:y", "1:2:3"])
+def test_invalid_shards_are_rejected(output, spec):
+    with pytest.raises(SystemExit):
+        run(output, "-n", "8", "--shards", spec)
+
+
+def test_shards_are_written_in_order_with_several_workers(output):
+    generate_dataset.main(
+        ["--factory", FACTORY, "--output", output, "--workers", "2",
+         "-n", "21", "--shard-size", "4"]
+    )
+    for shard in range(6):
+        expected = list(range(shard * 4, min(shard * 4 + 4, 21)))
+        assert tar_indices(os.path.join(output, f"shard-{shard:06d}.tar")) == expected
+        assert manifest(output, shard)["num_samples"] == len(expected)
+
+
+def test_module_root_is_the_factory_directory(output):
+    generate_dataset.load_factory(FACTORY)
+    assert generate_dataset.module_root(FACTORY) == os.path.dirname(os.path.abspath(__file__))
+    # パッケージのモジュールはパッケージの親ディレクトリ
+    package_dir = os.path.dirname(os.path.abspath(concurrent.futures.__file__))
+    assert generate_dataset.module_root("concurrent.futures:wait") == os.path.dirname(
+        os.path.dirname(package_dir)
+    )
@@ -0,0 +1,210 @@
+import collections
+import copy
+import io
+import os
+import numpy as np
+import pytest
+from PIL import ImageFont
+import layout
+from configs import Margin, Point
+from conftest import FONT_CANDIDATES
+from font_utils import get_font
+from generation_utils import get_tiled_option_cfgs
+from layout import (
+    CharBoxes,
+    break_lines,
+    fit_font_size,
+    fits_box,
+    layout_text,
+    ruby_font_size_for,
+)
+
+
+def break_lines_loop(widths, extents, character_spacing, left, right, max_lines=None):
+    """元のcreate_textareaと同じく1文字ずつ改行を判定する"""
+    x, line = left, 0
+    xs, lines, line_starts = [], [], [0]
+    n_chars = len(widths)
+    for k in range(len(widths)):
+        if x + extents[k] > right:
+            line += 1
+            x = left
+            if max_lines is not None and line >= max_lines:
+                n_chars = k
+                break
+            line_starts.append(k)
+        xs.append(x)
+        lines.append(line)
+        x += widths[k] + character_spacing
+    return np.array(xs), np.array(lines, dtype=np.int64), line_starts, n_chars
+
+
+def random_line(rng, n):
+    # FreeTypeの送り幅と同じ1/64単位にして、累積和の計算順で結果が変わらないようにする
+    widths = rng.integers(64, 64 * 40, n) / 64
+    extents = widths.copy()
+    spacing = int(rng.integers(0, 6))
+    k = 0
+    while k < n:
+        # ルビ対象の文字列: 1文字目で全体の幅を判定し、2文字目以降は改行しない
+        size = int(rng.integers(1, 5))
+        if rng.random() < 0.3:
+            group = slice(k, min(k + size, n))
+            extents[k] = np.sum(widths[group] + spacing)
+            extents[k + 1 : group.stop] = -np.inf
+            k = group.stop
+        else:
+            k += 1
+    return widths, extents, spacing
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_break_lines_matches_per_char_loop(seed):
+    rng = np.random.default_rng(seed)
+    widths, extents, spacing = random_line(rng, int(rng.integers(0, 120)))
+    left = int(rng.integers(0, 40))
+    right = left + int(rng.integers(20, 600))
+    max_lines = None if seed % 3 == 0 else int(rng.integers(1, 6))
+
+    result = break_lines(widths, extents, spacing, left, right, max_lines)
+    x, line, line_starts, n_chars = break_lines_loop(
+        widths, extents, spacing, left, right, max_lines
+    )
+    assert result.n_chars == n_chars
+    assert result.line_starts.tolist() == line_starts
+    np.testing.assert_array_equal(result.line, line)
+    np.testing.assert_array_equal(result.x, x)
+
+
+def test_break_lines_wraps_a_too_wide_first_character():
+    widths = np.array([50.0, 10.0])
+    result = break_lines(widths, widths.copy(), 0, 0, 40)
+    x, line, line_starts, n_chars = break_lines_loop(widths, widths.copy(), 0, 0, 40)
+    assert result.line_starts.tolist() == line_starts == [0, 0, 1]
+    np.testing.assert_array_equal(result.line, line)
+    assert result.n_chars == n_chars == 2
+
+
+def test_char_boxes_round_trip(make_textbox):
+    message = make_textbox(
+        "A <ruby>ruby<rt>rb</rt></ruby> message that wraps onto a second line",
+        tl=Point(40, 300),
+    )
+    name = make_textbox("Name", width=200, height=60, tl=Point(40, 220), centering=True)
+    parts = [
+        CharBoxes.from_layout(layout_text(cfg), cfg, i)
+        for i, cfg in enumerate([message, name])
+    ]
+    boxes = CharBoxes.concat(parts, ["messages", "names"])
+    assert len(boxes) == sum(len(part) for part in parts)
+    assert boxes.ruby.sum() == 2
+    assert boxes.chars.replace("rb", "").startswith("A ruby message")
+
+    buf = io.BytesIO()
+    np.savez(buf, **boxes.to_dict())
+    buf.seek(0)
+    with np.load(buf) as data:
+        loaded = CharBoxes.from_dict(data)
+
+    assert loaded.box_kinds == ["messages", "names"]
+    assert loaded.chars == boxes.chars
+    for field in ("boxes", "codepoints", "box_id", "ruby"):
+        expected, actual = getattr(boxes, field), getattr(loaded, field)
+        assert actual.dtype == expected.dtype
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_char_boxes_concat_of_nothing():
+    boxes = CharBoxes.from_dict(CharBoxes.concat([]).to_dict())
+    assert len(boxes) == 0
+    assert boxes.boxes.shape == (0, 4)
+    assert boxes.box_kinds == []
+
+
+def _fits(cfg, font_size):
+    trial = copy.copy(cfg)
+    trial.change_font_size(font_size)
+    trial.change_ruby_font_size(ruby_font_size_for(font_size, cfg.ruby_font.size))
+    try:
+        return fits_box(layout_text(trial), trial)
+    except ValueError:
+        return False
+
+
+FIT_TEXTS = [
+    "short",
+    "A longer <ruby>message<rt>msg</rt></ruby> that needs to wrap over several lines",
+    "<ruby>Ruby<rt>rb</rt></ruby> " * 12,
+]
+
+
+@pytest.mark.parametrize("text", FIT_TEXTS)
+def test_fit_font_size_is_the_largest_size_that_fits(make_textbox, text):
+    cfg = make_textbox(text, width=500, height=180)
+    size = fit_font_size(cfg)
+    assert _fits(cfg, size)
+    assert not _fits(cfg, size + 1)
+    # 引数のcfgは書き換えない
+    assert cfg.font.size == 32
+
+
+def test_fit_font_size_memo_follows_the_config(make_textbox, font_path, monkeypatch):
+    monkeypatch.setattr(layout, "_fit_font_size_cache", collections.OrderedDict())
+
+    def fresh(cfg):
+        # メモを使わずに計算した結果
+        saved = layout._fit_font_size_cache.copy()
+        layout._fit_font_size_cache.clear()
+        size = fit_font_size(cfg)
+        layout._fit_font_size_cache.clear()
+        layout._fit_font_size_cache.update(saved)
+        return size
+
+    cfg = make_textbox(FIT_TEXTS[1], width=500, height=180)
+    sizes = {fit_font_size(cfg)}
+
+    cfg.br = Point(cfg.br.x - 200, cfg.br.y)
+    assert fit_font_size(cfg) == fresh(cfg)
+    sizes.add(fit_font_size(cfg))
+
+    cfg.margin = Margin(top=40, right=40, bottom=40, left=40)
+    assert fit_font_size(cfg) == fresh(cfg)
+    sizes.add(fit_font_size(cfg))
+    assert len(sizes) == 3
+
+    others = [p for p in FONT_CANDIDATES if os.path.exists(p) and p != font_path]
+    if others:
+        cfg.font = get_font(others[0], cfg.font.size)
+        assert fit_font_size(cfg) == fresh(cfg)
+
+    # レイアウトエンジンが違うフォントは別のメモになる
+    n = len(layout._fit_font_size_cache)
+    font = copy.copy(cfg.font)
+    font.layout_engine = (
+        ImageFont.Layout.RAQM
+        if cfg.font.layout_engine == ImageFont.Layout.BASIC
+        else ImageFont.Layout.BASIC
+    )
+    cfg._font = font
+    fit_font_size(cfg)
+    assert len(layout._fit_font_size_cache) == n + 1
+
+
+def _tiled(make_textbox, **kwargs):
+    cfgs = [
+        make_textbox(text, width=700, height=120)
+        for text in ["Yes", "No", "<ruby>Maybe<rt>mb</rt></ruby> later"]
+    ]
+    get_tiled_option_cfgs(3, 1, Point(100, 100), Point(1800, 900), cfgs, **kwargs)
+    return [(c.tl, c.br, c.font.size, c.ruby_font.size) for c in cfgs]
+
+
+def test_tiled_options_exact_fit(make_textbox):
+    default = _tiled(make_textbox)
+    exact = _tiled(make_textbox, exact_fit=True)
+    # 配置は同じで、フォントサイズだけが変わる
+    assert [d[:2] for d in default] == [e[:2] for e in exact]
+    # フォントサイズを調整しない場合はexact_fitを指定しても同じ
+    assert _tiled(make_textbox, fit_font=False, exact_fit=True) == _tiled(
+        make_textbox, fit_font=False
+    )
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from PIL import Image
+from configs import CFG1, ImageCFG, Point
+from generation_utils import create_textbox
+from generators import generate_data
+from overlay_cache import OverlayCache, TextBoxCache
+
+
+@pytest.fixture
+def scene(tmp_path, make_textbox):
+    rng = np.random.default_rng(0)
+    bg_path = str(tmp_path / "bg.png")
+    Image.fromarray(rng.integers(0, 256, (360, 640, 3), dtype=np.uint8)).save(bg_path)
+
+    def make(bg_alpha=255):
+        noocr = [
+            make_textbox(label, width=120, height=40, tl=Point(20 + 140 * i, 10),
+                         bg_hex="#203040", font_hex="#f0f0f0", bg_alpha=bg_alpha)
+            for i, label in enumerate(["Save", "Load", "<ruby>Auto<rt>a</rt></ruby>"])
+        ]
+        msgbox = make_textbox("A message <ruby>with<rt>w</rt></ruby> ruby",
+                              width=600, height=120, tl=Point(20, 220),
+                              bg_alpha=bg_alpha)
+        namebox = make_textbox("Name", width=160, height=50, tl=Point(20, 160))
+        return CFG1(W=640, H=360, bg_cfg=ImageCFG(path=bg_path),
+                    msgbox=msgbox, namebox=namebox, noocrbox_list=noocr)
+
+    return make
+
+
+def assert_same(a, b):
+    assert a[1] == b[1]
+    assert a[0].size == b[0].size
+    assert np.array_equal(np.asarray(a[0]), np.asarray(b[0]))
+
+
+@pytest.mark.parametrize("bg_alpha", [255, 160])
+def test_overlay_cache_matches_uncached(scene, bg_alpha):
+    expected = generate_data(scene(bg_alpha))
+    cache = OverlayCache()
+    for _ in range(2):  # 1回目は合成、2回目はキャッシュした画像を使う
+        out = generate_data(scene(bg_alpha), overlays=cache)
+        assert out.to_gt_parse_ruby() == expected.to_gt_parse_ruby()
+        assert np.array_equal(np.asarray(out.image), np.asarray(expected.image))
+    # UI要素の合成画像1つとメッセージ・名前の背景2つ
+    assert cache.stats()["entries"] == 3
+    assert cache.hits == 3
+
+
+def test_textbox_cache_hits_by_content(make_textbox):
+    cache = TextBoxCache()
+    cfg = make_textbox("Name", width=200, height=60)
+    first = cache.get(cfg)
+    # 位置だけが異なるボックスは同じ画像を共有する
+    moved = make_textbox("Name", width=200, height=60, tl=Point(30, 40))
+    assert cache.get(moved) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert_same(first, create_textbox(moved))
+
+
+@pytest.mark.parametrize("field", ["text", "font", "margin"])
+def test_textbox_cache_misses_after_in_place_change(make_textbox, font_path, field):
+    cache = TextBoxCache()
+    cfg = make_textbox("An <ruby>option<rt>opt</rt></ruby> to choose", width=500, height=90)
+    cache.get(cfg)
+
+    if field == "text":
+        cfg.text = "Another <ruby>option<rt>alt</rt></ruby>"
+    elif field == "font":
+        cfg.change_font_size(cfg.font.size - 6)
+        cfg.change_ruby_font_size(cfg.ruby_font.size - 2)
+    else:
+        cfg.margin.left += 24
+        cfg.margin.top += 8
+
+    entry = cache.get(cfg)
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert_same(entry, create_textbox(cfg))
+    # 書き換えた後の設定でもう一度参照すればヒットする
+    assert cache.get(cfg) is entry
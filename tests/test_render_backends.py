@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from PIL import Image
+import render_backends
+from configs import Point
+from render_backends import (
+    RenderBackend,
+    available_backends,
+    get_backend,
+    register_backend,
+)
+
+TEXTS = [
+    "The quick brown fox jumps over the lazy dog. " * 3,
+    "A <ruby>ruby<rt>rb</rt></ruby> text with <ruby>two<rt>tw</rt></ruby> groups. " * 3,
+    "<ruby>Leading<rt>lead</rt></ruby> ruby and a very long line that has to wrap " * 4,
+]
+
+
+def test_backend_requires_create_textbox():
+    class Incomplete(RenderBackend):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_register_and_get_backend(monkeypatch):
+    monkeypatch.setattr(render_backends, "_backends", dict(render_backends._backends))
+
+    class Blank(RenderBackend):
+        name = "test-blank"
+
+        def create_textbox(self, cfg, box=None, layout=None):
+            return Image.new("RGBA", cfg.size.tuple), ""
+
+    register_backend(Blank())
+    assert "test-blank" in available_backends()
+    assert isinstance(get_backend("test-blank"), Blank)
+    with pytest.raises(ValueError, match="unknown backend"):
+        get_backend("no-such-backend")
+
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("centering", [False, True])
+def test_pillow_matches_reference(make_textbox, text, centering):
+    cfg = make_textbox(
+        text, width=520, height=160, tl=Point(10, 20), centering=centering, bg_alpha=180
+    )
+    base = Image.new("RGB", (560, 200), (30, 60, 90))
+    outputs = []
+    for name in ("reference", "pillow"):
+        img = base.copy()
+        rendered_text = get_backend(name).draw_textbox(img, cfg)
+        outputs.append((np.asarray(img), rendered_text))
+    (ref_img, ref_text), (img, rendered_text) = outputs
+    assert rendered_text == ref_text
+    np.testing.assert_array_equal(img, ref_img)
+
+
+def test_reference_keeps_closing_ruby_tags_when_truncated(make_textbox):
+    cfg = make_textbox("<ruby>word<rt>wd</rt></ruby>" * 30, width=400, height=100)
+    _, rendered_text = get_backend("reference").create_textbox(cfg)
+    assert rendered_text.endswith("</rt></ruby>")
+    assert rendered_text == get_backend("pillow").create_textbox(cfg)[1]
+
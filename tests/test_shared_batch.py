@@ -0,0 +1,114 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+from PIL import Image
+from augment import augment_image
+from shared_batch import BatchGenerator, SharedBatch
+from streaming import generate_sample
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_ATTACH_SCRIPT = """
+import sys
+sys.path.insert(0, {root!r})
+from shared_batch import SharedBatch
+batch = SharedBatch.attach({name!r}, {shape!r})
+batch.array[0, 0, 0, 0] = 7
+batch.release()
+"""
+
+
+def test_attach_from_other_process_does_not_unlink():
+    # 別のresource_trackerを持つプロセスで開いて終了しても、共有メモリは削除されず警告も出ない
+    with SharedBatch((2, 4, 4, 3)) as batch:
+        script = _ATTACH_SCRIPT.format(root=ROOT, name=batch.name, shape=batch.shape)
+        result = subprocess.run(
+            [sys.executable, "-c", script], capture_output=True, text=True, timeout=60
+        )
+        assert result.returncode == 0, result.stderr
+        assert "leaked" not in result.stderr
+        assert batch.array[0, 0, 0, 0] == 7
+
+        again = SharedBatch.attach(batch.name, batch.shape)
+        assert again.array[0, 0, 0, 0] == 7
+        again.release()
+
+
+_CHILD_SCRIPT = """
+import multiprocessing
+import sys
+sys.path.insert(0, {root!r})
+from shared_batch import SharedBatch
+
+
+def write(name, shape):
+    batch = SharedBatch.attach(name, shape)
+    batch.array[0, 0, 0, 0] += 1
+    batch.release()
+
+
+if __name__ == "__main__":
+    with SharedBatch((1, 2, 2, 3)) as batch:
+        for method in ("fork", "spawn"):
+            p = multiprocessing.get_context(method).Process(
+                target=write, args=(batch.name, batch.shape)
+            )
+            p.start()
+            p.join()
+            assert p.exitcode == 0
+        assert batch.array[0, 0, 0, 0] == 2
+"""
+
+
+def test_attach_from_child_process_keeps_creator_registration(tmp_path):
+    # 親のresource_trackerを引き継いだ子プロセスで開いても、作成したプロセスの登録を消さない
+    script = tmp_path / "child.py"
+    script.write_text(_CHILD_SCRIPT.format(root=ROOT))
+    result = subprocess.run(
+        [sys.executable, str(script)], capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr
+    assert "Traceback" not in result.stderr
+    assert "leaked" not in result.stderr
+
+
+@pytest.fixture
+def factory(tmp_path, monkeypatch, font_path):
+    bg = tmp_path / "bg.png"
+    Image.new("RGB", (320, 120), (40, 80, 120)).save(bg)
+    monkeypatch.setenv("VNVDU_TEST_BG", str(bg))
+    monkeypatch.setenv("VNVDU_TEST_FONT", font_path)
+    monkeypatch.syspath_prepend(os.path.dirname(__file__))
+    from _dataset_factory import make_augmented_cfg
+
+    return make_augmented_cfg
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_batch_matches_generate_sample_at_model_resolution(factory, workers):
+    size = (160, 60)
+    with BatchGenerator(factory, 4, size=size, workers=workers, seed=3) as generator:
+        batch = generator.generate(0)
+    try:
+        for i in range(4):
+            # 縮小した解像度で描画してから劣化を加える（リサイズしてから加えるのではない）
+            output = generate_sample(factory, 3, i, size=size)
+            assert output.image.size == size
+            np.testing.assert_array_equal(batch.array[i], np.asarray(output.image))
+    finally:
+        batch.release()
+
+
+def test_batch_with_other_aspect_ratio_augments_before_resizing(factory):
+    size = (100, 100)
+    with BatchGenerator(factory, 2, size=size, workers=0, seed=3) as generator:
+        batch = generator.generate(0)
+    try:
+        for i in range(2):
+            output = generate_sample(factory, 3, i, augment_image=False)
+            expected = augment_image(output.image, output.augment).resize(size)
+            np.testing.assert_array_equal(batch.array[i], np.asarray(expected))
+    finally:
+        batch.release()
@@ -0,0 +1,59 @@
+import os
+import random
+import numpy as np
+import pytest
+from PIL import Image
+from streaming import generate_sample, generate_stream
+
+N = 12
+
+
+@pytest.fixture
+def factory(tmp_path, monkeypatch, font_path):
+    bg = tmp_path / "bg.png"
+    Image.new("RGB", (320, 120), (40, 80, 120)).save(bg)
+    monkeypatch.setenv("VNVDU_TEST_BG", str(bg))
+    monkeypatch.setenv("VNVDU_TEST_FONT", font_path)
+    # ワーカーでも読み込めるよう、モジュールの場所を環境変数でも渡す
+    tests_dir = os.path.dirname(__file__)
+    monkeypatch.syspath_prepend(tests_dir)
+    monkeypatch.setenv(
+        "PYTHONPATH", os.pathsep.join([tests_dir, os.environ.get("PYTHONPATH", "")])
+    )
+    from _dataset_factory import make_random_cfg
+
+    return make_random_cfg
+
+
+def summary(outputs):
+    return [
+        (o.index, o.text_ruby, np.asarray(o.image).tobytes())
+        for o in sorted(outputs, key=lambda o: o.index)
+    ]
+
+
+def test_output_does_not_depend_on_workers(factory):
+    expected = summary(generate_stream(factory, n=N, workers=0, seed=5))
+    assert [index for index, *_ in expected] == list(range(N))
+    assert len({text for _, text, _ in expected}) > 1
+
+    ordered = list(generate_stream(factory, n=N, workers=2, seed=5, ordered=True))
+    assert [o.index for o in ordered] == list(range(N))
+    assert summary(ordered) == expected
+
+    unordered = generate_stream(factory, n=N, workers=2, seed=5, ordered=False)
+    assert summary(unordered) == expected
+
+
+def test_in_process_generation_keeps_caller_random_state(factory):
+    random.seed(1)
+    np.random.seed(1)
+    expected = random.random(), np.random.random()
+
+    random.seed(1)
+    np.random.seed(1)
+    stream = generate_stream(factory, n=3, workers=0, seed=5)
+    next(stream)
+    generate_sample(factory, 0, 7)
+    list(stream)
+    assert (random.random(), np.random.random()) == expected
@@ -0,0 +1,89 @@
+import re
+import pytest
+from utils import RubyMarkupError, parse_ruby, remove_ruby_tags
+
+
+def test_plain_text():
+    markup = parse_ruby("ルビなしのテキスト")
+    assert markup.plain == "ルビなしのテキスト"
+    assert not markup.has_ruby
+    assert len(markup.segments) == 1
+
+
+def test_segments_and_offsets():
+    text = "大<ruby>自然<rt>しぜん</rt></ruby>の<ruby>中<rt>なか</rt></ruby>"
+    markup = parse_ruby(text)
+    assert markup.plain == "大自然の中"
+    assert markup.has_ruby
+    assert [(s.base, s.ruby) for s in markup.segments] == [
+        ("大", None),
+        ("自然", "しぜん"),
+        ("の", None),
+        ("中", "なか"),
+    ]
+    assert [s.start for s in markup.segments] == [0, 1, 3, 4]
+    assert text[markup.segments[1].source_start : markup.segments[1].source_end] == (
+        "<ruby>自然<rt>しぜん</rt></ruby>"
+    )
+
+
+def test_source_offset_keeps_ruby_groups_whole():
+    text = "大<ruby>自然<rt>しぜん</rt></ruby>の"
+    markup = parse_ruby(text)
+    assert markup.source_offset(0) == 0
+    assert text[: markup.source_offset(1)] == "大"
+    # ルビ対象の途中までしか描画していない場合はルビを含めない
+    assert text[: markup.source_offset(2)] == "大"
+    assert text[: markup.source_offset(3)] == "大<ruby>自然<rt>しぜん</rt></ruby>"
+    assert markup.source_offset(4) == len(text)
+
+
+def test_empty_and_adjacent_ruby():
+    assert parse_ruby("").plain == ""
+    markup = parse_ruby("<ruby>鰍<rt>かじか</rt></ruby><ruby>釣り<rt>つり</rt></ruby>")
+    assert markup.plain == "鰍釣り"
+    assert len(markup.ruby_segments) == 2
+
+
+@pytest.mark.parametrize(
+    "text, position",
+    [
+        ("a < b", 2),
+        ("<rt>かん</rt>", 0),
+        ("<ruby>漢字</ruby>", 8),
+        ("<ruby>漢字<rt>かんじ</ruby>", 15),
+        ("<ruby>漢字<rt>かんじ</rt>", 15),
+        ("<ruby>漢字<rt>かんじ", 12),
+        ("</ruby>", 0),
+    ],
+)
+def test_malformed_markup_raises(text, position):
+    with pytest.raises(RubyMarkupError) as e:
+        parse_ruby(text)
+    assert e.value.position == position
+    assert isinstance(e.value, ValueError)
+
+
+def _remove_ruby_tags_regex(text):
+    return re.sub(r"<ruby>(.*?)<rt>.*?</rt></ruby>", r"\1", text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "普通のテキスト",
+        "<ruby>漢字<rt>かんじ</rt></ruby>を<ruby>読<rt>よ</rt></ruby>む",
+        # タグが不正なテキストはエラーにせず、以前の正規表現と同じ結果を返す
+        "a < b",
+        "<ruby>漢<rt>かん</rt></ruby>字 < x",
+        "<ruby>漢字<rt>かんじ</rt>",
+    ],
+)
+def test_remove_ruby_tags_matches_regex(text):
+    assert remove_ruby_tags(text) == _remove_ruby_tags_regex(text)
+
+
+def test_has_ruby_is_lenient(make_textbox):
+    assert make_textbox("<ruby>漢字<rt>かんじ</rt></ruby>").has_ruby
+    assert not make_textbox("a < b").has_ruby
+    assert make_textbox("<ruby>漢字<rt>かんじ</rt>").has_ruby
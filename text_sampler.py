@@ -0,0 +1,143 @@
+import copy
+import dataclasses
+import random
+from collections import OrderedDict
+from typing import Sequence
+from configs import TextBoxCFG
+from layout import layout_text
+from utils import RubyMarkupError, parse_ruby, split_sentence
+
+_fit_cache = OrderedDict()
+FIT_CACHE_MAXSIZE = 65536
+
+
+def measure_fit(cfg: TextBoxCFG, text: str) -> tuple[int, int]:
+    """
+    cfgのボックスの形状とフォントでtextを描画した場合に(描画できる文字数, 全体の文字数)を返す。
+    文字数はタグとルビを除いた文字数。画像は描画せずlayout_textの結果だけで判定し、結果はメモ化する。
+    ルビがはみ出す場合やタグが不正な場合は、描画できる文字数を0とする。
+    """
+    key = (
+        text,
+        cfg.size.tuple,
+        dataclasses.astuple(cfg.margin),
+        cfg.line_spacing,
+        cfg.character_spacing,
+        cfg.ruby_line_spacing,
+        cfg.ruby_character_spacing,
+        (cfg.font.path, cfg.font.index, cfg.font.size),
+        (cfg.ruby_font.path, cfg.ruby_font.index, cfg.ruby_font.size),
+    )
+    result = _fit_cache.get(key)
+    if result is not None:
+        _fit_cache.move_to_end(key)
+        return result
+
+    # 引数のcfgは書き換えない
+    trial = copy.copy(cfg)
+    trial.text = text
+    try:
+        total = len(parse_ruby(text).plain)
+        result = (len(layout_text(trial).codepoints), total)
+    except RubyMarkupError:
+        result = (0, len(text))
+    except ValueError:
+        # ルビが左右にはみ出す場合
+        result = (0, total)
+
+    _fit_cache[key] = result
+    while len(_fit_cache) > FIT_CACHE_MAXSIZE:
+        _fit_cache.popitem(last=False)
+    return result
+
+
+def fits(cfg: TextBoxCFG, text: str) -> bool:
+    n_fit, total = measure_fit(cfg, text)
+    return n_fit >= total
+
+
+class FitSampler:
+    """
+    テキストボックスに収まるテキストを選ぶサンプラー。
+
+    textsからランダムに選んだテキストがcfgに収まらない場合は、split_sentenceで文に分けて
+    収まる範囲の連続した文だけを返し、それでも収まらなければ別のテキストを選び直す（max_triesまで）。
+    描画した結果が途中で切り捨てられることがなくなり、rendered_textとtextが一致する。
+
+    texts: テキストのシーケンス（list、corpus.TextCorpusなど）
+    split: 収まらないテキストを文に分けて使うかどうか
+    rng: 省略した場合はグローバルなrandomを使う
+
+    stats()のnaive_truncation_rateは最初に選んだテキストをそのまま描画した場合の切り捨て率、
+    truncation_rateはこのサンプラーが返したテキストの切り捨て率。
+    """
+
+    def __init__(
+        self,
+        texts: Sequence[str],
+        max_tries: int = 8,
+        split: bool = True,
+        rng: random.Random = None,
+    ):
+        self.texts = texts
+        self.max_tries = max_tries
+        self.split = split
+        self.rng = rng
+        self.reset_stats()
+
+    def sample(self, cfg: TextBoxCFG) -> str:
+        """cfgのボックスの形状とフォントで切り捨てずに描画できるテキストを返す。"""
+        rng = self.rng if self.rng is not None else random
+        self.samples += 1
+        text = None
+        for attempt in range(self.max_tries):
+            text = self.texts[rng.randrange(len(self.texts))]
+            self.tries += 1
+            fit = fits(cfg, text)
+            if attempt == 0 and not fit:
+                self.naive_truncated += 1
+            if fit:
+                return text
+            if self.split:
+                part = self._fit_sentences(cfg, text, rng)
+                if part is not None:
+                    self.splits += 1
+                    return part
+
+        # 収まるテキストが見つからない場合は、最後に選んだテキストをそのまま返す
+        self.truncated += 1
+        return text
+
+    def _fit_sentences(self, cfg: TextBoxCFG, text: str, rng) -> str:
+        """ランダムな文から始めて、収まる限り後ろの文をつなげたテキストを返す。1文も収まらない場合はNone"""
+        sentences = split_sentence(text)
+        if len(sentences) <= 1:
+            return None
+        starts = list(range(len(sentences)))
+        rng.shuffle(starts)
+        for start in starts:
+            if not fits(cfg, sentences[start]):
+                continue
+            end = start + 1
+            while end < len(sentences) and fits(cfg, "".join(sentences[start : end + 1])):
+                end += 1
+            return "".join(sentences[start:end])
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "samples": self.samples,
+            "tries": self.tries,
+            "splits": self.splits,
+            "naive_truncation_rate": self.naive_truncated / self.samples
+            if self.samples
+            else 0.0,
+            "truncation_rate": self.truncated / self.samples if self.samples else 0.0,
+        }
+
+    def reset_stats(self):
+        self.samples = 0
+        self.tries = 0
+        self.splits = 0
+        self.naive_truncated = 0
+        self.truncated = 0
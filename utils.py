@@ -1,8 +1,129 @@
+import functools
 import re
+from dataclasses import dataclass
+
+
+class RubyMarkupError(ValueError):
+    """ルビのタグが不正な場合のエラー。positionは元のテキスト中の位置。"""
+
+    def __init__(self, reason: str, text: str, position: int):
+        self.reason = reason
+        self.text = text
+        self.position = position
+        super().__init__(f"{reason} at {position}: {text[position : position + 20]!r}")
+
+
+@dataclass(frozen=True)
+class RubySegment:
+    base: str  # 描画する文字列
+    ruby: str = None  # ルビ（ルビなしの区間はNone）
+    start: int = 0  # タグを除いた文字列中の開始位置
+    source_start: int = 0  # 元のテキスト中の開始位置
+    source_end: int = 0  # 元のテキスト中の終了位置（ルビの場合は</ruby>の後）
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.base)
+
+
+@dataclass(frozen=True)
+class RubyText:
+    text: str  # 元のテキスト（タグ付き）
+    plain: str  # タグとルビを除いた文字列
+    segments: tuple[RubySegment, ...]
+
+    @property
+    def has_ruby(self) -> bool:
+        return any(segment.ruby is not None for segment in self.segments)
+
+    @property
+    def ruby_segments(self) -> tuple[RubySegment, ...]:
+        return tuple(segment for segment in self.segments if segment.ruby is not None)
+
+    def source_offset(self, n: int) -> int:
+        """
+        タグを除いた文字列の先頭n文字を描画したときの、元のテキスト中の終了位置を返す。
+        ルビは対象文字列をすべて描画した場合にのみ含め、</ruby>までを含む位置を返す。
+        """
+        offset = 0
+        for segment in self.segments:
+            if segment.end <= n:
+                offset = segment.source_end
+            else:
+                if segment.ruby is None:
+                    offset = segment.source_start + (n - segment.start)
+                break
+        return offset
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_ruby(text: str) -> RubyText:
+    """
+    <ruby>漢字<rt>かんじ</rt></ruby> の形式のテキストを1回の走査で区間に分解する。
+    一つの<ruby>タグに複数の<rt>は含められない（rubyタグ自体を複数使って記述する必要がある）
+    タグが不正な場合はRubyMarkupErrorを上げる。結果は文字列ごとにキャッシュする。
+    """
+    segments = []
+    plain_len = 0
+    i = 0
+    n = len(text)
+    while i < n:
+        j = text.find("<", i)
+        if j == -1:
+            j = n
+        if j > i:
+            segments.append(
+                RubySegment(
+                    base=text[i:j], start=plain_len, source_start=i, source_end=j
+                )
+            )
+            plain_len += j - i
+        if j == n:
+            break
+
+        if not text.startswith("<ruby>", j):
+            if text.startswith(("</ruby>", "<rt>", "</rt>"), j):
+                raise RubyMarkupError("Unexpected tag", text, j)
+            raise RubyMarkupError("Invalid tag", text, j)
+
+        base_start = j + 6
+        rt = text.find("<", base_start)
+        if rt == -1 or not text.startswith("<rt>", rt):
+            raise RubyMarkupError("Expected <rt>", text, base_start if rt == -1 else rt)
+        ruby_start = rt + 4
+        close = text.find("<", ruby_start)
+        if close == -1 or not text.startswith("</rt></ruby>", close):
+            raise RubyMarkupError(
+                "Expected </rt></ruby>", text, ruby_start if close == -1 else close
+            )
+        end = close + 12
+
+        base = text[base_start:rt]
+        segments.append(
+            RubySegment(
+                base=base,
+                ruby=text[ruby_start:close],
+                start=plain_len,
+                source_start=j,
+                source_end=end,
+            )
+        )
+        plain_len += len(base)
+        i = end
+
+    plain = "".join(segment.base for segment in segments)
+    return RubyText(text=text, plain=plain, segments=tuple(segments))
+
+
+_RUBY_TAG_PATTERN = re.compile(r"<ruby>(.*?)<rt>.*?</rt></ruby>")
 
 
 def remove_ruby_tags(text):
-    return re.sub(r"<ruby>(.*?)<rt>.*?</rt></ruby>", r"\1", text)
+    # タグが不正なテキスト（"<"を含む文など）はエラーにせず、正しいルビのタグだけを取り除く
+    try:
+        return parse_ruby(text).plain
+    except RubyMarkupError:
+        return _RUBY_TAG_PATTERN.sub(r"\1", text)
 
 
 def split_sentence(text):